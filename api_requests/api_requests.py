@@ -1,69 +1,237 @@
+import asyncio
+import hashlib
 import json
 import os
 import aiofiles
-import aiohttp
 from models.machine import MediaMachine
+from api_requests.client import HttpClient, default_client
+from api_requests import segmented
+from system_works.async_fs import create_empty
+from api_requests.manifest import ChunkRepairError, ChunkVerifier, fetch_manifest, repair, verify_and_repair
 import logging
 
 logger = logging.getLogger(__name__)
 
+def restore_partial_hash(machine: MediaMachine,
+                         downloading_path: str,
+                         resume_byte_pos: int,
+                         hash_name: str = 'md5'):
+    '''Возвращает объект хэша для уже скачанной части файла. Состояние
+    берется из сохраненного при обрыве загрузки, иначе префикс
+    файла перечитывается один раз'''
+
+    saved = machine.partial_hashes.pop(downloading_path, None)
+    if saved is not None and saved[0] == resume_byte_pos:
+        return saved[1]
+
+    filehash = hashlib.new(hash_name)
+    if resume_byte_pos:
+        logger.info(f"Нет сохраненного хэша префикса, перечитываю {downloading_path}")
+        with open(downloading_path, 'rb') as file:
+            while chunk := file.read(1024*1024):
+                filehash.update(chunk)
+    return filehash
+
+
+async def _partial_download(machine: MediaMachine, downloading_path: str) -> tuple[bool, int]:
+    # (есть ли недокачанный файл, его размер) одним stat в пуле fs
+    try:
+        return True, (await machine.fs.stat(downloading_path)).st_size
+    except FileNotFoundError:
+        return False, 0
+
+
 async def get_file(
         machine: MediaMachine,
         url,
         filename,
-        chunk_write_size=1024,):
-
-    file_handling_event = machine.get_event(filename)
-    await file_handling_event.wait()
-    file_handling_event.clear()
-
-    downloading_path = os.path.abspath(f'{machine.downloading_dir}/{filename}')
-    resume_mode = os.path.exists(downloading_path)
-    resume_byte_pos = os.path.getsize(downloading_path) if resume_mode else 0
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-                            url,
-                            headers={"Range": f"bytes={resume_byte_pos}-"}
-                            ) as response:
-
-            if response.status // 400:
-                logger.warning(f"No such file: {filename}, status: {response.status}")
-                file_handling_event.set()
-                return
-
-            elif response.status == 206 or not resume_mode:
-                mode = 'ab' if resume_mode else 'wb'
-                async with aiofiles.open(downloading_path, mode) as file:
+        chunk_write_size=64*1024,
+        md5hash=None,
+        hash_name='md5'):
+    '''Загрузка файла с докачкой. Хэш считается на лету по мере
+    поступления кусков, поэтому повторное чтение файла для сверки не нужно.
+    Большие файлы качаются параллельными диапазонами (segmented), если
+    сервер их поддерживает; тогда хэш считается одним чтением после загрузки.
+    Если источник публикует манифест кусков, куски проверяются по мере
+    записи, перед докачкой проверяется уже скачанная часть, а испорченные
+    куски перезагружаются по отдельности вместо всего файла.
+    Вернет кортеж (совпал ли хэш с md5hash, имя файла, хэш) или None,
+    если файл получить не удалось'''
+
+    async with machine.locks.exclusive(filename):
+        downloading_path = os.path.abspath(f'{machine.downloading_dir}/{filename}')
+        resume_mode, resume_byte_pos = await _partial_download(machine, downloading_path)
+        result = None
+        manifest = (await fetch_manifest(machine.http.session, url, md5hash)
+                    if md5hash is not None else None)
+        verifier = None
+
+        if (manifest is not None and resume_mode
+                and not await machine.fs.exists(segmented.state_path(downloading_path))):
+            # Порча уже скачанной части обнаруживается до докачки
+            checked = set(range(resume_byte_pos // manifest.chunk_size))
+            bad = await asyncio.to_thread(manifest.verify_file, downloading_path, checked)
+            if bad:
+                logger.warning(f"{filename}: испорчено кусков скачанной части {len(bad)}, перезагружаю")
+                machine.metrics.inc('chunks_repaired_total', len(bad))
+                machine.partial_hashes.pop(downloading_path, None)
+                if not await repair(machine.http.session, url, downloading_path, manifest, bad):
+                    await machine.fs.remove(downloading_path)
+                    resume_mode, resume_byte_pos, checked = False, 0, set()
+            verifier = ChunkVerifier(manifest, resume_byte_pos)
+            verifier.verified.update(checked)
+
+        try:
+            downloads = machine.downloads
+            if downloads.segments > 1 and (
+                    not resume_mode
+                    or await machine.fs.exists(segmented.state_path(downloading_path))):
+                digest = await segmented.download(
+                    machine.http.session, url, downloading_path,
+                    segments=downloads.segments,
+                    min_segment_size=downloads.min_segment_size,
+                    hash_name=hash_name,
+                    reserve=lambda path, offset, length: machine.storage.reserve_download(
+                        machine, path, offset, length),
+                    hasher=machine.hasher.hash_file,
+                    manifest=manifest,
+                    fs=machine.fs)
+                if digest is not None:
+                    result = (True, filename, digest)
+                    logger.info("Download completed")
+                resume_mode, resume_byte_pos = await _partial_download(machine, downloading_path)
+
+            if result is None:
+                if manifest is not None and (verifier is None or not resume_mode):
+                    # После неудачной сегментной попытки файл качается заново
+                    verifier = ChunkVerifier(manifest, resume_byte_pos)
+                result = await _get_file_stream(machine, url, filename,
+                                                downloading_path, resume_mode,
+                                                resume_byte_pos, chunk_write_size,
+                                                hash_name, verifier)
+                if result is not None and manifest is not None:
+                    repaired = await verify_and_repair(machine.http.session, url,
+                                                       downloading_path, manifest, [verifier])
+                    if repaired:
+                        machine.metrics.inc('chunks_repaired_total', repaired)
+                        # Хэш на лету считался по испорченным данным
+                        result = (True, filename, await machine.hasher.hash_file(downloading_path))
+        except ChunkRepairError as exception:
+            # Источник отдает испорченные куски - начинаем заново при повторе
+            logger.error(f"{filename}: {exception}, загрузка отменена")
+            machine.metrics.inc('chunk_repair_failures_total')
+            machine.partial_hashes.pop(downloading_path, None)
+            await machine.fs.remove(downloading_path, segmented.state_path(downloading_path))
+            raise
+
+        if result is not None and md5hash is not None:
+            result = (md5hash == result[2], filename, result[2])
+            if not result[0]:
+                logger.warning(f"Хэш {filename} не совпал: {result[2]} != {md5hash}, удаляю")
+                await machine.fs.remove(downloading_path)
+
+    return result
+
+
+async def _get_file_stream(machine: MediaMachine, url, filename,
+                           downloading_path, resume_mode, resume_byte_pos,
+                           chunk_write_size, hash_name, verifier=None):
+    '''Загрузка одним потоком с докачкой через Range. verifier
+    (ChunkVerifier) проверяет куски по мере записи'''
+
+    result = None
+    async with machine.http.session.get(
+                        url,
+                        headers={"Range": f"bytes={resume_byte_pos}-"}
+                        ) as response:
+
+        if response.status == 416 and resume_mode:
+            # Файл уже скачан целиком, но еще не перенесен
+            filehash = await asyncio.to_thread(
+                restore_partial_hash, machine, downloading_path,
+                resume_byte_pos, hash_name)
+            result = (True, filename, filehash.hexdigest())
+
+        elif response.status // 400:
+            logger.warning(f"No such file: {filename}, status: {response.status}")
+
+        elif response.status == 206 or not resume_mode:
+            if resume_mode:
+                filehash = await asyncio.to_thread(
+                    restore_partial_hash, machine, downloading_path,
+                    resume_byte_pos, hash_name)
+            else:
+                filehash = hashlib.new(hash_name)
+            if response.content_length is not None:
+                # Место под остаток файла выделяется до записи, размер файла
+                # остается равным скачанному - по нему докачка после сбоя
+                await machine.storage.reserve_download(
+                    machine, downloading_path, resume_byte_pos, response.content_length,
+                    keep_size=True)
+            elif not resume_mode:
+                await machine.fs.call('create', create_empty, downloading_path)
+            written = resume_byte_pos
+            try:
+                async with aiofiles.open(downloading_path, 'r+b') as file:
+                    await file.seek(resume_byte_pos)
                     async for chunk in response.content.iter_chunked(chunk_write_size):
                         await file.write(chunk)
-                logger.info("Download completed")
-            else:
-                logger.error(f"Failed to resume download, {filename}")
-
-    file_handling_event.set()
+                        filehash.update(chunk)
+                        written += len(chunk)
+                        if verifier is not None:
+                            verifier.feed(chunk)
+            except BaseException:
+                # Сохраняем состояние хэша для докачки, а размер файла
+                # возвращаем к скачанному - по нему считается позиция докачки
+                machine.partial_hashes[downloading_path] = (written, filehash)
+                # shield: при повторной отмене усечение все равно завершится
+                await asyncio.shield(machine.fs.call('truncate', os.truncate,
+                                                     downloading_path, written))
+                raise
+            logger.info("Download completed")
+            result = (True, filename, filehash.hexdigest())
+        else:
+            logger.error(f"Failed to resume download, {filename}")
+    return result
 
 
-async def request_tasks(url, *, headers=None, params=None) -> dict | str:
+async def request_tasks(url, *, headers=None, params=None,
+                        version: str | None = None,
+                        client: HttpClient | None = None) -> dict | str:
+    '''Запрос заданий. version - ETag уже примененного расписания: сервер
+    ответит 304 (вернется {'not_modified': True}) или только разницей
+    (ключ 'delta'). ETag ответа возвращается в ключе 'version' '''
 
     _headers = {'Content-Type': 'application/json'}
+    if version:
+        _headers.update({'If-None-Match': version, 'A-IM': 'delta'})
     if headers:
         _headers.update(headers)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url,
-                               headers=_headers,
-                               params=params,
-                               allow_redirects=True) as response:
+    client = client or default_client
+    async with client.session.get(url,
+                                  headers=_headers,
+                                  params=params,
+                                  allow_redirects=True) as response:
 
-            if response.status in (200, 201):
-                tasks = json.loads(await response.json())
-                return tasks.get('json', tasks)
+        if response.status == 304:
+            return {'not_modified': True, 'version': version}
+
+        if response.status in (200, 201, 226):
+            tasks = await response.json()
+            if isinstance(tasks, str):
+                # Старый сервер отдает json строкой внутри json
+                tasks = json.loads(tasks)
+            tasks = tasks.get('json', tasks)
+            if isinstance(tasks, dict):
+                tasks['version'] = response.headers.get('ETag')
+            return tasks
 
     return f'Response status error: {response.status}'
 
 
-async def send_response(data=None, *,  url=None, headers=None, params=None):
+async def send_response(data=None, *,  url=None, headers=None, params=None,
+                        client: HttpClient | None = None):
 
 
 
@@ -77,18 +245,17 @@ async def send_response(data=None, *,  url=None, headers=None, params=None):
     if headers:
         _headers.update(headers)
 
-    async with aiohttp.ClientSession() as session:
-
-        async with session.post(url,
-                                json=data,
-                                headers=_headers,
-                                params=params,
-                                allow_redirects=True) as response:
+    client = client or default_client
+    async with client.session.post(url,
+                                   json=data,
+                                   headers=_headers,
+                                   params=params,
+                                   allow_redirects=True) as response:
 
-            logger.info(f"{response.url=}, {await response.text()}")
-            logger.info(f"{data=}")
-            #if response.status in (200, 201):
-            ##    tasks = await response.json()
-            #    return tasks.get('json', tasks)
+        logger.info(f"{response.url=}, {await response.text()}")
+        logger.info(f"{data=}")
+        #if response.status in (200, 201):
+        ##    tasks = await response.json()
+        #    return tasks.get('json', tasks)
 
     return f'Response status error: {response.status}'
@@ -0,0 +1,66 @@
+import aiohttp
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    '''Долгоживущий HTTP клиент устройства. Одна сессия aiohttp с пулом
+    соединений, keep-alive и кэшем DNS на весь обмен с сервером.
+    Сессия создается лениво внутри работающего цикла событий'''
+
+    def __init__(self,
+                 limit: int = 32,
+                 limit_per_host: int = 8,
+                 keepalive_timeout: float = 60,
+                 ttl_dns_cache: int = 300,
+                 connect_timeout: float = 10,
+                 sock_read_timeout: float = 60,
+                 total_timeout: float | None = None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout,
+                                             connect=connect_timeout,
+                                             sock_read=sock_read_timeout)
+        self._session: aiohttp.ClientSession | None = None
+
+    @classmethod
+    def from_config(cls, section) -> 'HttpClient':
+        '''Создание клиента из секции [http] конфига (configparser)'''
+
+        if section is None:
+            return cls()
+        total_timeout = section.getfloat('total_timeout', fallback=0)
+        return cls(limit=section.getint('limit', fallback=32),
+                   limit_per_host=section.getint('limit_per_host', fallback=8),
+                   keepalive_timeout=section.getfloat('keepalive_timeout', fallback=60),
+                   ttl_dns_cache=section.getint('ttl_dns_cache', fallback=300),
+                   connect_timeout=section.getfloat('connect_timeout', fallback=10),
+                   sock_read_timeout=section.getfloat('sock_read_timeout', fallback=60),
+                   total_timeout=total_timeout or None)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+                )
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=self.timeout)
+            logger.info(f"Открыта HTTP сессия, {self.limit=}, {self.limit_per_host=}")
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("HTTP сессия закрыта")
+        self._session = None
+
+
+# Клиент по умолчанию для вызовов без машины
+default_client = HttpClient()
@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import aiofiles
+import aiohttp
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkRepairError(Exception):
+    '''Испорченные куски файла не удалось перезагрузить'''
+
+    def __init__(self, path: str, indexes: list[int]):
+        super().__init__(f'{path}: chunks {indexes} not repaired')
+        self.path = path
+        self.indexes = indexes
+
+
+class Manifest:
+    '''Хэши кусков файла фиксированного размера, которые публикует сервер
+    (/files/{md5}/manifest). root - хэш конкатенации хэшей кусков, md5
+    всего файла остается его идентификатором'''
+
+    __slots__ = ('md5hash', 'size', 'chunk_size', 'hash_name', 'chunks')
+
+    def __init__(self, md5hash: str, size: int, chunk_size: int,
+                 hash_name: str, chunks: list[str]):
+        self.md5hash = md5hash
+        self.size = size
+        self.chunk_size = chunk_size
+        self.hash_name = hash_name
+        self.chunks = chunks
+
+    @classmethod
+    def from_dict(cls, data: dict, md5hash: str) -> 'Manifest':
+        manifest = cls(data['md5'], int(data['size']), int(data['chunk_size']),
+                       data['hash'], list(data['chunks']))
+        root = hashlib.new(manifest.hash_name,
+                           b''.join(bytes.fromhex(digest) for digest in manifest.chunks))
+        if (manifest.md5hash != md5hash or root.hexdigest() != data['root']
+                or manifest.chunk_size <= 0
+                or len(manifest.chunks) != -(-manifest.size // manifest.chunk_size)):
+            raise ValueError(f'Inconsistent manifest for {md5hash}')
+        return manifest
+
+    def chunk_range(self, index: int) -> tuple[int, int]:
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size) - 1
+
+    def chunk_ok(self, index: int, data: bytes) -> bool:
+        return hashlib.new(self.hash_name, data).hexdigest() == self.chunks[index]
+
+    def verify_file(self, path: str, indexes) -> list[int]:
+        '''Перечитывает куски indexes с диска, вернет испорченные'''
+
+        bad = []
+        with open(path, 'rb') as file:
+            for index in sorted(indexes):
+                start, end = self.chunk_range(index)
+                file.seek(start)
+                if not self.chunk_ok(index, file.read(end - start + 1)):
+                    bad.append(index)
+        return bad
+
+
+class ChunkVerifier:
+    '''Проверка кусков по мере записи потока, который начинается с offset.
+    Кусок, начатый до offset, не проверяется - его нужно перечитать с диска'''
+
+    def __init__(self, manifest: Manifest, offset: int = 0):
+        self.manifest = manifest
+        self.verified: set[int] = set()
+        self.bad: set[int] = set()
+        self.index = -(-offset // manifest.chunk_size)
+        self._skip = self.index * manifest.chunk_size - offset
+        self._hash = hashlib.new(manifest.hash_name)
+        self._filled = 0
+
+    def feed(self, data: bytes):
+        view = memoryview(data)
+        if self._skip:
+            skipped = min(self._skip, len(view))
+            self._skip -= skipped
+            view = view[skipped:]
+        while view and self.index < len(self.manifest.chunks):
+            start, end = self.manifest.chunk_range(self.index)
+            take = min(end - start + 1 - self._filled, len(view))
+            self._hash.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == end - start + 1:
+                if self._hash.hexdigest() == self.manifest.chunks[self.index]:
+                    self.verified.add(self.index)
+                else:
+                    self.bad.add(self.index)
+                self.index += 1
+                self._hash = hashlib.new(self.manifest.hash_name)
+                self._filled = 0
+
+
+async def fetch_manifest(session: aiohttp.ClientSession, url: str, md5hash: str) -> Manifest | None:
+    '''Манифест файла url или None, если источник его не публикует'''
+
+    try:
+        async with session.get(f'{url}/manifest') as response:
+            if response.status != 200:
+                return None
+            return Manifest.from_dict(await response.json(content_type=None), md5hash)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as exception:
+        logger.info(f"Манифест {url} не получен, {exception=}")
+        return None
+
+
+async def repair(session: aiohttp.ClientSession,
+                 url: str,
+                 path: str,
+                 manifest: Manifest,
+                 bad,
+                 attempts: int = 3) -> bool:
+    '''Перезагружает испорченные куски диапазонами и пишет их на место,
+    только если хэш куска совпал. Вернет False, если кусок так и не
+    получен - тогда файл считается испорченным целиком'''
+
+    async with aiofiles.open(path, 'r+b') as file:
+        for index in sorted(bad):
+            start, end = manifest.chunk_range(index)
+            for attempt in range(1, attempts + 1):
+                try:
+                    async with session.get(url, headers={'Range': f'bytes={start}-{end}'}) as response:
+                        data = await response.read() if response.status == 206 else b''
+                except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+                    logger.info(f"Кусок {index} {url} не получен, {exception=}")
+                    data = b''
+                if len(data) == end - start + 1 and manifest.chunk_ok(index, data):
+                    await file.seek(start)
+                    await file.write(data)
+                    logger.info(f"Кусок {index} ({start}-{end}) {path} перезагружен, попытка {attempt}")
+                    break
+            else:
+                logger.warning(f"Кусок {index} {path} не восстановлен за {attempts} попыток")
+                return False
+    return True
+
+
+async def verify_and_repair(session: aiohttp.ClientSession,
+                            url: str,
+                            path: str,
+                            manifest: Manifest,
+                            verifiers: list[ChunkVerifier]) -> int:
+    '''Куски, не проверенные на лету (докачка с середины куска, загрузка
+    до перезапуска), перечитываются с диска; испорченные перезагружаются.
+    Вернет число восстановленных кусков, ChunkRepairError - если
+    восстановить их не удалось'''
+
+    verified = set().union(*(verifier.verified for verifier in verifiers))
+    bad = set().union(*(verifier.bad for verifier in verifiers))
+    unchecked = set(range(len(manifest.chunks))) - verified - bad
+    if unchecked:
+        bad.update(await asyncio.to_thread(manifest.verify_file, path, unchecked))
+    if not bad:
+        return 0
+    logger.warning(f"{path}: испорчено кусков {len(bad)} из {len(manifest.chunks)}, перезагружаю")
+    if not await repair(session, url, path, manifest, bad):
+        raise ChunkRepairError(path, sorted(bad))
+    return len(bad)
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import re
+from aiohttp import web
+from api_requests.client import HttpClient
+import logging
+
+logger = logging.getLogger(__name__)
+
+MD5_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class PeerDirectory:
+    '''Локальный кеш соседних устройств площадки. Каждое устройство
+    отдает проверенные объекты хранилища по HTTP (/blobs/{md5}) и список
+    своих md5 (/blobs). Списки соседей опрашиваются раз в refresh_interval;
+    файл сначала ищется у соседей, затем у сервера, хэш проверяется всегда'''
+
+    def __init__(self, peers: list[str] | None = None, refresh_interval: float = 60):
+        self.peers = [peer.rstrip('/') for peer in peers or []]
+        self.refresh_interval = refresh_interval
+        self.index: dict[str, set[str]] = {}  # {md5: {peer}}
+        self.peer_hits = 0
+        self.peer_failures = 0
+        self.origin_fetches = 0
+        self.bytes_from_peers = 0
+        self.bytes_served = 0
+
+    def sources(self, md5hash: str) -> list[str]:
+        return [f'{peer}/blobs/{md5hash}' for peer in self.index.get(md5hash, ())]
+
+    def forget(self, url: str):
+        # Сосед не отдал файл - до следующего опроса к нему не обращаемся
+        peer, _, md5hash = url.rpartition('/blobs/')
+        self.index.get(md5hash, set()).discard(peer)
+
+    async def refresh(self, client: HttpClient):
+        index: dict[str, set[str]] = {}
+
+        async def fetch(peer: str):
+            try:
+                async with client.session.get(f'{peer}/blobs') as response:
+                    if response.status == 200:
+                        for md5hash in await response.json():
+                            index.setdefault(md5hash, set()).add(peer)
+            except Exception as exception:
+                logger.info(f"Сосед {peer} недоступен, {exception=}")
+
+        await asyncio.gather(*(fetch(peer) for peer in self.peers))
+        self.index = index
+
+    async def refresh_loop(self, client: HttpClient):
+        while True:
+            await self.refresh(client)
+            await asyncio.sleep(self.refresh_interval)
+
+    def app(self, store) -> web.Application:
+        '''Приложение раздачи объектов store (MediaStore) соседям'''
+
+        async def blobs(request: web.Request):
+            names = await store.fs.call('listdir', os.listdir, store.objects_dir)
+            return web.json_response([name for name in names if MD5_RE.match(name)])
+
+        async def blob(request: web.Request):
+            md5hash = request.match_info['md5hash']
+            if not MD5_RE.match(md5hash):
+                raise web.HTTPNotFound()
+            try:
+                size = (await store.fs.stat(store.blob_path(md5hash))).st_size
+            except FileNotFoundError:
+                raise web.HTTPNotFound() from None
+            # FileResponse сам обрабатывает Range и отдает через sendfile
+            response = web.FileResponse(store.blob_path(md5hash),
+                                        headers={'ETag': f'"{md5hash}"'})
+            if request.method == 'GET':
+                self.bytes_served += size
+            return response
+
+        app = web.Application()
+        app.router.add_get('/blobs', blobs)
+        app.router.add_get('/blobs/{md5hash}', blob)
+        return app
+
+    async def serve(self, store, host: str = '0.0.0.0', port: int = 8090):
+        runner = web.AppRunner(self.app(store))
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Раздача объектов соседям на {host}:{port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    def stats(self) -> dict:
+        return {'peers': len(self.peers), 'indexed': len(self.index),
+                'peer_hits': self.peer_hits, 'peer_failures': self.peer_failures,
+                'origin_fetches': self.origin_fetches,
+                'bytes_from_peers': self.bytes_from_peers,
+                'bytes_served': self.bytes_served}
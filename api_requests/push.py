@@ -0,0 +1,60 @@
+import asyncio
+import random
+from typing import Awaitable, Callable
+import aiohttp
+from models.machine import MediaMachine
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def push_listener(machine: MediaMachine,
+                        url: str,
+                        handler: Callable[[MediaMachine, dict], Awaitable],
+                        min_backoff: float = 1,
+                        max_backoff: float = 300,
+                        heartbeat: float = 30):
+    '''Держит WebSocket канал с сервером. События с заданиями передаются
+    в handler (как ответ на опрос), {'event': 'poll'} будит опрос.
+    Пока канал поднят, machine.push_connected установлен и опрос идет
+    редко; при обрыве - переподключение с растущей задержкой и джиттером'''
+
+    backoff = min_backoff
+    # Обработка идет отдельными задачами, чтобы чтение канала (и ответы
+    # на heartbeat) не ждали долгих загрузок
+    handling: set[asyncio.Task] = set()
+    while True:
+        was_connected = False
+        try:
+            async with machine.http.session.ws_connect(url, heartbeat=heartbeat) as websocket:
+                logger.info(f"Push канал открыт: {url}")
+                machine.push_connected.set()
+                was_connected = True
+                backoff = min_backoff
+                async for message in websocket:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        if message.type == aiohttp.WSMsgType.ERROR:
+                            break
+                        continue
+                    event = message.json()
+                    logger.info(f"Push событие: {event}")
+                    if event.get('event') == 'poll':
+                        machine.poll_now.set()
+                    else:
+                        task = asyncio.create_task(handler(machine, event))
+                        handling.add(task)
+                        task.add_done_callback(handling.discard)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exception:
+            logger.warning(f"Push канал недоступен, {exception=}")
+        finally:
+            machine.push_connected.clear()
+
+        # После обрыва сразу сверяемся опросом, затем ждем переподключения
+        if was_connected:
+            machine.poll_now.set()
+        delay = backoff * random.uniform(0.5, 1.5)
+        logger.info(f"Переподключение push через {delay:.1f} c")
+        await asyncio.sleep(delay)
+        backoff = min(backoff * 2, max_backoff)
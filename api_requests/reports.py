@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import random
+from collections import deque
+from api_requests.client import HttpClient
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ошибки клиента, после которых пачку стоит послать повторно
+RETRY_STATUSES = (408, 425, 429)
+
+
+class ReportQueue:
+    '''Очередь отчетов серверу вне цикла планировщика.
+    Отчеты копятся в памяти и уходят пачками одним POST на
+    /device/{sn}/reports. При недоступности сервера - повтор с растущей
+    задержкой и джиттером, очередь сбрасывается на диск (spool_path,
+    json по строке на отчет) и дочитывается при следующем запуске.
+    Пачка, отвергнутая сервером (4xx), не повторяется, а отбрасывается.
+    Размер очереди ограничен max_size, лишние старые отчеты отбрасываются'''
+
+    def __init__(self,
+                 spool_path: str,
+                 batch_size: int = 100,
+                 flush_interval: float = 2.0,
+                 max_size: int = 10000,
+                 min_backoff: float = 1,
+                 max_backoff: float = 300):
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.queue: deque[dict] = deque()
+        self.sent = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failures = 0
+        self.online = True
+        self._ready = asyncio.Event()
+        self._spooled = False
+        self._load_spool()
+
+    def _load_spool(self):
+        try:
+            with open(self.spool_path, encoding='utf-8') as spool:
+                for line in spool:
+                    try:
+                        self._append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+            self._spooled = True
+            logger.info(f"Из очереди на диске поднято отчетов: {len(self.queue)}")
+        except FileNotFoundError:
+            pass
+
+    def _append(self, report: dict):
+        if len(self.queue) >= self.max_size:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(report)
+
+    def put(self, kind: str, data: dict):
+        '''Ставит отчет в очередь, не дожидаясь отправки.
+        kind - 'schedule', 'current' или 'startup' '''
+
+        self._append({'kind': kind, 'data': data})
+        self._ready.set()
+
+    def _spill(self, reports: list[dict]):
+        tmp_path = f'{self.spool_path}.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as spool:
+            for report in reports:
+                spool.write(json.dumps(report, ensure_ascii=False))
+                spool.write('\n')
+        os.replace(tmp_path, self.spool_path)
+        self._spooled = True
+
+    def _clear_spool(self):
+        if os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+        self._spooled = False
+
+    async def _send(self, client: HttpClient, url: str, batch: list[dict]) -> bool:
+        # True - пачка снята с очереди: принята или отвергнута сервером
+        try:
+            async with client.session.post(url, json={'reports': batch}) as response:
+                if response.status // 100 == 2:
+                    try:
+                        answer = await response.json(content_type=None)
+                    except ValueError:
+                        answer = None
+                    rejected = (answer.get('rejected') or []) if isinstance(answer, dict) else []
+                    if rejected:
+                        self.rejected += len(rejected)
+                        logger.warning(f"Сервер отверг отчетов: {len(rejected)}, {rejected[:3]}")
+                    return True
+                if response.status // 100 == 4 and response.status not in RETRY_STATUSES:
+                    # Повтор той же пачки получит тот же ответ - отбрасываем
+                    self.rejected += len(batch)
+                    logger.error(f"Сервер отверг пачку отчетов ({len(batch)}): "
+                                 f"{response.status} {(await response.text())[:200]}")
+                    return True
+                logger.warning(f"Сервер не принял отчеты: {response.status}")
+        except Exception as exception:
+            logger.warning(f"Отчеты не отправлены, {exception=}")
+        return False
+
+    async def run(self, client: HttpClient, url: str):
+        backoff = self.min_backoff
+        while True:
+            if not self.queue:
+                self._ready.clear()
+                await self._ready.wait()
+            # Даем накопиться пачке
+            await asyncio.sleep(self.flush_interval)
+
+            while self.queue:
+                batch = [self.queue[index]
+                         for index in range(min(self.batch_size, len(self.queue)))]
+                dropped_before = self.dropped
+                if not await self._send(client, url, batch):
+                    break
+                # Пока шла отправка, переполнение могло вытеснить часть пачки
+                for _ in range(max(0, len(batch) - (self.dropped - dropped_before))):
+                    self.queue.popleft()
+                self.sent += len(batch)
+                if not self.online:
+                    logger.info("Связь с сервером восстановлена, досылаю очередь")
+                self.online = True
+                backoff = self.min_backoff
+
+            if self.queue:
+                self.online = False
+                self.failures += 1
+                await asyncio.to_thread(self._spill, list(self.queue))
+                delay = backoff * random.uniform(0.5, 1.5)
+                logger.info(f"Отчетов в очереди: {len(self.queue)}, повтор через {delay:.1f} c")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+            elif self._spooled:
+                await asyncio.to_thread(self._clear_spool)
+
+    def stats(self) -> dict:
+        return {'queued': len(self.queue), 'sent': self.sent,
+                'dropped': self.dropped, 'rejected': self.rejected,
+                'failures': self.failures,
+                'online': self.online}
@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Awaitable, Callable
+import aiofiles
+import aiohttp
+from api_requests.manifest import Manifest, ChunkVerifier, verify_and_repair
+from system_works.async_fs import AsyncFS, remove_existing
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RangeNotSupported(Exception):
+    '''Сервер не отдает запрошенные диапазоны байт'''
+
+
+def state_path(downloading_path: str) -> str:
+    return f'{downloading_path}.segments'
+
+
+def load_state(path: str) -> dict | None:
+    try:
+        with open(path, encoding='utf-8') as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return None
+    except Exception as exception:
+        logger.warning(f"Состояние сегментов {path} не прочитано, {exception=}")
+        return None
+
+
+def save_state(path: str, state: dict):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, mode='w', encoding='utf-8') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, path)
+
+
+def resume_state(path: str) -> dict | None:
+    # Состояние сегментов, если и оно, и сам файл загрузки на месте
+    state = load_state(state_path(path))
+    return state if state is not None and os.path.exists(path) else None
+
+
+def keep_state(path: str, state: dict):
+    # Прогресс сохраняется, только пока загрузка не завершена и не отменена
+    if os.path.exists(path):
+        save_state(path, state)
+
+
+def plan_segments(size: int, segments: int, min_segment_size: int,
+                  align: int = 1) -> list[list[int]]:
+    '''Делит файл на диапазоны [start, end, скачано байт]. Границы
+    диапазонов кратны align (размеру куска манифеста)'''
+
+    count = max(1, min(segments, size // max(min_segment_size, 1)))
+    step = -(-size // count)
+    step = -(-step // align) * align
+    return [[start, min(start + step, size) - 1, 0]
+            for start in range(0, size, step)]
+
+
+def preallocate(path: str, size: int):
+    with open(path, 'wb') as file:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(file.fileno(), 0, size)
+        else:
+            file.truncate(size)
+
+
+def hash_file(path: str, hash_name: str = 'md5', chunk_size: int = 1024*1024) -> str:
+    filehash = hashlib.new(hash_name)
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            filehash.update(chunk)
+    return filehash.hexdigest()
+
+
+async def probe(session: aiohttp.ClientSession, url: str) -> int | None:
+    '''Размер файла, если сервер поддерживает диапазоны, иначе None'''
+
+    try:
+        async with session.head(url, allow_redirects=True) as response:
+            if (response.status != 200
+                    or response.headers.get('Accept-Ranges', '').lower() != 'bytes'
+                    or response.headers.get('Content-Length') is None):
+                return None
+            return int(response.headers['Content-Length'])
+    except aiohttp.ClientError as exception:
+        logger.info(f"HEAD {url} не удался, {exception=}")
+        return None
+
+
+async def fetch_segment(session: aiohttp.ClientSession,
+                        url: str,
+                        path: str,
+                        segment: list[int],
+                        chunk_size: int,
+                        verifier: ChunkVerifier | None = None):
+    start, end, done = segment
+    if start + done > end:
+        return
+
+    async with session.get(url,
+                           headers={'Range': f'bytes={start + done}-{end}'}
+                           ) as response:
+        content_range = response.headers.get('Content-Range', '')
+        if (response.status != 206
+                or not content_range.startswith(f'bytes {start + done}-')):
+            raise RangeNotSupported(f'{url}: {response.status} {content_range}')
+
+        async with aiofiles.open(path, 'r+b') as file:
+            await file.seek(start + done)
+            async for chunk in response.content.iter_chunked(chunk_size):
+                await file.write(chunk)
+                segment[2] += len(chunk)
+                if verifier is not None:
+                    verifier.feed(chunk)
+
+
+async def download(session: aiohttp.ClientSession,
+                   url: str,
+                   path: str,
+                   segments: int,
+                   min_segment_size: int,
+                   chunk_size: int = 64*1024,
+                   hash_name: str = 'md5',
+                   persist_interval: float = 1.0,
+                   reserve: Callable[[str, int, int], Awaitable] | None = None,
+                   hasher: Callable[[str, str], Awaitable[str]] | None = None,
+                   manifest: Manifest | None = None,
+                   fs: AsyncFS | None = None) -> str | None:
+    '''Загрузка файла параллельными диапазонами в заранее выделенный файл.
+    Прогресс каждого диапазона сохраняется в {path}.segments, поэтому после
+    перезапуска каждый диапазон докачивается с места остановки.
+    reserve(path, offset, length) - проверка места и выделение файла
+    вместо простого preallocate, hasher(path, hash_name) - подсчет хэша
+    готового файла (по умолчанию hash_file в потоке). С манифестом
+    куски проверяются по мере записи, а испорченные перезагружаются
+    до подсчета хэша всего файла. fs - пул файловых операций
+    (machine.fs), без него они идут в общий to_thread.
+    Вернет хэш файла или None, если сервер не поддерживает диапазоны
+    и нужно качать одним потоком'''
+
+    async def fs_call(op: str, func: Callable, *args):
+        if fs is not None:
+            return await fs.call(op, func, *args)
+        return await asyncio.to_thread(func, *args)
+
+    spath = state_path(path)
+    state = await fs_call('segments_state', resume_state, path)
+    if state is None:
+        size = await probe(session, url)
+        if size is None or size < 2 * min_segment_size:
+            return None
+        state = {'size': size,
+                 'segments': plan_segments(size, segments, min_segment_size,
+                                           manifest.chunk_size if manifest else 1)}
+        if reserve is not None:
+            await reserve(path, 0, size)
+        else:
+            await fs_call('preallocate', preallocate, path, size)
+        await fs_call('segments_state', save_state, spath, state)
+        logger.info(f"Сегментная загрузка {path}: {len(state['segments'])} диапазонов, {size} байт")
+    else:
+        logger.info(f"Докачка сегментов {path}: {state['segments']}")
+
+    async def persist():
+        while True:
+            await asyncio.sleep(persist_interval)
+            await fs_call('segments_state', save_state, spath, state)
+
+    persist_task = asyncio.create_task(persist())
+    verifiers = [ChunkVerifier(manifest, segment[0] + segment[2]) if manifest else None
+                 for segment in state['segments']]
+    tasks = [asyncio.create_task(fetch_segment(session, url, path, segment, chunk_size, verifier))
+             for segment, verifier in zip(state['segments'], verifiers)]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            task.result()
+    except RangeNotSupported as exception:
+        logger.warning(f"Диапазоны не поддерживаются, качаю одним потоком: {exception}")
+        persist_task.cancel()
+        await asyncio.gather(persist_task, return_exceptions=True)
+        await fs_call('remove', remove_existing, [path, spath])
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        persist_task.cancel()
+        await fs_call('segments_state', keep_state, spath, state)
+
+    await fs_call('remove', remove_existing, [spath])
+    if manifest is not None:
+        # Невосстановленные куски - ChunkRepairError, файл до сверки хэша не доходит
+        await verify_and_repair(session, url, path, manifest,
+                                [verifier for verifier in verifiers if verifier])
+    if hasher is not None:
+        return await hasher(path, hash_name)
+    return await asyncio.to_thread(hash_file, path, hash_name)
@@ -0,0 +1,88 @@
+'''Сравнение запросов в секунду: новая сессия aiohttp на каждый запрос
+(как было) против общего пула HttpClient. Сервер - локальная заглушка.
+
+    python -m benchmarks.bench_http_client --requests 2000 --concurrency 16
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+from time import perf_counter
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.abspath(f'{os.path.dirname(__file__)}/..'))
+
+from api_requests import api_requests  # noqa: E402
+from api_requests.client import HttpClient  # noqa: E402
+
+SCHEDULE = json.dumps(json.dumps({'schedule': [], 'current': [], 'delete': []}))
+
+
+async def start_stub_server(host='127.0.0.1', port=0):
+    async def device(request):
+        return web.Response(text=SCHEDULE, content_type='application/json')
+
+    async def report(request):
+        await request.read()
+        return web.Response(text='Thanks')
+
+    app = web.Application()
+    app.router.add_get('/device/{sn}', device)
+    app.router.add_post('/device/{sn}/schedule', report)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://{host}:{port}'
+
+
+async def session_per_request(url):
+    # Прежний вариант: рукопожатие на каждый запрос
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            await response.read()
+
+
+async def run(label, request, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await request()
+
+    started = perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = perf_counter() - started
+    return {'case': label, 'requests': total, 'seconds': round(elapsed, 3),
+            'rps': round(total / elapsed, 1)}
+
+
+async def main(total, concurrency):
+    runner, srv_url = await start_stub_server()
+    client = HttpClient()
+    url = f'{srv_url}/device/bench'
+    try:
+        results = [
+            await run('session_per_request',
+                      lambda: session_per_request(url), total, concurrency),
+            await run('shared_client',
+                      lambda: api_requests.request_tasks(url, client=client),
+                      total, concurrency),
+            ]
+    finally:
+        await client.close()
+        await runner.cleanup()
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
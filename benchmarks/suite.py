@@ -0,0 +1,499 @@
+'''Набор замеров горячих путей устройства и сервера. Все запускается
+локально: сервер-заглушка на aiohttp (или шаблон FastAPI под uvicorn
+для замера ручек), синтетические медиафайлы, поддельные systemctl и sudo
+в PATH. Результат пишется в JSON для сравнения между запусками.
+
+    python -m benchmarks.suite --sizes 1,16,64 --schedule-size 5000 --output bench.json
+    python -m benchmarks.suite --only get_md5,save_json --compare bench.json
+'''
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter, time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.abspath(f'{os.path.dirname(__file__)}/..')
+TEMPLATES = os.path.join(ROOT, 'myFastapi_templates')
+sys.path.insert(0, ROOT)
+
+from api_requests import api_requests  # noqa: E402
+from models.machine import MediaMachine  # noqa: E402
+from system_works import files  # noqa: E402
+from scheduler import scheduler  # noqa: E402
+import main as device_main  # noqa: E402
+
+MB = 1024 * 1024
+DATE_FORMAT = '%d.%m.%Y %H:%M:%S'
+
+
+def install_fake_platform(root: str):
+    '''systemctl и sudo ничего не делают'''
+
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    scripts = {
+        'systemctl': '#!/bin/sh\nexit 0\n',
+        'sudo': '#!/bin/sh\nexec "$@"\n',
+        }
+    for name, body in scripts.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as script:
+            script.write(body)
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = f'{bin_dir}{os.pathsep}{os.environ["PATH"]}'
+
+
+def make_media(directory: str, size: int, seed: int, name: str | None = None) -> tuple[str, str]:
+    '''Воспроизводимый файл из псевдослучайных байт. Вернет (путь, md5)'''
+
+    rng = random.Random(seed)
+    filehash = hashlib.md5()
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f'.media_{seed}')
+    with open(tmp_path, 'wb') as media:
+        remaining = size
+        while remaining:
+            chunk = rng.randbytes(min(remaining, 4 * MB))
+            media.write(chunk)
+            filehash.update(chunk)
+            remaining -= len(chunk)
+    md5hash = filehash.hexdigest()
+    path = os.path.join(directory, name or f'{md5hash}.mp4')
+    os.replace(tmp_path, path)
+    return path, md5hash
+
+
+def make_schedule(size: int, displays: list[str], media: list[tuple[str, str]],
+                  srv_url: str, start: float) -> dict:
+    schedule = []
+    for index in range(size):
+        _, md5hash = media[index % len(media)]
+        schedule.append({
+            'display': displays[index % len(displays)],
+            'from_date': datetime.fromtimestamp(start + index * 60).strftime(DATE_FORMAT),
+            'filename': f'{md5hash}.mp4',
+            'md5hash': md5hash,
+            'url': f'{srv_url}/files/{md5hash}',
+            })
+    return {'schedule': schedule, 'current': [], 'delete': []}
+
+
+def new_machine(working_dir: str, displays: list[str] = ()) -> MediaMachine:
+    machine = MediaMachine(working_dir=working_dir, from_date_format=DATE_FORMAT)
+    machine.info['serial'] = 'bench'
+    # Дисплеи читаются из /sys/class/drm, на стенде их задаем сами
+    machine.info['displays'] = list(displays)
+    machine.service_name = 'bench-player'
+    return machine
+
+
+class StubServer:
+    '''Заглушка сервера: расписание с ETag, файлы с Range, прием отчетов'''
+
+    def __init__(self, media_dir: str):
+        self.media_dir = media_dir
+        self.payload = b'{}'
+        self.etag = '""'
+        self.runner = None
+        self.url = None
+
+    def set_schedule(self, data: dict):
+        self.payload = json.dumps(data).encode()
+        self.etag = f'"{hashlib.md5(self.payload).hexdigest()}"'
+
+    async def start(self, host: str = '127.0.0.1'):
+        async def device(request: web.Request):
+            if request.headers.get('If-None-Match') == self.etag:
+                return web.Response(status=304, headers={'ETag': self.etag})
+            return web.Response(body=self.payload, content_type='application/json',
+                                headers={'ETag': self.etag})
+
+        async def file(request: web.Request):
+            path = os.path.join(self.media_dir, f"{request.match_info['md5hash']}.mp4")
+            if not os.path.exists(path):
+                raise web.HTTPNotFound()
+            return web.FileResponse(path)
+
+        async def reports(request: web.Request):
+            await request.read()
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_get('/device/{sn}', device)
+        app.router.add_get('/files/{md5hash}', file)
+        app.router.add_post('/device/{sn}/reports', reports)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, 0)
+        await site.start()
+        self.url = f'http://{host}:{site._server.sockets[0].getsockname()[1]}'
+
+    async def close(self):
+        await self.runner.cleanup()
+
+
+async def bench_get_file(ctx) -> list[dict]:
+    results = []
+    machine = new_machine(os.path.join(ctx.workspace, 'get_file'))
+    for segments in (1, 4):
+        machine.downloads.segments = segments
+        machine.downloads.min_segment_size = 4 * MB
+        for size, (path, md5hash) in zip(ctx.sizes, ctx.media):
+            filename = f'bench_{md5hash}.mp4'
+            started = perf_counter()
+            result = await api_requests.get_file(machine, f'{ctx.server.url}/files/{md5hash}',
+                                                 filename, md5hash=md5hash)
+            elapsed = perf_counter() - started
+            assert result and result[0], result
+            os.remove(os.path.join(machine.downloading_dir, filename))
+            results.append({'bench': 'get_file', 'case': f'{size // MB}MB_segments{segments}',
+                            'seconds': round(elapsed, 4), 'mb_per_s': round(size / MB / elapsed, 1)})
+    await machine.http.close()
+    return results
+
+
+async def bench_get_md5(ctx) -> list[dict]:
+    results = []
+    machine = new_machine(os.path.join(ctx.workspace, 'get_md5'))
+    for size, (path, md5hash) in zip(ctx.sizes, ctx.media):
+        started = perf_counter()
+        result = await files.get_md5(machine, os.path.basename(path), dir_path=ctx.media_dir)
+        elapsed = perf_counter() - started
+        assert result[2] == md5hash
+        results.append({'bench': 'get_md5', 'case': f'{size // MB}MB',
+                        'seconds': round(elapsed, 4), 'mb_per_s': round(size / MB / elapsed, 1)})
+    await machine.http.close()
+    return results
+
+
+async def bench_startup_scan(ctx) -> list[dict]:
+    working_dir = os.path.join(ctx.workspace, 'scan')
+    for index in range(ctx.scan_files):
+        make_media(working_dir, ctx.scan_file_size, seed=10_000 + index, name=f'scan_{index}.mp4')
+
+    results = []
+    for case in ('cold', 'warm'):
+        if case == 'cold':
+            for stale in ('hash_cache.json', 'objects'):
+                stale = os.path.join(working_dir, stale)
+                if os.path.isdir(stale):
+                    shutil.rmtree(stale)
+                elif os.path.exists(stale):
+                    os.remove(stale)
+        started = perf_counter()
+        machine = new_machine(working_dir)
+        machine.files = await files.get_files_list_from_dir(machine=machine)
+        elapsed = perf_counter() - started
+        assert len(machine.files) == ctx.scan_files
+        results.append({'bench': 'startup_scan', 'case': case, 'files': ctx.scan_files,
+                        'seconds': round(elapsed, 4)})
+        machine.persistence.request_save()
+        await machine.persistence.flush()
+        await machine.http.close()
+
+    # Быстрый старт: список файлов из db.json, без сверки с диском
+    started = perf_counter()
+    machine = new_machine(working_dir)
+    await machine.store.reindex([(record.filename, record.md5hash) for record in machine.files],
+                                prune=False)
+    elapsed = perf_counter() - started
+    assert len(machine.files) == ctx.scan_files
+    results.append({'bench': 'startup_scan', 'case': 'fast', 'files': ctx.scan_files,
+                    'seconds': round(elapsed, 4)})
+    await machine.http.close()
+    return results
+
+
+async def bench_server_polling(ctx) -> list[dict]:
+    machine = new_machine(os.path.join(ctx.workspace, 'polling'))
+    for _, md5hash in ctx.media:
+        machine.files.add(f'{md5hash}.mp4', md5hash)
+    ctx.server.set_schedule(make_schedule(ctx.schedule_size, ctx.displays, ctx.media,
+                                          ctx.server.url, start=time() + 86400))
+    summary_key = ('poll_cycle_seconds', ())
+    poller = asyncio.create_task(device_main.server_polling(
+        machine, interval=60, url=f'{ctx.server.url}/device/bench'))
+
+    async def cycles(count: int):
+        while machine.metrics.summaries.get(summary_key) is None \
+                or machine.metrics.summaries[summary_key].count < count:
+            await asyncio.sleep(0.001)
+        return machine.metrics.summaries[summary_key].last
+
+    results = []
+    try:
+        full = await cycles(1)
+        results.append({'bench': 'server_polling', 'case': 'full',
+                        'schedule': ctx.schedule_size, 'seconds': round(full, 4)})
+        machine.poll_now.set()
+        not_modified = await cycles(2)
+        results.append({'bench': 'server_polling', 'case': 'not_modified',
+                        'schedule': ctx.schedule_size, 'seconds': round(not_modified, 4)})
+    finally:
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+        await machine.persistence.flush()
+        await machine.http.close()
+    return results
+
+
+async def bench_scheduler(ctx) -> list[dict]:
+    machine = new_machine(os.path.join(ctx.workspace, 'scheduler'), ctx.displays)
+    path, md5hash = ctx.media[0]
+    os.link(path, machine.store.blob_path(md5hash))
+
+    started = perf_counter()
+    past = time() - ctx.schedule_size - 10
+    for index in range(ctx.schedule_size):
+        await scheduler.set_schedule(machine, {
+            'display': ctx.displays[index % len(ctx.displays)],
+            'from_date': datetime.fromtimestamp(past + index).strftime(DATE_FORMAT),
+            'filename': f'{md5hash}.mp4',
+            'md5hash': md5hash,
+            'url': f'{ctx.server.url}/files/{md5hash}',
+            })
+    scheduled = perf_counter() - started
+
+    started = perf_counter()
+    task = asyncio.create_task(scheduler.start_scheduler(machine, interval=1))
+    while len(machine.current) < len(ctx.displays):
+        await asyncio.sleep(0.001)
+    activated = perf_counter() - started
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    lateness = machine.metrics.summaries[('activation_lateness_seconds', ())]
+    await machine.persistence.flush()
+    await machine.http.close()
+    return [{'bench': 'scheduler', 'case': 'set_schedule', 'tasks': ctx.schedule_size,
+             'seconds': round(scheduled, 4)},
+            {'bench': 'scheduler', 'case': 'activate_due', 'displays': len(ctx.displays),
+             'seconds': round(activated, 4), 'activations': lateness.count}]
+
+
+async def bench_save_json(ctx) -> list[dict]:
+    results = []
+    for journal in (False, True):
+        machine = new_machine(os.path.join(ctx.workspace, f'save_json_{journal}'))
+        machine.persistence.journal = journal
+        for entry in make_schedule(ctx.schedule_size, ctx.displays, ctx.media,
+                                   ctx.server.url, start=time() + 86400)['schedule']:
+            await scheduler.set_schedule(machine, entry)
+
+        for case in ('first', 'one_change'):
+            if case == 'one_change':
+                machine.current.set(ctx.displays[0], 'x.mp4', 'x')
+            written = machine.persistence.bytes_written
+            started = perf_counter()
+            await machine.persistence.flush()
+            elapsed = perf_counter() - started
+            results.append({'bench': 'save_json', 'case': f'{case}_journal{int(journal)}',
+                            'schedule': ctx.schedule_size, 'seconds': round(elapsed, 4),
+                            'bytes': machine.persistence.bytes_written - written})
+        await machine.http.close()
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def load(session: aiohttp.ClientSession, request, total: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses: dict[int, int] = {}
+
+    async def one():
+        async with semaphore:
+            status = await request(session)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = perf_counter() - started
+    return {'requests': total, 'seconds': round(elapsed, 3),
+            'rps': round(total / elapsed, 1), 'statuses': statuses}
+
+
+async def bench_server(ctx) -> list[dict]:
+    '''Ручки шаблона FastAPI под uvicorn. Нагрузка идет из того же
+    процесса, поэтому rps - оценка снизу'''
+
+    try:
+        import uvicorn
+    except ImportError:
+        return [{'bench': 'server', 'case': 'skipped', 'reason': 'uvicorn is not installed'}]
+
+    server_root = os.path.join(ctx.workspace, 'server')
+    datafiles = os.path.join(server_root, 'datafiles')
+    os.makedirs(os.path.join(datafiles, 'devices', 'bench'), exist_ok=True)
+    with open(os.path.join(datafiles, 'devices', 'bench', 'schedule.json'), 'w') as schedule:
+        json.dump(make_schedule(ctx.schedule_size, ctx.displays, ctx.media,
+                                'http://localhost', start=time() + 86400), schedule)
+    path, md5hash = ctx.media[-1]
+    os.link(path, os.path.join(datafiles, f'{md5hash}.mp4'))
+
+    # Модули шаблона грузятся из его каталога под своим именем,
+    # чтобы не пересечься с main.py устройства
+    cwd = os.getcwd()
+    os.chdir(server_root)
+    sys.path.append(TEMPLATES)
+    spec = importlib.util.spec_from_file_location('fastapi_template', os.path.join(TEMPLATES, 'main.py'))
+    template = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(template)
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(template.app, host='127.0.0.1', port=port,
+                                           log_level='warning', access_log=False))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    base = f'http://127.0.0.1:{port}'
+
+    async def get_schedule(session):
+        async with session.get(f'{base}/device/bench') as response:
+            await response.read()
+            return response.status
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f'{base}/device/bench') as response:
+            etag = response.headers['ETag']
+
+        async def not_modified(session):
+            async with session.get(f'{base}/device/bench', headers={'If-None-Match': etag}) as response:
+                await response.read()
+                return response.status
+
+        async def file_range(session):
+            async with session.get(f'{base}/files/{md5hash}', headers={'Range': 'bytes=0-1048575'}) as response:
+                await response.read()
+                return response.status
+
+        reports = {'reports': [{'kind': 'schedule', 'data': {
+            **entry, 'state': 'current', 'status': True, 'error': None}}
+            for entry in make_schedule(50, ctx.displays, ctx.media, 'http://localhost',
+                                       start=time())['schedule']]}
+
+        async def post_reports(session):
+            async with session.post(f'{base}/device/bench/reports', json=reports) as response:
+                await response.read()
+                return response.status
+
+        results = []
+        for case, request in (('schedule_200', get_schedule), ('schedule_304', not_modified),
+                              ('files_range_1MB', file_range), ('reports_batch50', post_reports)):
+            total = ctx.requests if case != 'reports_batch50' else max(ctx.requests // 10, 1)
+            results.append({'bench': 'server', 'case': case,
+                            **await load(session, request, total, ctx.concurrency)})
+
+    server.should_exit = True
+    await serving
+    await template.report_store.close()
+    os.chdir(cwd)
+    return results
+
+
+BENCHES = {
+    'get_file': bench_get_file,
+    'get_md5': bench_get_md5,
+    'startup_scan': bench_startup_scan,
+    'server_polling': bench_server_polling,
+    'scheduler': bench_scheduler,
+    'save_json': bench_save_json,
+    'server': bench_server,
+    }
+
+
+class Context:
+    def __init__(self, args, workspace: str):
+        self.workspace = workspace
+        self.sizes = [int(size) * MB for size in args.sizes.split(',')]
+        self.displays = [f'HDMI-A-{index + 1}' for index in range(args.displays)]
+        self.schedule_size = args.schedule_size
+        self.scan_files = args.scan_files
+        self.scan_file_size = args.scan_file_size * MB
+        self.requests = args.requests
+        self.concurrency = args.concurrency
+        self.media_dir = os.path.join(workspace, 'media')
+        self.media: list[tuple[str, str]] = []
+        self.server: StubServer | None = None
+
+
+def compare(previous_path: str, results: list[dict]):
+    '''Изменение времени относительно прошлого прогона, в процентах'''
+
+    with open(previous_path, encoding='utf-8') as previous_file:
+        previous = {(item['bench'], item['case']): item
+                    for item in json.load(previous_file)['results']}
+    for item in results:
+        before = previous.get((item['bench'], item['case']))
+        if before is None or not before.get('seconds') or 'seconds' not in item:
+            continue
+        change = (item['seconds'] - before['seconds']) / before['seconds'] * 100
+        print(f"{item['bench']:>15} {item['case']:<22} {before['seconds']:>9.4f} -> "
+              f"{item['seconds']:>9.4f} c  {change:+.1f}%")
+
+
+async def run(args) -> dict:
+    workspace = tempfile.mkdtemp(prefix='media_bench_')
+    ctx = Context(args, workspace)
+    install_fake_platform(workspace)
+    for index, size in enumerate(ctx.sizes):
+        ctx.media.append(make_media(ctx.media_dir, size, seed=index))
+
+    ctx.server = StubServer(ctx.media_dir)
+    await ctx.server.start()
+    selected = args.only.split(',') if args.only else list(BENCHES)
+    results = []
+    try:
+        for name in selected:
+            logging.getLogger(__name__).warning(f"Замер {name}")
+            results.extend(await BENCHES[name](ctx))
+    finally:
+        await ctx.server.close()
+        if not args.keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    return {'meta': {'timestamp': datetime.now().isoformat(timespec='seconds'),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'args': vars(args)},
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1,16,64', help='размеры файлов, МБ')
+    parser.add_argument('--displays', type=int, default=4)
+    parser.add_argument('--schedule-size', type=int, default=5000)
+    parser.add_argument('--scan-files', type=int, default=50)
+    parser.add_argument('--scan-file-size', type=int, default=1, help='МБ')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--only', help=f'через запятую из: {",".join(BENCHES)}')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='JSON прошлого прогона')
+    parser.add_argument('--keep', action='store_true', help='не удалять рабочий каталог')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = asyncio.run(run(args))
+    with open(args.output, 'w', encoding='utf-8') as output:
+        json.dump(report, output, indent=2, ensure_ascii=False)
+    print(json.dumps(report['results'], indent=2, ensure_ascii=False))
+    if args.compare:
+        compare(args.compare, report['results'])
@@ -1,12 +1,16 @@
 import asyncio
 import json
 import os
-from datetime import datetime
-from time import time
+from time import monotonic, time
 import aiofiles
 from models.machine import MediaMachine, JsonSections
 from models.api_collections import TaskCurrent
+from models.registry import parse_from_date
 from api_requests import api_requests
+from api_requests.client import HttpClient
+from system_works.hash_engine import HashEngine
+from system_works.async_fs import AsyncFS
+from api_requests import push
 from system_works import files
 from scheduler import scheduler
 import configparser
@@ -14,12 +18,122 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Ответы опроса и события push обрабатываются по очереди
+response_lock = asyncio.Lock()
+
+
+async def process_response(machine: MediaMachine, response: dict):
+    '''Обработка заданий сервера: удаление, немедленная постановка,
+    расписание (полное или разница в ключе delta)'''
+
+    async with response_lock:
+        scheduled_tasks = await _process_response(machine, response)
+
+    # Загрузки ждем уже без блокировки: push событие current или delete
+    # не должно стоять в очереди за многогигабайтными загрузками
+    logger.info(f"Очередь загрузок: {machine.downloads.stats()}")
+    try:
+        await asyncio.gather(*scheduled_tasks)
+        await files.save_json(machine)
+    except Exception as exception:
+        logger.exception(f'Глобальная ошибка в main.server_pooling {exception=}')
+
+
+async def _process_response(machine: MediaMachine, response: dict) -> list[asyncio.Task]:
+    # Применяет задания к состоянию машины. Вернет задачи загрузок
+    # расписания, которые ждет вызывающий
+
+    # Проверка данных в списках json ('schedule', 'current', 'delete'):
+    # Запуск задач удаления
+    to_delete_list = response.get('delete')
+    if to_delete_list is not None:
+        delete_tasks = [asyncio.create_task(files.delete_file(
+            machine=machine,
+            filename=task.get('filename'),
+            md5hash=task.get('md5hash')
+            )) for task in to_delete_list]
+
+        await asyncio.gather(*delete_tasks)
+        await files.save_json(machine)
+
+    # Запуск задачи немедленной постановки файла проигрывания
+    make_current_list = response.get(JsonSections.CURRENT.value, ())
+    if make_current_list is not None:
+        current_tasks = [asyncio.create_task(
+            files.set_current(
+                machine=machine,
+                current_task=TaskCurrent(**task)
+                )
+            ) for task in make_current_list]
+
+        await asyncio.gather(*current_tasks)
+        await files.save_json(machine)
+
+    # Запуск задач загрузки, сверки и планировки файла проигрывания
+    scheduled_tasks = []
+    new_schedule = response.get(JsonSections.SCHEDULE.value)
+    if response.get('delta') is not None:
+        # Разница применяется к реестру сразу, дальше - только новые записи
+        new_schedule = scheduler.apply_schedule_delta(machine, response['delta'])
+
+    if new_schedule is not None:
+        for sch_task in new_schedule:
+            sch_task['due'] = parse_from_date(sch_task.get('from_date'),
+                                              machine.from_date_format)
+            if sch_task['due'] is None:
+                logger.warning(f"Не разобрана дата задачи {sch_task=}")
+        new_schedule = [sch_task for sch_task in new_schedule
+                        if sch_task['due'] is not None]
+        new_schedule.sort(key=lambda rec: rec['due'])
+        started = scheduler.started_slots(machine, new_schedule, time())
+
+        for sch_task in new_schedule:
+
+            logger.info(f"Загрузчик качает, {sch_task['filename']=}")
+            # Качаем, сверяем, переносим
+            if ((sch_task.get('filename'),
+                    sch_task.get('md5hash')) not in machine.files
+                    and scheduler.needs_download(machine, sch_task, started)):
+
+                # Загрузка через общую очередь, хэш считается при загрузке,
+                # перенос - по ее завершению
+                scheduled_tasks.append(asyncio.create_task(files.fetch_file(
+                                    machine=machine,
+                                    url=sch_task.get('url'),
+                                    filename=sch_task['filename'],
+                                    md5hash=sch_task['md5hash'],
+                                    due=sch_task['due'])
+                                    ))
+
+            # Сверяем наличие полученно задачи во внутреннем планировщике
+            # и обновляем ее
+            await scheduler.set_schedule(machine, sch_task)
+    return scheduled_tasks
+
+
+async def wait_next_poll(machine: MediaMachine, delay: float):
+    '''Сон до следующего опроса, прерывается событием poll_now'''
+
+    try:
+        await asyncio.wait_for(machine.poll_now.wait(), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+    machine.poll_now.clear()
+
+
 async def server_polling(machine: MediaMachine,
                          interval=30,
-                         url=None):
+                         url=None,
+                         push_interval=None,
+                         max_backoff=30):
+    '''Опрос сервера каждые interval минут. Пока поднят push канал -
+    раз в push_interval минут для сверки. Если сервер недоступен,
+    интервал растет вдвое до max_backoff минут'''
 
+    failures = 0
     while True:
         logger.info("Новый цикл Загрузчика")
+        cycle_started = monotonic()
         # Процедура запроса заднных к серверу
         # Запрос данных серверу:
         if url and 'json' in url:
@@ -31,91 +145,38 @@ async def server_polling(machine: MediaMachine,
                     JsonSections.SCHEDULE.value)
         else:
             url = url if url else f"{machine.srv_url}/device/{machine.info.get('serial')}"
-            response = await api_requests.request_tasks(url=url)
+            try:
+                response = await api_requests.request_tasks(url=url,
+                                                            version=machine.schedule_version,
+                                                            client=machine.http)
+            except Exception as exception:
+                response = f'{type(exception).__name__}: {exception}'
 
         if not isinstance(response, dict):
             logger.warning(f"RESPONSE=, {response}")
             response = {}
+            failures += 1
+        else:
+            failures = 0
 
-        # Проверка данных в списках json ('schedule', 'current', 'delete'):
-        # Запуск задач удаления
-        to_delete_list = response.get('delete')
-        if to_delete_list is not None:
-            delete_tasks = [asyncio.create_task(files.delete_file(
-                machine=machine,
-                filename=task.get('filename'),
-                md5hash=task.get('md5hash')
-                )) for task in to_delete_list]
-
-            await asyncio.gather(*delete_tasks)
-            await files.save_json(machine)
-
-        # Запуск задачи немедленной постановки файла проигрывания
-        make_current_list = response.get(JsonSections.CURRENT.value, ())
-        if make_current_list is not None:
-            current_tasks = [asyncio.create_task(
-                files.set_current(
-                    machine=machine,
-                    current_task=TaskCurrent(**task)
-                    )
-                ) for task in make_current_list]
-
-            await asyncio.gather(*current_tasks)
-            await files.save_json(machine)
-
-        # Запуск задач загрузки, сверки и планировки файла проигрывания
-        scheduled_tasks = []
-        new_schedule = response.get(JsonSections.SCHEDULE.value)
-
-        if new_schedule is not None:
-            new_schedule.sort(key=lambda rec: datetime.strptime(
-                            rec.get('from_date'),
-                            machine.from_date_format
-                            ))
-
-            for sch_task in new_schedule:
-
-                logger.info(f"Загрузчик качает, {sch_task['filename']=}")
-                # Качаем, сверяем, переносим
-                if {
-                        'filename': sch_task.get('filename'),
-                        'md5hash': sch_task.get('md5hash')
-                        } not in machine.files:
-
-                    get_file_task = asyncio.create_task(api_requests.get_file(
-                                        machine=machine,
-                                        url=sch_task.get('url'),
-                                        filename=sch_task['filename'])
-                                        )
-
-                    check_hash_task = asyncio.create_task(files.get_md5(
-                                        machine=machine,
-                                        filename=sch_task['filename'],
-                                        md5hash=sch_task['md5hash'])
-                                        )
-
-                    check_hash_task.add_done_callback(
-                        lambda task: files.move_to_working_dir(
-                            task, machine
-                            ))
-
-                    scheduled_tasks.extend([get_file_task, check_hash_task])
-
-                # Сверяем наличие полученно задачи во внутреннем планировщике
-                # и обновляем ее
-                await scheduler.set_schedule(machine, sch_task)
-        try:
-            await asyncio.gather(*scheduled_tasks)
-            await files.save_json(machine)
-        except Exception as exception:
-            logger.exception(f'Глобальная ошибка в main.server_pooling {exception=}')
-        await asyncio.sleep(interval*60)
-
-
-async def timer():
-    while True:
-        print(datetime.now().strftime("%H:%M:%S"))
-        await asyncio.sleep(1)
+        if response.get('not_modified'):
+            logger.info("Задания не менялись (304)")
+        else:
+            await process_response(machine, response)
+            # Версию запоминаем только после применения заданий
+            if response.get('version'):
+                machine.schedule_version = response['version']
+                await files.save_json(machine)
+
+        machine.metrics.observe('poll_cycle_seconds', monotonic() - cycle_started)
+        machine.metrics.inc('polls_total', status='error' if failures else 'ok')
+
+        delay = interval
+        if failures:
+            delay = min(interval * 2 ** failures, max(max_backoff, interval))
+        elif push_interval and machine.push_connected.is_set():
+            delay = push_interval
+        await wait_next_poll(machine, delay*60)
 
 
 async def main():
@@ -128,28 +189,108 @@ async def main():
 
     machine = MediaMachine(
         working_dir=config['local']['working_dir'],
-        srv_url=config['server']['url']
+        hasher=HashEngine(
+            workers=config.getint('hashing', 'workers', fallback=0) or None,
+            io_concurrency=config.getint('hashing', 'io_concurrency', fallback=2),
+            buffer_size=config.getint('hashing', 'buffer_mb', fallback=4) * 1024 * 1024,
+            use_mmap=config.getboolean('hashing', 'mmap', fallback=True)),
+        fs=AsyncFS(workers=config.getint('fs', 'workers', fallback=2),
+                   durable=config.getboolean('fs', 'durable', fallback=True)),
+        srv_url=config['server']['url'],
+        http=HttpClient.from_config(config['http'] if config.has_section('http') else None)
         )
 
-    machine.files = await files.get_files_list_from_dir(machine=machine)
+    # Быстрый старт: файлы и ссылки дисплеев из db.json, полная сверка
+    # с диском - в фоне, когда проигрывание уже восстановлено
+    fast_start = config.getboolean('startup', 'fast', fallback=True) and len(machine.files) > 0
+    if fast_start:
+        machine.startup.mode = 'fast'
+        await machine.store.reindex([(record.filename, record.md5hash) for record in machine.files],
+                                    prune=False)
+    else:
+        machine.files = await files.get_files_list_from_dir(machine=machine)
 
     logger.info(f'{machine.__dict__=}')
     # Добавляем фиктивные данные для теста
     machine.info['serial'] = '123test'
     machine.info['displays'].append('7')
     machine.service_name = config['local']['service']
+    machine.downloads.concurrency = config.getint('downloads', 'concurrency', fallback=2)
+    machine.downloads.segments = config.getint('downloads', 'segments', fallback=4)
+    machine.downloads.min_segment_size = config.getint(
+        'downloads', 'min_segment_size_mb', fallback=32) * 1024 * 1024
+    # Ожидание блокировки файла; 0 - без предела
+    machine.locks.timeout = config.getfloat('locks', 'timeout', fallback=0) or None
+    machine.persistence.delay = config.getfloat('persistence', 'delay', fallback=1.0)
+    machine.persistence.journal = config.getboolean('persistence', 'journal', fallback=False)
+    machine.persistence.compact_every = config.getint('persistence', 'compact_every', fallback=200)
+    machine.reports.batch_size = config.getint('reports', 'batch_size', fallback=100)
+    machine.reports.flush_interval = config.getfloat('reports', 'flush_interval', fallback=2.0)
+    machine.reports.max_size = config.getint('reports', 'max_size', fallback=10000)
+    machine.storage.quota = config.getint('storage', 'quota_mb', fallback=0) * 1024 * 1024
+    machine.storage.reserve = config.getint('storage', 'reserve_mb', fallback=100) * 1024 * 1024
+    # Приводим занятое место к квоте еще до первых загрузок
+    await machine.storage.ensure_space(machine)
+    logger.info(f"Хранилище: {await machine.storage.stats(machine)}")
+    machine.prefetch.lead_time = config.getfloat('prefetch', 'lead_time', fallback=30)
+    machine.prefetch.memory_budget = config.getint(
+        'prefetch', 'memory_budget_mb', fallback=256) * 1024 * 1024
+    machine.prefetch.retry_delay = config.getfloat('prefetch', 'retry_delay', fallback=5)
+    machine.prefetch.max_retry_delay = config.getfloat('prefetch', 'max_retry_delay', fallback=300)
+
+    await files.restore_playback(machine)
 
     scheduler_instant = scheduler.start_scheduler(
                             machine, interval=1
                             )
+    push_enabled = config.getboolean('server', 'push', fallback=False)
     poller = server_polling(
                             machine,
-                            interval=1
+                            interval=1,
+                            push_interval=config.getfloat('server', 'push_poll_interval', fallback=30)
+                            if push_enabled else None
                             )
-    await asyncio.gather(scheduler_instant, poller, timer())
-    await files.save_json(machine)
+    workers = [scheduler_instant, poller,
+               machine.metrics.loop_lag_sampler(
+                   interval=config.getfloat('metrics', 'lag_interval', fallback=0.5)),
+               machine.reports.run(
+                   machine.http,
+                   url=f"{machine.srv_url}/device/{machine.info.get('serial')}/reports"
+                   )]
+    if fast_start:
+        workers.append(files.reconcile_files(
+            machine, delay=config.getfloat('startup', 'reconcile_delay', fallback=30)))
+    if config.getboolean('prefetch', 'enabled', fallback=True):
+        workers.append(scheduler.prefetch_loop(machine))
+    if config.getboolean('metrics', 'enabled', fallback=True):
+        workers.append(machine.metrics.serve(machine,
+                                             host=config.get('metrics', 'host', fallback='127.0.0.1'),
+                                             port=config.getint('metrics', 'port', fallback=9100)))
+    if config.getboolean('peers', 'enabled', fallback=False):
+        machine.peers.peers = [peer.strip().rstrip('/') for peer in
+                               config.get('peers', 'peers', fallback='').split(',') if peer.strip()]
+        machine.peers.refresh_interval = config.getfloat('peers', 'refresh_interval', fallback=60)
+        workers.append(machine.peers.serve(machine.store,
+                                           host=config.get('peers', 'host', fallback='0.0.0.0'),
+                                           port=config.getint('peers', 'port', fallback=8090)))
+        workers.append(machine.peers.refresh_loop(machine.http))
+    if push_enabled:
+        workers.append(push.push_listener(
+            machine,
+            url=f"{machine.srv_url}/device/{machine.info.get('serial')}/ws",
+            handler=process_response
+            ))
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        await machine.persistence.flush()
+        await machine.downloads.close()
+        await machine.http.close()
+        machine.hasher.close()
+        machine.fs.close()
     logger.info('Finish')
 
 
-asyncio.run(main())
+if __name__ == '__main__':
+    asyncio.run(main())
 #print(logging.INFO)
\ No newline at end of file
@@ -28,4 +28,14 @@ class ScheduledFile(BaseModel):
     state: str
     # optional
     status: Optional[bool]
-    error: Optional[str]
\ No newline at end of file
+    error: Optional[str]
+
+class StartupInfo(BaseModel):
+
+    # necessary
+
+    mode: str  # 'fast' | 'full'
+    display: str  # first display to show a file
+    since_start: float  # seconds from process start to first frame
+    # optional
+    since_boot: Optional[float]
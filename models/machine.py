@@ -1,11 +1,25 @@
 
-import json
 import os
-import subprocess
+import re
 from dataclasses import dataclass, field
 from enum import Enum
 import asyncio
 import logging
+from system_works.hash_cache import HashCache
+from api_requests.client import HttpClient
+from system_works.downloads import DownloadManager
+from models.registry import FileRegistry, CurrentRegistry, ScheduleRegistry
+from system_works.persistence import GENERATION, StatePersistence, load_state
+from api_requests.reports import ReportQueue
+from api_requests.peers import PeerDirectory
+from system_works.media_store import MediaStore
+from system_works.warmup import Prefetcher
+from system_works.storage import StorageManager
+from system_works.metrics import Metrics
+from system_works.hash_engine import HashEngine
+from system_works.async_fs import AsyncFS
+from system_works.locks import LockManager
+from system_works.startup import StartupClock
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +36,42 @@ def log_exception_wrapper(func):
     return log_exception_wrapper
 
 
+def read_cpuinfo(path: str = '/proc/cpuinfo') -> dict:
+    # Строки Revision, Serial, Model без запуска cat | grep
+    info = {}
+    try:
+        with open(path, encoding='utf-8', errors='replace') as cpuinfo:
+            for line in cpuinfo:
+                if ':' in line and re.search('Revision|Serial|Model', line):
+                    key, _, value = line.partition(':')
+                    info[key.strip().lower()] = value.strip()
+    except OSError as exception:
+        logger.warning(f"{path} не прочитан, {exception=}")
+    return info
+
+
+def read_displays(path: str = '/sys/class/drm') -> list[str]:
+    # Подключенные разъемы (card1-HDMI-A-1 -> HDMI-A-1), как их
+    # показывает kmsprint, без запуска kmsprint
+    displays = []
+    try:
+        entries = sorted(os.listdir(path))
+    except OSError as exception:
+        logger.warning(f"{path} не прочитан, {exception=}")
+        return displays
+    for entry in entries:
+        match = re.match(r'card\d+-(.+)$', entry)
+        if match is None:
+            continue
+        try:
+            with open(os.path.join(path, entry, 'status'), encoding='utf-8') as status:
+                if status.read().strip() == 'connected':
+                    displays.append(match.group(1))
+        except OSError:
+            continue
+    return displays
+
+
 class JsonSections(Enum):
     # Описание секции джейсона для обмена
 
@@ -54,13 +104,32 @@ class MediaMachine:
     from_date_format: str = field(compare=False, default='%d.%m.%Y')
     service_name: str | None = field(default=None)  # Наименование активного сервиса воспроизведения медиа
     db_json: str = field(compare=False, default='db.json')
-    scheduler: list[dict] = field(default_factory=list)  # [{'display':str, 'from_date': datetime, 'filename':str, 'md5hash':str, 'state':str}]
-    current: list[dict] = field(default_factory=list)  # {'display':str, 'filename':str, 'md5hash':str}
-    files: list = field(default_factory=list)
+    hash_cache_json: str = field(compare=False, default='hash_cache.json')
+    reports_json: str = field(compare=False, default='reports_queue.jsonl')
+    scheduler: ScheduleRegistry = field(default_factory=ScheduleRegistry)  # ScheduleRecord(display, from_date, filename, md5hash, url, state)
+    current: CurrentRegistry = field(default_factory=CurrentRegistry)  # CurrentRecord(display, filename, md5hash)
+    files: FileRegistry = field(default_factory=FileRegistry)  # FileRecord(filename, md5hash)
     srv_url: str = field(compare=False, default='http://localhost:8000')
+    schedule_version: str | None = field(compare=False, default=None)  # ETag примененного расписания
     renew: bool = field(compare=False, default=False)
     info: dict = field(compare=False, init=False, default_factory=dict)
-    async_events: dict = field(compare=False, init=False, default_factory=dict[asyncio.Event])
+    locks: LockManager = field(compare=False, repr=False, default_factory=LockManager)  # блокировки файлов по имени
+    hash_cache: HashCache = field(compare=False, init=False, repr=False)
+    http: HttpClient = field(compare=False, repr=False, default_factory=HttpClient)  # общий пул соединений с сервером
+    downloads: DownloadManager = field(compare=False, repr=False, default_factory=DownloadManager)  # очередь загрузок
+    persistence: StatePersistence = field(compare=False, init=False, repr=False)  # запись db.json
+    reports: ReportQueue = field(compare=False, init=False, repr=False)  # отчеты серверу
+    store: MediaStore = field(compare=False, init=False, repr=False)  # объекты objects/<md5>
+    prefetch: Prefetcher = field(compare=False, repr=False, default_factory=Prefetcher)  # прогрев перед слотом
+    peers: PeerDirectory = field(compare=False, repr=False, default_factory=PeerDirectory)  # кеш соседей площадки
+    storage: StorageManager = field(compare=False, repr=False, default_factory=StorageManager)  # квота и вытеснение
+    fs: AsyncFS = field(compare=False, repr=False, default_factory=AsyncFS)  # файловые операции вне цикла событий
+    hasher: HashEngine = field(compare=False, repr=False, default_factory=HashEngine)  # пул подсчета хэшей
+    metrics: Metrics = field(compare=False, repr=False, default_factory=Metrics)  # /metrics
+    startup: StartupClock = field(compare=False, repr=False, default_factory=StartupClock)  # время до первого кадра
+    push_connected: asyncio.Event = field(compare=False, init=False, repr=False, default_factory=asyncio.Event)  # поднят push канал
+    poll_now: asyncio.Event = field(compare=False, init=False, repr=False, default_factory=asyncio.Event)  # внеочередной опрос
+    partial_hashes: dict = field(compare=False, init=False, repr=False, default_factory=dict)  # {downloading_path: (offset, hash)}
 
     def __post_init__(self):
 
@@ -70,42 +139,50 @@ class MediaMachine:
                     )
         if not os.path.exists(self.downloading_dir):
             os.makedirs(self.downloading_dir)
+        self.store = MediaStore(self.working_dir, fs=self.fs)
+        db_path = os.path.abspath(f'{self.working_dir}/{self.db_json}')
+        state = {}
         try:
-            with open(
-                    f'{self.working_dir}/{self.db_json}',
-                    encoding='utf-8'
-                    ) as db_json:
-                self.scheduler = json.load(db_json).get('schedule', [])
-        except Exception as e:
-            print(self.scheduler, e)
+            state = load_state(db_path)
+            self.scheduler = ScheduleRegistry.from_list(
+                state.get('schedule', []),
+                date_format=self.from_date_format)
+            self.schedule_version = state.get('schedule_version')
+            # Для быстрого старта: файлы и текущие ссылки на момент
+            # последнего сохранения, сверка с диском - позже в фоне
+            self.files = FileRegistry.from_list(state.get('files', []))
+            self.current = CurrentRegistry.from_list(state.get('current', []))
+        except Exception as exception:
+            # Битому db.json не доверяем: без списка файлов старт пойдет
+            # полной сверкой с диском
+            logger.exception(f"Состояние {db_path} не прочитано, {exception=}")
+            self.files = FileRegistry()
+            self.current = CurrentRegistry()
+        self.scheduler.date_format = self.from_date_format
+        self.persistence = StatePersistence(db_path, snapshot=self.snapshot,
+                                            generation=state.get(GENERATION, 0))
+        # Кэш хэшей лежит рядом с db.json
+        self.hash_cache = HashCache(
+                    os.path.abspath(f'{self.working_dir}/{self.hash_cache_json}')
+                    )
+        self.hash_cache.load()
+        self.persistence.on_flush.append(self.hash_cache.save_job)
+        self.reports = ReportQueue(
+                    os.path.abspath(f'{self.working_dir}/{self.reports_json}')
+                    )
         self.info = self.get_info()
         # self.scheduler.sort(key=lambda x: datetime.strptime(x['from_date'], self.from_date_format))
 
     @log_exception_wrapper
     def get_info(self) -> dict:
         # Получаем инфо с raspberry в виде
-        # {'displays':[], 'Revision':str, 'Model':str, 'Serial':str}
-        # только для  raspberry!
+        # {'displays':[], 'revision':str, 'model':str, 'serial':str}
+        # только для  raspberry! Читается напрямую из /proc и /sys
         logger.info('Получаем инфо машины')
-        disp = subprocess.run(
-            "kmsprint | grep Connector | awk '{print $4}'",
-            shell=True, capture_output=True, text=True
-            )
-        displays = disp.stdout.split()
-        syst = subprocess.run(
-            "cat /proc/cpuinfo | grep -E 'Revision|Serial|Model'",
-            shell=True,
-            capture_output=True,
-            text=True
-            )
-        logger.debug(f"MACHINE SYSTEM:{syst}")
-
-        sys_info = dict(
-            (x.strip().split('\t:', 1)[0].strip().lower(), x.strip().split('\t:', 1)[1].strip())
-            for x in syst.stdout.split('\n') if x
-            )
-
-        sys_info.update({'displays': displays})
+        sys_info = read_cpuinfo()
+        logger.debug(f"MACHINE SYSTEM:{sys_info}")
+
+        sys_info.update({'displays': read_displays()})
         sys_info.update({'service': self.service_name})
         sys_info.update({'working_dir': self.working_dir})
         sys_info.update({'downloading_dir': self.downloading_dir})
@@ -113,12 +190,12 @@ class MediaMachine:
         logger.debug(f"Инфо машины:{sys_info}")
         return sys_info
 
-    @log_exception_wrapper
-    def get_event(self, eventname: str) -> asyncio.Event:
-        '''Проверяет или заводит событие для контроля доступа к объекту(файлу)
-        инициирует и возвращает его'''
-
-        if self.async_events.get(eventname, None) is None:
-            self.async_events[eventname] = asyncio.Event()
-            self.async_events[eventname].set()
-        return self.async_events[eventname]
+    def snapshot(self) -> dict:
+        # Секции db.json
+        return {
+            'info': self.info,
+            'current': self.current.to_list(),
+            'files': self.files.to_list(),
+            'schedule': self.scheduler.to_list(),
+            'schedule_version': self.schedule_version
+            }
@@ -0,0 +1,321 @@
+import asyncio
+import heapq
+import itertools
+from collections import deque
+from datetime import datetime
+from typing import Iterator
+
+# Форматы from_date с точностью меньше суток, проверяются после основного
+SUBDAY_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M')
+
+
+def parse_from_date(value: str, date_format: str = '%d.%m.%Y') -> float | None:
+    '''Перевод from_date в timestamp. Кроме основного формата понимает
+    время внутри суток и ISO 8601. Вернет None, если разобрать не удалось'''
+
+    for fmt in (date_format, *SUBDAY_FORMATS):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except (TypeError, ValueError):
+            continue
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class FileRecord:
+    # Запись о файле рабочей директории
+
+    __slots__ = ('filename', 'md5hash')
+
+    def __init__(self, filename: str, md5hash: str):
+        self.filename = filename
+        self.md5hash = md5hash
+
+    def to_dict(self) -> dict:
+        return {'filename': self.filename, 'md5hash': self.md5hash}
+
+    def __repr__(self):
+        return f'FileRecord({self.filename!r}, {self.md5hash!r})'
+
+
+class CurrentRecord:
+    # Запись о файле, проигрываемом на дисплее
+
+    __slots__ = ('display', 'filename', 'md5hash')
+
+    def __init__(self, display: str, filename: str, md5hash: str):
+        self.display = display
+        self.filename = filename
+        self.md5hash = md5hash
+
+    def to_dict(self) -> dict:
+        return {'display': self.display,
+                'filename': self.filename,
+                'md5hash': self.md5hash}
+
+    def __repr__(self):
+        return f'CurrentRecord({self.display!r}, {self.filename!r}, {self.md5hash!r})'
+
+
+class ScheduleRecord:
+    # Задача расписания, поля как в ScheduledFile.
+    # due - from_date в виде timestamp, разбирается один раз при добавлении
+
+    FIELDS = ('display', 'from_date', 'filename', 'md5hash', 'url',
+              'state', 'status', 'error')
+    __slots__ = FIELDS + ('due', 'lateness')
+
+    def __init__(self, display: str, from_date: str, filename: str,
+                 md5hash: str, url: str | None = None,
+                 state: str | None = None, status: bool | None = None,
+                 error: str | None = None):
+        self.display = display
+        self.from_date = from_date
+        self.filename = filename
+        self.md5hash = md5hash
+        self.url = url
+        self.state = state
+        self.status = status
+        self.error = error
+        self.due: float | None = None
+        self.lateness: float | None = None  # опоздание активации, сек
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ScheduleRecord':
+        return cls(**{name: data.get(name) for name in cls.FIELDS})
+
+    @property
+    def key(self) -> tuple:
+        return (self.display, self.from_date, self.md5hash, self.filename)
+
+    def to_dict(self) -> dict:
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        for optional in ('status', 'error'):
+            if data[optional] is None:
+                del data[optional]
+        return data
+
+    def __repr__(self):
+        return f'ScheduleRecord({self.to_dict()!r})'
+
+
+class FileRegistry:
+    '''Файлы рабочей директории с поиском по имени и по md5 за O(1)'''
+
+    def __init__(self):
+        self._by_filename: dict[str, FileRecord] = {}
+        self._by_md5: dict[str, dict[str, FileRecord]] = {}
+
+    @classmethod
+    def from_list(cls, records: list[dict]) -> 'FileRegistry':
+        registry = cls()
+        for record in records:
+            registry.add(record['filename'], record['md5hash'])
+        return registry
+
+    def add(self, filename: str, md5hash: str) -> FileRecord:
+        record = self._by_filename.get(filename)
+        if record is not None:
+            if record.md5hash == md5hash:
+                return record
+            self.remove(filename)
+        record = FileRecord(filename, md5hash)
+        self._by_filename[filename] = record
+        self._by_md5.setdefault(md5hash, {})[filename] = record
+        return record
+
+    def remove(self, filename: str) -> FileRecord | None:
+        record = self._by_filename.pop(filename, None)
+        if record is not None:
+            same_hash = self._by_md5.get(record.md5hash, {})
+            same_hash.pop(filename, None)
+            if not same_hash:
+                self._by_md5.pop(record.md5hash, None)
+        return record
+
+    def get(self, filename: str) -> FileRecord | None:
+        return self._by_filename.get(filename)
+
+    def by_md5(self, md5hash: str) -> list[FileRecord]:
+        return list(self._by_md5.get(md5hash, {}).values())
+
+    def first_by_md5(self, md5hash: str) -> FileRecord | None:
+        return next(iter(self._by_md5.get(md5hash, {}).values()), None)
+
+    def has_md5(self, md5hash: str) -> bool:
+        return md5hash in self._by_md5
+
+    def __contains__(self, item: tuple[str, str]) -> bool:
+        filename, md5hash = item
+        record = self._by_filename.get(filename)
+        return record is not None and record.md5hash == md5hash
+
+    def __iter__(self) -> Iterator[FileRecord]:
+        return iter(list(self._by_filename.values()))
+
+    def __len__(self):
+        return len(self._by_filename)
+
+    def to_list(self) -> list[dict]:
+        return [record.to_dict() for record in self._by_filename.values()]
+
+
+class CurrentRegistry:
+    '''Текущие файлы дисплеев с поиском по дисплею и по md5 за O(1)'''
+
+    def __init__(self):
+        self._by_display: dict[str, CurrentRecord] = {}
+        self._md5_count: dict[str, int] = {}
+
+    @classmethod
+    def from_list(cls, records: list[dict]) -> 'CurrentRegistry':
+        registry = cls()
+        for record in records:
+            registry.set(record['display'], record['filename'], record['md5hash'])
+        return registry
+
+    def set(self, display: str, filename: str, md5hash: str) -> CurrentRecord | None:
+        '''Ставит текущий файл дисплея, вернет предыдущую запись'''
+
+        previous = self.remove(display)
+        self._by_display[display] = CurrentRecord(display, filename, md5hash)
+        self._md5_count[md5hash] = self._md5_count.get(md5hash, 0) + 1
+        return previous
+
+    def remove(self, display: str) -> CurrentRecord | None:
+        record = self._by_display.pop(display, None)
+        if record is not None:
+            self._md5_count[record.md5hash] -= 1
+            if not self._md5_count[record.md5hash]:
+                del self._md5_count[record.md5hash]
+        return record
+
+    def get(self, display: str) -> CurrentRecord | None:
+        return self._by_display.get(display)
+
+    def is_playing(self, md5hash: str) -> bool:
+        return md5hash in self._md5_count
+
+    def __iter__(self) -> Iterator[CurrentRecord]:
+        return iter(list(self._by_display.values()))
+
+    def __len__(self):
+        return len(self._by_display)
+
+    def to_list(self) -> list[dict]:
+        return [record.to_dict() for record in self._by_display.values()]
+
+
+class ScheduleRegistry:
+    '''Задачи расписания. Поиск по полному ключу
+    (display, from_date, md5hash, filename), по слоту (display, from_date)
+    и по паре (display, md5hash) за O(1). Ожидающие активации задачи
+    хранятся в куче по времени due, wakeup будит планировщик, если
+    добавлена задача раньше ближайшей'''
+
+    def __init__(self, date_format: str = '%d.%m.%Y', lateness_history: int = 200):
+        self.date_format = date_format
+        self._by_key: dict[tuple, ScheduleRecord] = {}
+        self._by_slot: dict[tuple, dict[tuple, ScheduleRecord]] = {}
+        self._by_display_md5: dict[tuple, dict[tuple, ScheduleRecord]] = {}
+        self._pending: list[tuple[float, int, ScheduleRecord]] = []
+        self._seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.lateness = deque(maxlen=lateness_history)  # (key, опоздание, сек)
+
+    @classmethod
+    def from_list(cls, records: list[dict],
+                  date_format: str = '%d.%m.%Y') -> 'ScheduleRegistry':
+        registry = cls(date_format=date_format)
+        for record in records:
+            registry.add(ScheduleRecord.from_dict(record))
+        return registry
+
+    def add(self, record: ScheduleRecord) -> ScheduleRecord:
+        existing = self._by_key.get(record.key)
+        if existing is not None:
+            return existing
+        if record.due is None:
+            record.due = parse_from_date(record.from_date, self.date_format)
+        self._by_key[record.key] = record
+        self._by_slot.setdefault(
+            (record.display, record.from_date), {})[record.key] = record
+        self._by_display_md5.setdefault(
+            (record.display, record.md5hash), {})[record.key] = record
+        return record
+
+    def remove(self, record: ScheduleRecord) -> ScheduleRecord | None:
+        record = self._by_key.pop(record.key, None)
+        if record is None:
+            return None
+        for index, index_key in ((self._by_slot, (record.display, record.from_date)),
+                                 (self._by_display_md5, (record.display, record.md5hash))):
+            bucket = index.get(index_key, {})
+            bucket.pop(record.key, None)
+            if not bucket:
+                index.pop(index_key, None)
+        return record
+
+    def schedule(self, record: ScheduleRecord, at: float | None = None) -> bool:
+        '''Ставит задачу в очередь активации на время due (или at для
+        повторов). Вернет False, если from_date не разобран'''
+
+        if record.due is None:
+            return False
+        at = record.due if at is None else at
+        earliest = self.next_due()
+        heapq.heappush(self._pending, (at, next(self._seq), record))
+        if earliest is None or at < earliest:
+            self.wakeup.set()
+        return True
+
+    def next_due(self) -> float | None:
+        # Снимаем с вершины кучи удаленные из реестра задачи
+        while self._pending and self._by_key.get(self._pending[0][2].key) is not self._pending[0][2]:
+            heapq.heappop(self._pending)
+        return self._pending[0][0] if self._pending else None
+
+    def pop_due(self, now: float) -> list[ScheduleRecord]:
+        '''Извлекает задачи со временем due <= now в порядке due'''
+
+        due_tasks = []
+        while (next_due := self.next_due()) is not None and next_due <= now:
+            due_tasks.append(heapq.heappop(self._pending)[2])
+        return due_tasks
+
+    def upcoming(self, states: tuple) -> dict[str, ScheduleRecord]:
+        '''Ближайшая ожидающая задача каждого дисплея'''
+
+        nearest: dict[str, tuple[float, ScheduleRecord]] = {}
+        for at, _, record in self._pending:
+            if self._by_key.get(record.key) is not record or record.state not in states:
+                continue
+            if record.display not in nearest or at < nearest[record.display][0]:
+                nearest[record.display] = (at, record)
+        return {display: record for display, (_, record) in nearest.items()}
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def remove_slot(self, display, from_date) -> list[ScheduleRecord]:
+        return [self.remove(record) for record in self.by_slot(display, from_date)]
+
+    def find(self, display, from_date, md5hash, filename) -> ScheduleRecord | None:
+        return self._by_key.get((display, from_date, md5hash, filename))
+
+    def by_slot(self, display, from_date) -> list[ScheduleRecord]:
+        return list(self._by_slot.get((display, from_date), {}).values())
+
+    def by_display_md5(self, display, md5hash) -> list[ScheduleRecord]:
+        return list(self._by_display_md5.get((display, md5hash), {}).values())
+
+    def __iter__(self) -> Iterator[ScheduleRecord]:
+        return iter(list(self._by_key.values()))
+
+    def __len__(self):
+        return len(self._by_key)
+
+    def to_list(self) -> list[dict]:
+        return [record.to_dict() for record in self._by_key.values()]
@@ -0,0 +1,137 @@
+from models.registry import (CurrentRegistry, FileRegistry, ScheduleRecord,
+                             ScheduleRegistry, parse_from_date)
+
+
+def schedule_record(display='d1', from_date='01.01.2030', filename='a.mp4', md5hash='aaa'):
+    return ScheduleRecord(display, from_date, filename, md5hash, state='ждет')
+
+
+def test_file_registry_add_remove():
+    files = FileRegistry()
+    files.add('a.mp4', 'aaa')
+    files.add('b.mp4', 'aaa')
+    files.add('c.mp4', 'ccc')
+
+    assert ('a.mp4', 'aaa') in files
+    assert sorted(record.filename for record in files.by_md5('aaa')) == ['a.mp4', 'b.mp4']
+    assert len(files) == 3
+
+    files.remove('a.mp4')
+    assert files.first_by_md5('aaa').filename == 'b.mp4'
+    files.remove('b.mp4')
+    assert not files.has_md5('aaa')
+    assert files.by_md5('aaa') == []
+    assert files.remove('missing.mp4') is None
+
+
+def test_file_registry_rekey():
+    # Тот же файл с новым содержимым переходит в другую группу md5
+    files = FileRegistry()
+    first = files.add('a.mp4', 'aaa')
+    assert files.add('a.mp4', 'aaa') is first
+
+    files.add('a.mp4', 'bbb')
+    assert not files.has_md5('aaa')
+    assert [record.filename for record in files.by_md5('bbb')] == ['a.mp4']
+    assert ('a.mp4', 'aaa') not in files
+    assert len(files) == 1
+
+
+def test_file_registry_round_trip():
+    records = [{'filename': 'a.mp4', 'md5hash': 'aaa'},
+               {'filename': 'b.mp4', 'md5hash': 'bbb'}]
+    assert FileRegistry.from_list(records).to_list() == records
+
+
+def test_current_registry_md5_count():
+    current = CurrentRegistry()
+    assert current.set('d1', 'a.mp4', 'aaa') is None
+    current.set('d2', 'b.mp4', 'aaa')
+    assert current.is_playing('aaa')
+
+    previous = current.set('d1', 'c.mp4', 'ccc')
+    assert (previous.filename, previous.md5hash) == ('a.mp4', 'aaa')
+    assert current.is_playing('aaa')
+
+    current.remove('d2')
+    assert not current.is_playing('aaa')
+    assert current.is_playing('ccc')
+    assert current.remove('d2') is None
+    assert [record.display for record in current] == ['d1']
+
+
+def test_schedule_registry_indexes():
+    schedule = ScheduleRegistry()
+    first = schedule.add(schedule_record())
+    second = schedule.add(schedule_record(filename='b.mp4', md5hash='bbb'))
+    assert schedule.add(schedule_record()) is first
+
+    assert schedule.find('d1', '01.01.2030', 'aaa', 'a.mp4') is first
+    assert set(schedule.by_slot('d1', '01.01.2030')) == {first, second}
+    assert schedule.by_display_md5('d1', 'aaa') == [first]
+
+    schedule.remove(first)
+    assert schedule.by_slot('d1', '01.01.2030') == [second]
+    assert schedule.by_display_md5('d1', 'aaa') == []
+    assert schedule.remove(first) is None
+
+    assert schedule.remove_slot('d1', '01.01.2030') == [second]
+    assert len(schedule) == 0
+
+
+def test_schedule_registry_heap_skips_removed():
+    schedule = ScheduleRegistry()
+    early = schedule.add(schedule_record(from_date='01.01.2030'))
+    late = schedule.add(schedule_record(from_date='02.01.2030'))
+    assert schedule.schedule(late)
+    schedule.wakeup.clear()
+    assert schedule.schedule(early)
+    # Задача раньше ближайшей будит планировщик
+    assert schedule.wakeup.is_set()
+
+    # Удаленная задача остается в куче, но не выдается
+    schedule.remove(early)
+    assert schedule.by_display_md5('d1', 'aaa') == [late]
+    assert schedule.next_due() == late.due
+    assert schedule.pop_due(late.due) == [late]
+    assert schedule.next_due() is None
+
+
+def test_schedule_registry_readded_record_replaces_stale_heap_entry():
+    # Удаленная и добавленная заново задача - новый объект, старая запись кучи устарела
+    schedule = ScheduleRegistry()
+    stale = schedule.add(schedule_record())
+    schedule.schedule(stale)
+    schedule.remove(stale)
+    fresh = schedule.add(schedule_record())
+    schedule.schedule(fresh)
+
+    assert schedule.by_display_md5('d1', 'aaa') == [fresh]
+    assert schedule.pop_due(fresh.due) == [fresh]
+    assert schedule.upcoming(('ждет',)) == {}
+
+
+def test_schedule_registry_upcoming():
+    schedule = ScheduleRegistry()
+    for display, from_date in (('d1', '02.01.2030'), ('d1', '01.01.2030'), ('d2', '03.01.2030')):
+        schedule.schedule(schedule.add(schedule_record(display, from_date)))
+
+    upcoming = schedule.upcoming(('ждет',))
+    assert upcoming['d1'].from_date == '01.01.2030'
+    assert upcoming['d2'].from_date == '03.01.2030'
+    assert schedule.upcoming(('загружен',)) == {}
+
+
+def test_unparsed_from_date_not_scheduled():
+    schedule = ScheduleRegistry()
+    record = schedule.add(schedule_record(from_date='завтра'))
+    assert record.due is None
+    assert not schedule.schedule(record)
+    assert schedule.pending_count() == 0
+
+
+def test_parse_from_date_formats():
+    day = parse_from_date('01.01.2030')
+    assert parse_from_date('01.01.2030 12:30') == day + 12.5 * 3600
+    assert parse_from_date('2030-01-01T00:00:10') == day + 10
+    assert parse_from_date(None) is None
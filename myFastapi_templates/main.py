@@ -1,29 +1,130 @@
 from fastapi import FastAPI, HTTPException, Header, Request, Response, status
-from fastapi import responses
+from fastapi import WebSocket, WebSocketDisconnect
+from collections import OrderedDict
+import asyncio
 import aiofiles
 import json
-from models.endpoints import MediaMachine, CurrentInfo, ScheduledFile
+from pydantic import ValidationError
+from models.endpoints import MediaMachine, CurrentInfo, ScheduledFile, ReportsBatch
+from models.api_collections import StartupInfo
+from push import PushManager
+from ranges import range_response
+from store import ReportStore
+from schedules import ScheduleCache
+from manifests import ManifestCache
 import os
 
 app = FastAPI()
+push_manager = PushManager()
 
 DATAFILES = './datafiles'
 
+# Отчеты устройств; файл базы общий для всех воркеров uvicorn
+report_store = ReportStore(f'{DATAFILES}/reports.sqlite3')
+# Скомпилированные расписания устройств и групп
+schedule_cache = ScheduleCache(DATAFILES)
+# Хэши кусков файлов для проверки и частичной докачки на устройстве
+manifest_cache = ManifestCache(DATAFILES)
+
+# Последние отданные версии расписания по устройствам: {sn: {etag: данные}}
+SCHEDULE_VERSIONS: dict[str, OrderedDict] = {}
+VERSIONS_KEPT = 16
+
+
+def remember_version(sn: str, etag: str, data: dict):
+    versions = SCHEDULE_VERSIONS.setdefault(sn, OrderedDict())
+    versions[etag] = data
+    versions.move_to_end(etag)
+    while len(versions) > VERSIONS_KEPT:
+        versions.popitem(last=False)
+
+
+def schedule_delta(old: dict, new: dict) -> dict:
+    '''Разница расписаний по слоту (display, from_date). Секции current
+    и delete передаются, только если изменились'''
+
+    def slots(data):
+        return {(entry.get('display'), entry.get('from_date')): entry
+                for entry in data.get('schedule', [])}
+
+    old_entries, new_entries = slots(old), slots(new)
+    delta = {
+        'added': [entry for slot, entry in new_entries.items()
+                  if slot not in old_entries],
+        'removed': [{'display': slot[0], 'from_date': slot[1]}
+                    for slot in old_entries if slot not in new_entries],
+        'changed': [entry for slot, entry in new_entries.items()
+                    if slot in old_entries and old_entries[slot] != entry],
+        }
+    result = {'delta': delta}
+    for section in ('current', 'delete'):
+        if new.get(section) != old.get(section):
+            result[section] = new.get(section)
+    return result
+
+@app.on_event("shutdown")
+async def close_store():
+    await report_store.close()
+
+
 @app.get("/test/{sn}")
 async def test_request(request: Request, sn):
     print(request.headers, sn)
     return  sn
 
 @app.get("/device/{sn}")
-async def task_response(sn):
-    schedule_json = os.path.abspath(f'{DATAFILES}/devices/{sn}/schedule.json')
+async def task_response(sn, request: Request):
+    '''Отдает расписание устройства (или его группы) готовыми байтами с ETag.
+    Если устройство прислало текущую версию в If-None-Match - 304, если
+    прислало старую и A-IM: delta - только разницу (226 IM Used), иначе
+    полное расписание, сжатое gzip при Accept-Encoding: gzip'''
+
     if not os.path.exists(f'{DATAFILES}/devices/{sn}'):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Device not found')
-    elif not os.path.exists(schedule_json):
+    compiled = schedule_cache.get(sn)
+    if compiled is None:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='No info found')
-    else:
-        async with aiofiles.open(schedule_json) as schedule:
-            return await schedule.read()
+
+    etag = compiled.etag
+    client_version = request.headers.get('If-None-Match')
+    if client_version == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+    base = SCHEDULE_VERSIONS.get(sn, {}).get(client_version)
+    remember_version(sn, etag, compiled.data)
+    if base is not None and 'delta' in request.headers.get('A-IM', ''):
+        return Response(content=json.dumps(schedule_delta(base, compiled.data)),
+                        status_code=status.HTTP_226_IM_USED,
+                        media_type='application/json',
+                        headers={'ETag': etag, 'IM': 'delta'})
+
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+    if compiled.gzipped is not None and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return Response(content=compiled.gzipped, media_type='application/json', headers=headers)
+    return Response(content=compiled.payload, media_type='application/json', headers=headers)
+
+
+@app.put("/groups/{group}/schedule")
+async def group_schedule(group: str, data: dict):
+    '''Новое расписание группы: пересборка кеша и push подключенным устройствам'''
+
+    if group.startswith('.'):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Bad group name')
+    compiled = schedule_cache.set_group_schedule(group, data)
+    delivered = 0
+    for sn in schedule_cache.members(group):
+        delivered += await push_manager.send(sn, data)
+    return {'etag': compiled.etag, 'devices': len(schedule_cache.members(group)),
+            'delivered': delivered}
+
+
+@app.put("/groups/{group}/devices")
+async def group_devices(group: str, devices: list[str]):
+    '''Состав группы; устройство состоит не более чем в одной группе'''
+
+    schedule_cache.set_group_members(group, devices)
+    return {'group': group, 'devices': schedule_cache.members(group)}
 
 
 @app.post("/device/{sn}")
@@ -37,55 +138,109 @@ async def task_response(sn: str, machine: MediaMachine):
         return Response(status_code=status.HTTP_200_OK, content="Thanks")
 
 
+@app.websocket("/device/{sn}/ws")
+async def device_push(websocket: WebSocket, sn: str):
+    '''Постоянный канал устройства, сервер шлет в него события'''
+
+    if not os.path.exists(f'{DATAFILES}/devices/{sn}'):
+        await websocket.close(code=4404)
+        return
+    await push_manager.connect(sn, websocket)
+    try:
+        while True:
+            # Устройство ничего не шлет, чтение нужно для обнаружения обрыва
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        push_manager.disconnect(sn, websocket)
+
+
+@app.post("/device/{sn}/push")
+async def push_event(sn: str, event: dict):
+    '''Немедленная отправка события устройству: schedule/current/delete
+    в формате GET /device/{sn} или {"event": "poll"}'''
+
+    delivered = await push_manager.send(sn, event)
+    if not delivered:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Device not connected')
+    return {'delivered': delivered}
+
+
 @app.post("/device/{sn}/current")
 async def current_response(sn: str, data: CurrentInfo):
-    info_json = os.path.abspath(f'{DATAFILES}/devices/{sn}/info.json')
-    async with aiofiles.open(info_json, mode="a+") as info:
-        await info.seek(0)
-        actual_info = json.loads(await info.read())
-        current = next((record for record in actual_info['current'] if record.get('display') == data.display), {})
-        current.update(data)
-        await info.truncate(0)
-        await info.write(json.dumps(actual_info, indent=2))
+    await report_store.upsert_current(sn, [data.model_dump()])
     return Response(status_code=status.HTTP_200_OK, content="Thanks")
 
 
 @app.post("/device/{sn}/schedule")
 async def schedule_response(sn:str, data: ScheduledFile):
-    info_json = os.path.abspath(f'{DATAFILES}/devices/{sn}/schedule.json')
-
-    async with aiofiles.open(info_json, mode="a+") as info:
-        await info.seek(0)
-        actual_info = json.loads(await info.read())
-
-        scheduled_file = next((record for record in actual_info['schedule']
-                               if record.get('display') == data.display
-                               and record.get('md5hash') == data.md5hash
-                               and  record.get('from_date') == data.from_date), {})
-
-        if scheduled_file in actual_info['schedule']:
-            actual_info['schedule'].remove(scheduled_file)
-        scheduled_file.update(data.model_dump())
-        actual_info['schedule'].append(scheduled_file)
-        await info.truncate(0)
-        await info.write(json.dumps(actual_info, indent=2))
+    await report_store.upsert_schedule(sn, [data.model_dump()])
     return Response(status_code=status.HTTP_200_OK, content="Thanks")
 
 
-@app.get("/files/{md5hash}")
-async def files_response(request: Request, md5hash):
+# Модели данных отчетов по их виду
+REPORT_MODELS = {'current': CurrentInfo, 'schedule': ScheduledFile, 'startup': StartupInfo}
+
+
+@app.post("/device/{sn}/reports")
+async def reports_response(sn: str, data: ReportsBatch):
+    '''Пачка отчетов устройства, записывается одной транзакцией'''
+
+    if not os.path.exists(f'{DATAFILES}/devices/{sn}'):
+        raise HTTPException(status_code=404, detail='Device not found')
+
+    # Отчет с неверными данными не валит пачку - он возвращается в rejected
+    records = {kind: [] for kind in REPORT_MODELS}
+    rejected = []
+    for index, report in enumerate(data.reports):
+        model = REPORT_MODELS.get(report.kind)
+        if model is None:
+            rejected.append({'index': index, 'error': f'Unknown report kind {report.kind!r}'})
+            continue
+        try:
+            records[report.kind].append(model(**report.data).model_dump())
+        except ValidationError as exception:
+            rejected.append({'index': index, 'error': str(exception)})
+    await asyncio.gather(report_store.upsert_current(sn, records['current']),
+                         report_store.upsert_schedule(sn, records['schedule']),
+                         report_store.upsert_startup(sn, records['startup']))
+    return {'accepted': len(data.reports) - len(rejected), 'rejected': rejected}
+
+
+@app.get("/device/{sn}/status")
+async def status_response(sn: str):
+    '''Последние отчеты устройства: текущие файлы, состояние задач расписания
+    и время первого кадра после запуска'''
+
+    return await report_store.device_status(sn)
+
+
+@app.api_route("/files/{md5hash}", methods=["GET", "HEAD"])
+async def files_response(request: Request, md5hash: str):
     file = os.path.abspath(f'{DATAFILES}/{md5hash}.mp4')
     if not os.path.exists(file):
         raise HTTPException(status_code=404, detail='No file found')
 
-    if request.headers.get('Range') is not None:
-        start_bytes =  int(request.headers.get('Range').strip('bytes=').split("-",1)[0])
-        async def iter(file):
-            async with aiofiles.open(file, mode='rb') as videofile:
-                await videofile.seek(start_bytes)
-                return await videofile.read()
-        return responses.Response(content=await iter(file), status_code=status.HTTP_206_PARTIAL_CONTENT, media_type="video/mp4")
+    # Файлы адресуются по md5, он же служит ETag
+    return range_response(file, f'"{md5hash}"', 'video/mp4',
+                          range_header=request.headers.get('Range'),
+                          if_range=request.headers.get('If-Range'),
+                          if_none_match=request.headers.get('If-None-Match'),
+                          head=request.method == 'HEAD')
+
+
+@app.get("/files/{md5hash}/manifest")
+async def manifest_response(request: Request, md5hash: str):
+    file = os.path.abspath(f'{DATAFILES}/{md5hash}.mp4')
+    if not os.path.exists(file):
+        raise HTTPException(status_code=404, detail='No file found')
 
-    return responses.FileResponse(file, filename = f'{md5hash}.mp4')
+    # Манифест однозначно определяется файлом и размером куска
+    etag = f'"{md5hash}-{manifest_cache.chunk_size}"'
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    payload = await manifest_cache.get(md5hash, file)
+    return Response(content=payload, media_type='application/json', headers={'ETag': etag})
 
 #test
\ No newline at end of file
@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Размер куска манифеста: повторная загрузка при порче - не больше него
+CHUNK_SIZE = 4 * 1024 * 1024
+HASH_NAME = 'md5'
+
+
+def build_manifest(path: str, md5hash: str,
+                   chunk_size: int = CHUNK_SIZE, hash_name: str = HASH_NAME) -> dict:
+    '''Хэши кусков файла фиксированного размера и корень - хэш их
+    конкатенации. md5 всего файла остается идентификатором файла'''
+
+    chunks = []
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            chunks.append(hashlib.new(hash_name, chunk).hexdigest())
+    root = hashlib.new(hash_name, b''.join(bytes.fromhex(digest) for digest in chunks))
+    return {'md5': md5hash, 'size': os.path.getsize(path),
+            'chunk_size': chunk_size, 'hash': hash_name,
+            'chunks': chunks, 'root': root.hexdigest()}
+
+
+class ManifestCache:
+    '''Манифесты файлов в manifests/{md5}.json. Манифест строится один раз
+    при первом запросе и пересобирается, только если файл изменился'''
+
+    def __init__(self, datafiles: str, chunk_size: int = CHUNK_SIZE):
+        self.manifests_dir = os.path.join(datafiles, 'manifests')
+        self.chunk_size = chunk_size
+        self.builds = 0
+        self.hits = 0
+
+        self._payloads: dict[str, tuple[tuple, bytes]] = {}
+        self._building: dict[str, asyncio.Future] = {}
+
+    def _load_or_build(self, path: str, md5hash: str, signature: tuple) -> bytes:
+        manifest_path = os.path.join(self.manifests_dir, f'{md5hash}.json')
+        try:
+            with open(manifest_path, 'rb') as manifest_file:
+                payload = manifest_file.read()
+            manifest = json.loads(payload)
+            if manifest['size'] == signature[1] and manifest['chunk_size'] == self.chunk_size:
+                return payload
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        self.builds += 1
+        payload = json.dumps(build_manifest(path, md5hash, self.chunk_size)).encode('utf-8')
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        tmp_path = f'{manifest_path}.tmp'
+        with open(tmp_path, 'wb') as manifest_file:
+            manifest_file.write(payload)
+        os.replace(tmp_path, manifest_path)
+        logger.info(f"Построен манифест {md5hash}: {signature[1]} байт")
+        return payload
+
+    async def get(self, md5hash: str, path: str) -> bytes:
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._payloads.get(md5hash)
+        if cached is not None and cached[0] == signature:
+            self.hits += 1
+            return cached[1]
+
+        # Одновременные запросы одного файла ждут одну сборку
+        building = self._building.get(md5hash)
+        if building is None:
+            building = asyncio.ensure_future(asyncio.to_thread(
+                self._load_or_build, path, md5hash, signature))
+            self._building[md5hash] = building
+            building.add_done_callback(lambda _: self._building.pop(md5hash, None))
+        payload = await asyncio.shield(building)
+        self._payloads[md5hash] = (signature, payload)
+        return payload
+
+    def stats(self) -> dict:
+        return {'manifests': len(self._payloads), 'builds': self.builds, 'hits': self.hits}
@@ -19,3 +19,14 @@ class MediaMachine(BaseModel):
     ether_mac: str | None = None # optional
     working_dir: str = './scripts/tmp' # common operating dir
     json_file: str = f'{working_dir}/db.json' # local database
+
+
+class Report(BaseModel):
+
+    kind: str  # 'schedule' | 'current' | 'startup'
+    data: dict
+
+
+class ReportsBatch(BaseModel):
+
+    reports: list[Report]
@@ -0,0 +1,41 @@
+from fastapi import WebSocket
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PushManager:
+    '''Открытые WebSocket соединения устройств: {sn: {websocket, ...}}.
+    Сообщения - тот же json, что отдает GET /device/{sn}
+    (schedule, current, delete), либо {'event': 'poll'} - запросить
+    расписание немедленно'''
+
+    def __init__(self):
+        self.connections: dict[str, set[WebSocket]] = {}
+
+    async def connect(self, sn: str, websocket: WebSocket):
+        await websocket.accept()
+        self.connections.setdefault(sn, set()).add(websocket)
+        logger.info(f"Устройство {sn} подключено к push, всего {self.count()}")
+
+    def disconnect(self, sn: str, websocket: WebSocket):
+        sockets = self.connections.get(sn, set())
+        sockets.discard(websocket)
+        if not sockets:
+            self.connections.pop(sn, None)
+
+    async def send(self, sn: str, message: dict) -> int:
+        '''Вернет число устройств, получивших сообщение'''
+
+        delivered = 0
+        for websocket in list(self.connections.get(sn, ())):
+            try:
+                await websocket.send_json(message)
+                delivered += 1
+            except Exception as exception:
+                logger.warning(f"push {sn} не доставлен, {exception=}")
+                self.disconnect(sn, websocket)
+        return delivered
+
+    def count(self) -> int:
+        return sum(len(sockets) for sockets in self.connections.values())
@@ -0,0 +1,148 @@
+import os
+import secrets
+from email.utils import formatdate
+from typing import AsyncIterator
+import anyio
+from fastapi import Response, status
+from fastapi.responses import StreamingResponse
+
+CHUNK_SIZE = 256 * 1024
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str | None, size: int) -> list[tuple[int, int]] | None:
+    '''Разбор Range: bytes=a-b, bytes=a-, bytes=-n и их списка через запятую.
+    Вернет отсортированные непересекающиеся диапазоны [start, end] включительно,
+    None - заголовка нет или синтаксис не распознан (отдается весь файл).
+    RangeNotSatisfiable - ни один диапазон не попадает в файл'''
+
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else max(size - 1, start)
+                if end < start:
+                    return None
+            elif last:
+                # Последние n байт
+                start, end = max(size - int(last), 0), size - 1
+                if not int(last):
+                    continue
+            else:
+                return None
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+    if len(ranges) > MAX_RANGES:
+        # Защита от запросов с множеством мелких диапазонов
+        return None
+
+    # Склеиваем пересекающиеся и смежные диапазоны
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+async def file_chunks(path: str, ranges: list[tuple[int, int]],
+                      chunk_size: int = CHUNK_SIZE,
+                      parts: list[bytes] | None = None,
+                      tail: bytes = b'') -> AsyncIterator[bytes]:
+    '''Чтение диапазонов файла кусками по chunk_size, память на запрос
+    ограничена одним куском. parts - заголовки частей multipart перед
+    каждым диапазоном, tail - завершающая граница'''
+
+    async with await anyio.open_file(path, mode='rb') as file:
+        for index, (start, end) in enumerate(ranges):
+            if parts:
+                yield parts[index]
+            await file.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = await file.read(min(chunk_size, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+    if tail:
+        yield tail
+
+
+def range_response(path: str, etag: str, media_type: str,
+                   range_header: str | None = None,
+                   if_range: str | None = None,
+                   if_none_match: str | None = None,
+                   head: bool = False) -> Response:
+    '''Ответ на GET/HEAD файла с поддержкой Range (RFC 9110):
+    206 с Content-Range для одного диапазона, multipart/byteranges для
+    нескольких, 416 для недостижимых, If-Range и If-None-Match по ETag'''
+
+    stat = os.stat(path)
+    size = stat.st_size
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    headers = {'Accept-Ranges': 'bytes', 'ETag': etag, 'Last-Modified': last_modified}
+
+    if if_none_match is not None and etag in (tag.strip() for tag in if_none_match.split(',')):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # If-Range: диапазон действителен только для той же версии файла
+    if if_range is not None and if_range not in (etag, last_modified):
+        range_header = None
+
+    try:
+        ranges = parse_range(range_header, size)
+    except RangeNotSatisfiable:
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                        headers=headers)
+
+    parts, tail = None, b''
+    if ranges is None:
+        ranges = [(0, size - 1)] if size else []
+        status_code = status.HTTP_200_OK
+        content_length = size
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        content_length = end - start + 1
+    else:
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        boundary = secrets.token_hex(16)
+        parts = [(f'\r\n--{boundary}\r\nContent-Type: {media_type}\r\n'
+                  f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode()
+                 for start, end in ranges]
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        content_length = (sum(len(part) for part in parts) + len(tail)
+                          + sum(end - start + 1 for start, end in ranges))
+        media_type = f'multipart/byteranges; boundary={boundary}'
+
+    headers['Content-Length'] = str(content_length)
+    if head:
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    return StreamingResponse(file_chunks(path, ranges, parts=parts, tail=tail),
+                             status_code=status_code, headers=headers,
+                             media_type=media_type)
@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Меньше этого сжатие не окупается
+GZIP_MIN_SIZE = 1024
+
+
+class CompiledSchedule:
+    # Расписание, готовое к отдаче: байты json, их gzip и ETag
+
+    __slots__ = ('data', 'payload', 'gzipped', 'etag', 'signature')
+
+    def __init__(self, data: dict, signature: tuple):
+        self.data = data
+        self.payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.gzipped = (gzip.compress(self.payload, compresslevel=6)
+                        if len(self.payload) >= GZIP_MIN_SIZE else None)
+        self.etag = f'"{hashlib.md5(self.payload).hexdigest()}"'
+        self.signature = signature
+
+
+class ScheduleCache:
+    '''Расписания групп устройств. Группа описана один раз в
+    groups/{group}/schedule.json, состав групп - в groups.json
+    ({group: [sn, ...]}). Устройство вне групп получает свое
+    devices/{sn}/schedule.json. Каждый файл компилируется в байты один раз
+    и пересобирается, только если изменился (invalidate или mtime/размер)'''
+
+    def __init__(self, datafiles: str):
+        self.datafiles = datafiles
+        self.groups_json = os.path.join(datafiles, 'groups.json')
+        self.compiles = 0
+        self.hits = 0
+
+        self._compiled: dict[str, CompiledSchedule] = {}
+        self._device_group: dict[str, str] = {}
+        self._groups: dict[str, list[str]] = {}
+        self._groups_signature = None
+
+    @staticmethod
+    def _signature(path: str) -> tuple | None:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load_groups(self):
+        signature = self._signature(self.groups_json)
+        if signature == self._groups_signature:
+            return
+        groups = {}
+        if signature is not None:
+            with open(self.groups_json, encoding='utf-8') as groups_file:
+                groups = json.load(groups_file)
+        self._groups = groups
+        self._device_group = {sn: group for group, devices in groups.items() for sn in devices}
+        self._groups_signature = signature
+
+    def group_schedule_path(self, group: str) -> str:
+        return os.path.join(self.datafiles, 'groups', group, 'schedule.json')
+
+    def group_of(self, sn: str) -> str | None:
+        self._load_groups()
+        return self._device_group.get(sn)
+
+    def members(self, group: str) -> list[str]:
+        self._load_groups()
+        return list(self._groups.get(group, []))
+
+    def source_path(self, sn: str) -> str:
+        group = self.group_of(sn)
+        if group is not None:
+            return self.group_schedule_path(group)
+        return os.path.join(self.datafiles, 'devices', sn, 'schedule.json')
+
+    def get(self, sn: str) -> CompiledSchedule | None:
+        '''Скомпилированное расписание устройства, None - файла нет'''
+
+        path = self.source_path(sn)
+        signature = self._signature(path)
+        if signature is None:
+            return None
+        compiled = self._compiled.get(path)
+        if compiled is not None and compiled.signature == signature:
+            self.hits += 1
+            return compiled
+
+        with open(path, 'rb') as schedule:
+            data = json.loads(schedule.read())
+        compiled = self._compile_path(path, data)
+        logger.info(f"Расписание {path} собрано: {len(compiled.payload)} байт, ETag {compiled.etag}")
+        return compiled
+
+    def invalidate(self, path: str):
+        self._compiled.pop(path, None)
+
+    def set_group_schedule(self, group: str, data: dict) -> CompiledSchedule:
+        path = self.group_schedule_path(group)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as schedule:
+            json.dump(data, schedule, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self.invalidate(path)
+        return self._compile_path(path, data)
+
+    def _compile_path(self, path: str, data: dict) -> CompiledSchedule:
+        # Подпись берется после записи, чтобы следующий get не пересобирал
+        compiled = CompiledSchedule(data, self._signature(path))
+        self._compiled[path] = compiled
+        self.compiles += 1
+        return compiled
+
+    def set_group_members(self, group: str, devices: list[str]):
+        self._load_groups()
+        groups = {name: [sn for sn in members if sn not in devices]
+                  for name, members in self._groups.items() if name != group}
+        groups = {name: members for name, members in groups.items() if members}
+        groups[group] = list(devices)
+        tmp_path = f'{self.groups_json}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as groups_file:
+            json.dump(groups, groups_file, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.groups_json)
+        self._groups_signature = None
+
+    def stats(self) -> dict:
+        return {'schedules': len(self._compiled), 'compiles': self.compiles,
+                'hits': self.hits, 'groups': len(self._groups)}
@@ -0,0 +1,197 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS schedule_status (
+    sn TEXT NOT NULL,
+    display TEXT NOT NULL,
+    md5hash TEXT NOT NULL,
+    from_date TEXT NOT NULL,
+    filename TEXT,
+    url TEXT,
+    state TEXT,
+    status INTEGER,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (sn, display, md5hash, from_date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS current_status (
+    sn TEXT NOT NULL,
+    display TEXT NOT NULL,
+    filename TEXT,
+    md5hash TEXT,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (sn, display)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS startup_status (
+    sn TEXT NOT NULL PRIMARY KEY,
+    mode TEXT,
+    display TEXT,
+    since_start REAL,
+    since_boot REAL,
+    updated REAL NOT NULL
+) WITHOUT ROWID;
+'''
+
+UPSERT_SCHEDULE = '''
+INSERT INTO schedule_status (sn, display, md5hash, from_date, filename, url, state, status, error, updated)
+VALUES (:sn, :display, :md5hash, :from_date, :filename, :url, :state, :status, :error, :updated)
+ON CONFLICT (sn, display, md5hash, from_date) DO UPDATE SET
+    filename = excluded.filename, url = excluded.url, state = excluded.state,
+    status = excluded.status, error = excluded.error, updated = excluded.updated
+'''
+
+UPSERT_CURRENT = '''
+INSERT INTO current_status (sn, display, filename, md5hash, error, updated)
+VALUES (:sn, :display, :filename, :md5hash, :error, :updated)
+ON CONFLICT (sn, display) DO UPDATE SET
+    filename = excluded.filename, md5hash = excluded.md5hash,
+    error = excluded.error, updated = excluded.updated
+'''
+
+UPSERT_STARTUP = '''
+INSERT INTO startup_status (sn, mode, display, since_start, since_boot, updated)
+VALUES (:sn, :mode, :display, :since_start, :since_boot, :updated)
+ON CONFLICT (sn) DO UPDATE SET
+    mode = excluded.mode, display = excluded.display, since_start = excluded.since_start,
+    since_boot = excluded.since_boot, updated = excluded.updated
+'''
+
+
+class ReportStore:
+    '''Хранилище отчетов устройств в SQLite (режим WAL).
+    Запись - upsert по ключу (sn, display, md5hash, from_date) для расписания
+    и (sn, display) для текущих файлов, время первого кадра после
+    запуска - одна запись на устройство. Отчеты, пришедшие за commit_delay
+    секунд, фиксируются одной транзакцией; запрос отвечает после фиксации.
+    Все обращения к базе идут в одном потоке, несколько воркеров uvicorn
+    разделяют файл базы через блокировки SQLite (busy_timeout)'''
+
+    def __init__(self, path: str, commit_delay: float = 0.05, busy_timeout: int = 5000):
+        self.path = path
+        self.commit_delay = commit_delay
+        self.busy_timeout = busy_timeout
+        self.commits = 0
+        self.rows_written = 0
+
+        self._connection: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='report-store')
+        self._pending: list[tuple[str, dict, asyncio.Future]] = []
+        self._flush_task: asyncio.Task | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None,
+                                         timeout=self.busy_timeout / 1000)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(f'PRAGMA busy_timeout={self.busy_timeout}')
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _commit(self, batch: list[tuple[str, dict]]):
+        connection = self._connect()
+        # IMMEDIATE сразу берет блокировку записи, без гонки с другими воркерами
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for sql, params in batch:
+                connection.execute(sql, params)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    async def _write(self, sql: str, rows: list[dict]):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for row in rows:
+            future = loop.create_future()
+            self._pending.append((sql, row, future))
+            futures.append(future)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+        await asyncio.gather(*futures)
+
+    async def _flush(self):
+        # Отчеты, пришедшие во время фиксации, уходят следующей транзакцией
+        while self._pending:
+            await asyncio.sleep(self.commit_delay)
+            batch, self._pending = self._pending, []
+            try:
+                await self._run(self._commit, [(sql, params) for sql, params, _ in batch])
+            except Exception as exception:
+                logger.error(f"Отчеты не записаны, {exception=}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(exception)
+                continue
+            self.commits += 1
+            self.rows_written += len(batch)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    async def upsert_schedule(self, sn: str, records: list[dict]):
+        updated = time()
+        await self._write(UPSERT_SCHEDULE, [
+            {'sn': sn, 'updated': updated, 'url': None, 'state': None,
+             'status': None, 'error': None, 'filename': None, **record}
+            for record in records])
+
+    async def upsert_current(self, sn: str, records: list[dict]):
+        updated = time()
+        await self._write(UPSERT_CURRENT, [
+            {'sn': sn, 'updated': updated, 'filename': None, 'md5hash': None,
+             'error': None, **record}
+            for record in records])
+
+    async def upsert_startup(self, sn: str, records: list[dict]):
+        updated = time()
+        await self._write(UPSERT_STARTUP, [
+            {'sn': sn, 'updated': updated, 'since_boot': None, **record}
+            for record in records])
+
+    def _select(self, sql: str, params: tuple) -> list[dict]:
+        return [dict(row) for row in self._connect().execute(sql, params)]
+
+    async def device_status(self, sn: str) -> dict:
+        schedule = await self._run(
+            self._select,
+            'SELECT display, from_date, filename, md5hash, url, state, status, error, updated '
+            'FROM schedule_status WHERE sn = ? ORDER BY display, from_date', (sn,))
+        for record in schedule:
+            if record['status'] is not None:
+                record['status'] = bool(record['status'])
+        current = await self._run(
+            self._select,
+            'SELECT display, filename, md5hash, error, updated '
+            'FROM current_status WHERE sn = ? ORDER BY display', (sn,))
+        startup = await self._run(
+            self._select,
+            'SELECT mode, display, since_start, since_boot, updated '
+            'FROM startup_status WHERE sn = ?', (sn,))
+        return {'current': current, 'schedule': schedule,
+                'startup': startup[0] if startup else None}
+
+    def stats(self) -> dict:
+        return {'commits': self.commits, 'rows_written': self.rows_written,
+                'pending': len(self._pending)}
+
+    async def close(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from ranges import MAX_RANGES, RangeNotSatisfiable, file_chunks, parse_range, range_response
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 99)]),
+    ('bytes=100-', [(100, 999)]),
+    ('bytes=900-5000', [(900, 999)]),
+    ('bytes=-100', [(900, 999)]),
+    ('bytes=-5000', [(0, 999)]),
+    ('BYTES = 0-0', [(0, 0)]),
+    # Пересекающиеся и смежные диапазоны склеиваются, порядок - по началу
+    ('bytes=500-599, 0-99, 50-149', [(0, 149), (500, 599)]),
+    ('bytes=0-99,100-199', [(0, 199)]),
+    ('bytes=0-9,-10', [(0, 9), (990, 999)]),
+    # Недостижимые диапазоны списка отбрасываются
+    ('bytes=0-9,2000-3000', [(0, 9)]),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', [
+    None, '', 'items=0-9', 'bytes=', 'bytes=abc', 'bytes=9-0', 'bytes=-',
+    'bytes=0-9,x-1',
+])
+def test_parse_range_ignored(header):
+    # Нераспознанный заголовок - отдается весь файл
+    assert parse_range(header, 1000) is None
+
+
+def test_parse_range_too_many():
+    header = 'bytes=' + ','.join(f'{index * 10}-{index * 10}' for index in range(MAX_RANGES + 1))
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize('header, size', [
+    ('bytes=1000-', 1000),
+    ('bytes=1000-2000,5000-', 1000),
+    ('bytes=-0', 1000),
+    ('bytes=0-', 0),
+    ('bytes=-10', 0),
+])
+def test_parse_range_not_satisfiable(header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, size)
+
+
+def read_body(response) -> bytes:
+    async def collect():
+        return b''.join([chunk async for chunk in response.body_iterator])
+    return asyncio.run(collect())
+
+
+@pytest.fixture
+def media(tmp_path):
+    path = tmp_path / 'a.mp4'
+    path.write_bytes(bytes(range(256)) * 4)
+    return str(path)
+
+
+def test_range_response_single(media):
+    response = range_response(media, '"aaa"', 'video/mp4', range_header='bytes=-24')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 1000-1023/1024'
+    assert response.headers['Content-Length'] == '24'
+    assert read_body(response) == (bytes(range(256)) * 4)[1000:]
+
+
+def test_range_response_multipart(media):
+    response = range_response(media, '"aaa"', 'video/mp4', range_header='bytes=0-1,10-11')
+    body = read_body(response)
+    assert response.status_code == 206
+    assert response.media_type.startswith('multipart/byteranges; boundary=')
+    assert int(response.headers['Content-Length']) == len(body)
+    assert b'Content-Range: bytes 0-1/1024\r\n\r\n\x00\x01' in body
+    assert b'Content-Range: bytes 10-11/1024\r\n\r\n\x0a\x0b' in body
+
+
+def test_range_response_not_satisfiable(media):
+    response = range_response(media, '"aaa"', 'video/mp4', range_header='bytes=4096-')
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */1024'
+
+
+def test_range_response_if_range_mismatch(media):
+    # Файл сменился - If-Range не совпал, отдается целиком
+    response = range_response(media, '"aaa"', 'video/mp4', range_header='bytes=0-9',
+                              if_range='"old"')
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == '1024'
+
+
+def test_range_response_not_modified(media):
+    response = range_response(media, '"aaa"', 'video/mp4', if_none_match='"bbb", "aaa"')
+    assert response.status_code == 304
+
+
+def test_file_chunks_bounded(media):
+    async def collect():
+        return [chunk async for chunk in file_chunks(media, [(0, 99), (1000, 1023)], chunk_size=64)]
+
+    chunks = asyncio.run(collect())
+    assert [len(chunk) for chunk in chunks] == [64, 36, 24]
@@ -1,59 +1,188 @@
 import asyncio
-from datetime import datetime
 from time import time
 from models.machine import MediaMachine, JsonSections, FileStates
 from models.api_collections import TaskCurrent
+from models.registry import ScheduleRecord
 from system_works import files
-from api_requests import api_requests
+from system_works.downloads import DownloadPriority
 import logging
 
 logger = logging.getLogger(__name__)
 
+PENDING_STATES = (FileStates.SCHEDULED.value, FileStates.CURRENT.value)
+
+
 async def set_schedule(machine: MediaMachine, task: dict):
     '''Ставим статус 'scheduled' заданию из списка задач'''
 
-    tsk = next((x for x in machine.scheduler if all((
-        x['md5hash'] == task.get('md5hash'),
-        x['filename'] == task.get('filename'),
-        x['from_date'] == task['from_date'],
-        x['display'] == task['display']))), None)
+    tsk = machine.scheduler.find(task['display'],
+                                 task['from_date'],
+                                 task.get('md5hash'),
+                                 task.get('filename'))
 
     if tsk is None:
-        machine.scheduler.append(task)
-        tsk = machine.scheduler[-1]
-        tsk['state'] = FileStates.SCHEDULED.value
+        tsk = machine.scheduler.add(ScheduleRecord.from_dict(task))
+        tsk.state = FileStates.SCHEDULED.value
+        # Разбудит планировщик, если задача раньше ближайшей
+        if not machine.scheduler.schedule(tsk):
+            logger.warning(f"Не разобрана дата задачи {tsk.from_date=}")
 
 
-async def start_scheduler(machine: MediaMachine, interval=1):
+def apply_schedule_delta(machine: MediaMachine, delta: dict) -> list[dict]:
+    '''Применяет разницу расписания от сервера прямо к реестру.
+    Вернет добавленные и измененные записи - их нужно скачать
+    и поставить через set_schedule'''
 
-    while True:
-        logger.info("Новый цикл планировщика")
+    for removed in delta.get('removed', []):
+        machine.scheduler.remove_slot(removed.get('display'), removed.get('from_date'))
 
-        for task in machine.scheduler:
-            if (task['state'] in (FileStates.SCHEDULED.value,
-                                FileStates.CURRENT.value)
-                and datetime.strptime(
-                    task['from_date'],
-                    machine.from_date_format) <= datetime.today()):
+    for changed in delta.get('changed', []):
+        for record in machine.scheduler.by_slot(changed.get('display'), changed.get('from_date')):
+            if record.key == ScheduleRecord.from_dict(changed).key:
+                # Тот же файл в том же слоте - сохраняем локальное состояние
+                record.url = changed.get('url', record.url)
+            else:
+                machine.scheduler.remove(record)
 
+    return delta.get('added', []) + delta.get('changed', [])
 
-                res = await files.set_current(
-                                    machine=machine,
-                                    current_task=TaskCurrent(**task)
-                                    )
 
-                # Замена инфо о текущем файле в списке текущих
+def started_slots(machine: MediaMachine, tasks: list[dict], now: float) -> dict[str, float]:
+    '''Начало последней уже наступившей задачи каждого дисплея -
+    по реестру и по новым заданиям сервера (с разобранным due)'''
 
-                if res[0]:
-                    task['state'] = FileStates.CURRENT.value
-                    await files.save_json(machine)
+    latest: dict[str, float] = {}
+    known = [(record.display, record.due) for record in machine.scheduler]
+    for display, due in known + [(task.get('display'), task['due']) for task in tasks]:
+        if due is not None and due <= now and due > latest.get(display, float('-inf')):
+            latest[display] = due
+    return latest
 
-                # отправка отчета серверу?
-                data = task.copy()
-                data.update({'status': res[0], 'error': res[1]})
-                logger.info(f'{task=} {data=}')
-                await api_requests.send_response(data=data, url=f"{machine.srv_url}/device/{machine.info['serial']}/schedule")
-            else:
-                logger.info("Нет подходящих задач")
 
-        await asyncio.sleep(interval*60)
+def needs_download(machine: MediaMachine, task: dict, started: dict[str, float]) -> bool:
+    '''Файл задачи нужен, если она еще не сыграла (не в архиве) и не
+    перекрыта более поздней наступившей задачей того же дисплея.
+    Иначе вытесненный объект скачивался бы заново при каждом полном
+    расписании'''
+
+    record = machine.scheduler.find(task.get('display'), task.get('from_date'),
+                                    task.get('md5hash'), task.get('filename'))
+    if record is not None and record.state == FileStates.ARCHIVED.value:
+        return False
+    return task['due'] >= started.get(task.get('display'), task['due'])
+
+
+def collapse_due(tasks: list[ScheduleRecord]) -> list[ScheduleRecord]:
+    '''Из наступивших задач для каждого дисплея оставляет самую позднюю,
+    более ранние сразу уходят в архив - их переключение все равно
+    перекрылось бы следующей'''
+
+    latest: dict[str, ScheduleRecord] = {}
+    for task in tasks:
+        if task.state not in PENDING_STATES:
+            continue
+        previous = latest.get(task.display)
+        if previous is not None:
+            previous.state = FileStates.ARCHIVED.value
+        latest[task.display] = task
+    return list(latest.values())
+
+
+async def activate(machine: MediaMachine, task: ScheduleRecord, retry_delay: float):
+    task.lateness = max(0.0, time() - task.due)
+    machine.scheduler.lateness.append((task.key, task.lateness))
+    machine.metrics.observe('activation_lateness_seconds', task.lateness)
+    logger.info(f"Активация {task.key}, опоздание {task.lateness:.3f} c")
+
+    res = await files.set_current(
+                        machine=machine,
+                        current_task=TaskCurrent(**task.to_dict())
+                        ) or (False, 'set_current failed')
+
+    # Замена инфо о текущем файле в списке текущих
+
+    if res[0]:
+        task.state = FileStates.CURRENT.value
+        await files.save_json(machine)
+    else:
+        # Повтор, как раньше на следующем цикле
+        machine.scheduler.schedule(task, at=time() + retry_delay)
+
+    # отправка отчета серверу?
+    data = task.to_dict()
+    data.update({'status': res[0], 'error': res[1]})
+    logger.info(f'{task=} {data=}')
+    # Отправка пачками вне цикла планировщика
+    machine.reports.put('schedule', data)
+
+
+async def start_scheduler(machine: MediaMachine, interval=1):
+    '''Событийный планировщик: задачи ждут в куче по времени from_date,
+    сон длится до ближайшей из них или до добавления более ранней.
+    interval (мин) ограничивает сон сверху - страховка от скачков
+    системных часов, например после синхронизации NTP на raspberry'''
+
+    registry = machine.scheduler
+    for task in registry:
+        if task.state in PENDING_STATES:
+            registry.schedule(task)
+
+    while True:
+        registry.wakeup.clear()
+        due_tasks = collapse_due(registry.pop_due(time()))
+        if due_tasks:
+            logger.info(f"Наступили задачи: {len(due_tasks)}")
+        for task in due_tasks:
+            await activate(machine, task, retry_delay=interval*60)
+
+        next_due = registry.next_due()
+        timeout = interval*60 if next_due is None else min(
+            interval*60, max(0.0, next_due - time()))
+        try:
+            await asyncio.wait_for(registry.wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def prefetch_loop(machine: MediaMachine, interval: float = 60):
+    '''Прогрев следующего файла каждого дисплея за lead_time секунд до
+    слота. Если файл к этому времени не скачан, загрузка поднимается
+    в приоритет текущей'''
+
+    prefetcher = machine.prefetch
+    while True:
+        now = time()
+        wake_at = now + interval
+        upcoming = machine.scheduler.upcoming(PENDING_STATES)
+        # Снятые с расписания задачи освобождают бюджет и срочные загрузки
+        for key in set(prefetcher.warmed) | set(prefetcher.fetches) | set(prefetcher.retries):
+            task = upcoming.get(key[0])
+            if task is None or task.md5hash != key[1]:
+                prefetcher.forget(key)
+
+        for display, task in upcoming.items():
+            warm_at = task.due - prefetcher.lead_time
+            if warm_at > now:
+                wake_at = min(wake_at, warm_at)
+                continue
+            key = (display, task.md5hash)
+            current = machine.current.get(display)
+            if prefetcher.is_warmed(key) or current is not None and current.md5hash == task.md5hash:
+                continue
+            if not await machine.fs.exists(machine.store.blob_path(task.md5hash)):
+                # Одна загрузка на ключ, после неудачи - повтор с растущей паузой
+                wait = prefetcher.fetch_wait(key, now)
+                if wait is None:
+                    logger.warning(f"Файл {task.md5hash} для дисплея {display} не готов к слоту, ускоряю загрузку")
+                    prefetcher.track_fetch(key, asyncio.create_task(files.fetch_file(
+                        machine,
+                        url=task.url or f'{machine.srv_url}/files/{task.md5hash}',
+                        filename=task.filename,
+                        md5hash=task.md5hash,
+                        priority=DownloadPriority.CURRENT)))
+                    wait = 1.0
+                wake_at = min(wake_at, now + wait)
+                continue
+            await asyncio.to_thread(prefetcher.warm, key, machine.store.blob_path(task.md5hash))
+        # Новые задачи ставятся не раньше следующей проверки
+        await asyncio.sleep(max(0.5, min(wake_at - now, prefetcher.lead_time / 2)))
@@ -0,0 +1,170 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Any, Callable
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def fsync_dir(path: str):
+    # Запись каталога (переименование, новая ссылка) переживет сбой питания.
+    # Где каталог не открыть или не синхронизировать (не POSIX) - пропускаем
+    try:
+        fd = os.open(path or '.', os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def commit_file(src: str, dst: str, durable: bool = True):
+    '''Атомарная публикация готового файла: данные на диск, rename поверх
+    dst, затем fsync каталога dst, чтобы rename не откатился при сбое'''
+
+    if durable:
+        fd = os.open(src, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    os.replace(src, dst)
+    if durable:
+        fsync_dir(os.path.dirname(dst))
+
+
+def swap_symlink(target: str, link: str, durable: bool = True):
+    '''Атомарная замена символьной ссылки: временная ссылка рядом
+    и rename поверх старой. Читатель видит старую или новую ссылку,
+    но никогда ее отсутствие'''
+
+    tmp_link = f'{link}.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link)
+    if durable:
+        fsync_dir(os.path.dirname(link))
+
+
+def readlink_or_none(link: str) -> str | None:
+    try:
+        return os.readlink(link)
+    except OSError:
+        return None
+
+
+def remove_existing(paths: list[str]) -> list[str]:
+    # Вернет удаленные пути
+    removed = []
+    for path in paths:
+        try:
+            os.remove(path)
+            removed.append(path)
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+def create_empty(path: str):
+    with open(path, 'wb'):
+        pass
+
+
+def scan_files(path: str) -> list[tuple[str, str, os.stat_result]]:
+    # (имя, путь, stat) обычных файлов каталога за один проход
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                files.append((entry.name, entry.path, entry.stat(follow_symlinks=False)))
+    return files
+
+
+class OpStats:
+    # Число вызовов, суммарная и наибольшая задержка операции, сек
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+class AsyncFS:
+    '''Операции с файловой системой вне цикла событий. На SD-карте под
+    записью rename, unlink или даже stat может ждать десятки миллисекунд,
+    поэтому все они идут в отдельный пул потоков (не общий to_thread,
+    где их задержат подсчет хэшей и запись состояния). Несколько
+    метаданных-операций одного действия отправляются одним batch -
+    один переход в пул вместо нескольких. Задержка каждой операции
+    (с ожиданием в очереди пула) копится в ops'''
+
+    def __init__(self, workers: int = 2, durable: bool = True):
+        self.workers = workers
+        self.durable = durable
+        self.ops: dict[str, OpStats] = {}
+
+        self._executor: ThreadPoolExecutor | None = None
+
+    async def call(self, op: str, func: Callable, *args) -> Any:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix='fs')
+        started = monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.ops.setdefault(op, OpStats()).observe(monotonic() - started)
+
+    async def batch(self, op: str, calls: list[tuple[Callable, tuple]]) -> list:
+        '''Несколько вызовов за один переход в пул, по порядку.
+        Исключение прерывает пачку'''
+
+        def run():
+            return [func(*args) for func, args in calls]
+
+        return await self.call(op, run)
+
+    async def exists(self, path: str) -> bool:
+        return await self.call('exists', os.path.exists, path)
+
+    async def stat(self, path: str) -> os.stat_result:
+        return await self.call('stat', os.stat, path)
+
+    async def readlink(self, link: str) -> str | None:
+        return await self.call('readlink', readlink_or_none, link)
+
+    async def remove(self, *paths: str) -> list[str]:
+        return await self.call('remove', remove_existing, list(paths))
+
+    async def scan(self, path: str) -> list[tuple[str, str, os.stat_result]]:
+        return await self.call('scan', scan_files, path)
+
+    async def commit_download(self, src: str, dst: str):
+        await self.call('commit_download', commit_file, src, dst, self.durable)
+
+    async def swap_symlink(self, target: str, link: str):
+        await self.call('swap_symlink', swap_symlink, target, link, self.durable)
+
+    def stats(self) -> dict:
+        return {op: {'count': stats.count,
+                     'mean_ms': round(stats.total / stats.count * 1000, 3) if stats.count else 0.0,
+                     'max_ms': round(stats.max * 1000, 3)}
+                for op, stats in self.ops.items()}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
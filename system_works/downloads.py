@@ -0,0 +1,142 @@
+import asyncio
+import itertools
+import logging
+from collections import deque
+from enum import IntEnum
+from time import monotonic
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadPriority(IntEnum):
+    # Меньшее значение - раньше в очереди
+
+    CURRENT = 0
+    SCHEDULED = 1
+
+
+class DownloadJob:
+    __slots__ = ('key', 'factory', 'priority', 'future',
+                 'enqueued_at', 'started')
+
+    def __init__(self, key: str, factory: Callable[[], Awaitable[Any]],
+                 priority: tuple, future: asyncio.Future):
+        self.key = key
+        self.factory = factory
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = monotonic()
+        self.started = False
+
+
+class DownloadManager:
+    '''Очередь загрузок с ограничением числа одновременных передач.
+    Задачи немедленной постановки (current) идут первыми, затем задачи
+    расписания по возрастанию from_date. Повторный запрос того же md5
+    не создает новую загрузку, а получает результат уже поставленной'''
+
+    def __init__(self,
+                 concurrency: int = 2,
+                 segments: int = 4,
+                 min_segment_size: int = 32*1024*1024,
+                 wait_history: int = 100):
+        self.concurrency = concurrency
+        # Параметры сегментной загрузки больших файлов в get_file
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.wait_times = deque(maxlen=wait_history)
+        self._jobs: dict[str, DownloadJob] = {}
+        self._queue: asyncio.PriorityQueue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < self.concurrency:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    def submit(self,
+               key: str,
+               factory: Callable[[], Awaitable[Any]],
+               priority: DownloadPriority = DownloadPriority.SCHEDULED,
+               due: float = 0.0) -> asyncio.Future:
+        '''Ставит загрузку в очередь. key - md5 файла, factory - корутинная
+        функция без аргументов, выполняющая загрузку. Вернет future
+        с результатом factory, общий для всех запросов того же key.
+        Future защищен shield: отмена одного ждущего не отменяет загрузку
+        для остальных'''
+
+        self._ensure_workers()
+        new_priority = (int(priority), due)
+        job = self._jobs.get(key)
+        if job is not None:
+            self.deduplicated += 1
+            if not job.started and new_priority < job.priority:
+                # Поднимаем приоритет, старая запись в очереди станет неактуальной
+                job.priority = new_priority
+                self._queue.put_nowait((new_priority, next(self._seq), job))
+            return asyncio.shield(job.future)
+
+        job = DownloadJob(key, factory, new_priority,
+                          asyncio.get_running_loop().create_future())
+        self._jobs[key] = job
+        self._queue.put_nowait((new_priority, next(self._seq), job))
+        return asyncio.shield(job.future)
+
+    async def _worker(self):
+        while True:
+            priority, _, job = await self._queue.get()
+            if job.started or job.priority != priority:
+                self._queue.task_done()
+                continue
+
+            job.started = True
+            self.wait_times.append(monotonic() - job.enqueued_at)
+            self.active += 1
+            try:
+                result = await job.factory()
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as exception:
+                self.failed += 1
+                logger.exception(f"Загрузка {job.key} завершилась ошибкой {exception=}")
+                if not job.future.done():
+                    job.future.set_result(None)
+            else:
+                self.completed += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.active -= 1
+                self._jobs.pop(job.key, None)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        waiting = [job for job in self._jobs.values() if not job.started]
+        now = monotonic()
+        return {
+            'queue_depth': len(waiting),
+            'active': self.active,
+            'concurrency': self.concurrency,
+            'completed': self.completed,
+            'failed': self.failed,
+            'deduplicated': self.deduplicated,
+            'oldest_wait': max((now - job.enqueued_at for job in waiting), default=0.0),
+            'avg_wait': (sum(self.wait_times) / len(self.wait_times)
+                         if self.wait_times else 0.0),
+            'active_keys': [job.key for job in self._jobs.values() if job.started],
+            }
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
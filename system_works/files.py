@@ -1,12 +1,14 @@
 import asyncio
-import json
-import hashlib
 import os
-from datetime import datetime
-import aiofiles
-from api_requests import api_requests
+import aiohttp
+from time import time, monotonic
+from api_requests import api_requests, segmented
+from api_requests.manifest import ChunkRepairError
 from models.machine import MediaMachine, FileStates
 from models.api_collections import TaskCurrent
+from models.registry import FileRegistry
+from system_works.downloads import DownloadPriority
+from system_works.async_fs import readlink_or_none
 import logging
 from functools import wraps
 
@@ -25,35 +27,120 @@ def async_log_exception_wrapper(func):
 
     return log_exception_wrapper
 
-def move_to_working_dir(file_task: asyncio.Task, machine: MediaMachine):
-    # Перенос файла в рабочую директорию с проверкой
+async def move_to_working_dir(machine: MediaMachine, result: tuple | None):
+    '''Перенос проверенного файла из директории загрузки в рабочую.
+    result - кортеж (хэш совпал, имя файла, хэш) от get_file'''
 
-    if not file_task.result()[0]:
+    if not result or not result[0]:
         logger.info("Hash not compared, aborting")
         return False
     else:
-        md5hash, filename = file_task.result()[2], file_task.result()[1]
-
-    file_handling_event = machine.get_event(filename)
-    logger.info(f"Переношу, {filename, file_handling_event}")
-    if not file_handling_event.is_set():
-        logger.warning(f"переношу - {filename}, Файл уже кто-то качает.Выхожу")
-        return
+        md5hash, filename = result[2], result[1]
 
+    logger.info(f"Переношу {filename}")
     src_path = os.path.abspath(f'{machine.downloading_dir}/{filename}')
-    dst_path = os.path.abspath(f'{machine.working_dir}/{filename}')
-    if os.path.exists(dst_path):
-        os.remove(dst_path)
-    os.rename(src=src_path, dst=dst_path)
+    # Содержимое ложится в objects/<md5>, имя в рабочей директории - ссылка на него.
+    # Занятый файл (хэш, удаление) ждем, а не пропускаем перенос
+    async with machine.locks.exclusive(filename):
+        dst_path, stat = await machine.store.place(src_path, md5hash, filename)
+    machine.storage.touch(md5hash)
+    # inode и mtime объекта сохраняются - запоминаем уже проверенный хэш
+    machine.hash_cache.store(dst_path, stat, md5hash)
 
     # Ниже - обновление записи в списке рабочих файлов. Мб стоит отсюда вынести
-    record = next((rec for rec in machine.files
-                   if rec.get('filename') == filename
-                   and rec.get('md5hash') == md5hash), None)
-    if record is None:
-        machine.files.append({'filename': filename, 'md5hash': md5hash})
+    machine.files.add(filename, md5hash)
     return True
 
+
+async def add_file_alias(machine: MediaMachine, filename: str, md5hash: str) -> bool:
+    '''Файл с тем же хэшем уже есть в хранилище -
+    делаем жесткую ссылку на объект вместо повторной загрузки'''
+
+    aliased = await machine.store.alias(md5hash, filename)
+    if aliased is None:
+        return False
+    machine.hash_cache.store(*aliased, md5hash)
+    machine.files.add(filename, md5hash)
+    return True
+
+
+async def download_and_commit(machine: MediaMachine, url, filename, md5hash):
+    started = monotonic()
+    result = await _download_from_sources(machine, url, filename, md5hash)
+    if result and result[0]:
+        duration = monotonic() - started
+        size = (await machine.fs.stat(machine.store.blob_path(md5hash))).st_size
+        machine.metrics.inc('download_bytes_total', size)
+        machine.metrics.observe('download_seconds', duration)
+        machine.metrics.observe('download_bytes_per_second', size / max(duration, 1e-6))
+    else:
+        machine.metrics.inc('download_failures_total')
+    return result
+
+
+async def _download_from_sources(machine: MediaMachine, url, filename, md5hash):
+    # Сначала соседи по площадке, затем сервер. get_file сверяет хэш
+    # и удаляет файл при несовпадении, поэтому источнику можно не доверять
+    for peer_url in machine.peers.sources(md5hash):
+        try:
+            result = await api_requests.get_file(machine=machine,
+                                                 url=peer_url,
+                                                 filename=filename,
+                                                 md5hash=md5hash)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ChunkRepairError) as exception:
+            logger.info(f"Сосед {peer_url} не отдал {filename}, {exception=}")
+            result = None
+            # Недокачанное от соседа не докачиваем с другого источника
+            downloading_path = os.path.abspath(f'{machine.downloading_dir}/{filename}')
+            await machine.fs.remove(downloading_path, segmented.state_path(downloading_path))
+            machine.partial_hashes.pop(downloading_path, None)
+        if result and result[0]:
+            machine.peers.peer_hits += 1
+            machine.peers.bytes_from_peers += (await machine.fs.stat(
+                os.path.abspath(f'{machine.downloading_dir}/{filename}'))).st_size
+            logger.info(f"{filename} получен от соседа {peer_url}")
+            await move_to_working_dir(machine, result)
+            return result
+        machine.peers.peer_failures += 1
+        machine.peers.forget(peer_url)
+
+    machine.peers.origin_fetches += 1
+    result = await api_requests.get_file(machine=machine,
+                                         url=url,
+                                         filename=filename,
+                                         md5hash=md5hash)
+    await move_to_working_dir(machine, result)
+    return result
+
+
+@async_log_exception_wrapper
+async def fetch_file(machine: MediaMachine,
+                     url,
+                     filename,
+                     md5hash,
+                     priority: DownloadPriority = DownloadPriority.SCHEDULED,
+                     due: float = 0.0):
+    '''Постановка загрузки в общую очередь machine.downloads.
+    Загрузки одного md5 объединяются в одну, уже хранящийся объект
+    не загружается вовсе'''
+
+    if await add_file_alias(machine, filename, md5hash):
+        logger.info(f"{filename}: объект {md5hash} уже в хранилище, загрузка не нужна")
+        machine.storage.touch(md5hash)
+        return (True, filename, md5hash)
+
+    result = await machine.downloads.submit(
+        md5hash,
+        lambda: download_and_commit(machine, url, filename, md5hash),
+        priority=priority,
+        due=due)
+
+    if result and result[0] and result[1] != filename:
+        await add_file_alias(machine, filename, md5hash)
+        result = (True, filename, md5hash)
+    return result
+
+
 @async_log_exception_wrapper
 async def create_link(machine: MediaMachine, current_task: TaskCurrent):
 
@@ -61,12 +148,15 @@ async def create_link(machine: MediaMachine, current_task: TaskCurrent):
     md5hash = current_task.md5hash
     display = current_task.display
     link = os.path.abspath(f'{machine.working_dir}/{current_task.display}_media.mp4')
-    file_path = os.path.abspath(f'{machine.working_dir}/{filename}')
+    file_path = machine.store.blob_path(md5hash)
     err = None
 
-    # проверка наличия и корректности ссылки на файл
-    if os.path.exists(link) and os.readlink(link) == file_path:
-        return (False, f'{link} is set already')
+    # проверка наличия и корректности ссылки на файл, одним переходом в пул fs
+    link_exists, link_target = await machine.fs.batch('check_link', [
+        (os.path.exists, (link,)), (readlink_or_none, (link,))])
+    if link_exists and link_target == file_path:
+        machine.startup.frame(machine, display)
+        return (True, f'{link} is set already')
 
     if display is None or display not in machine.info['displays']:
         result = (False, f'ValueError: No such display {display}')
@@ -74,6 +164,7 @@ async def create_link(machine: MediaMachine, current_task: TaskCurrent):
         return result
 
         # Остановка сервиса проигрывания
+    switch_started = monotonic()
     try:
         process = await asyncio.create_subprocess_exec('sudo', 'systemctl',
                                              'stop', machine.service_name)
@@ -85,33 +176,22 @@ async def create_link(machine: MediaMachine, current_task: TaskCurrent):
         logger.exception(e)
         # Замена ссылки. Начало ---------------
 
-    if os.path.islink(link):
-        os.remove(link)
-    os.symlink(file_path, link)
+    await machine.store.switch_display(md5hash, display, link)
+    machine.storage.touch(md5hash)
 
     # Обновление ссылки в бд файлов:
-    current = next((task
-                    for task in machine.current
-                    if task.get('display', None) == display), None)
+    current = machine.current.set(display, filename, md5hash)
 
     if current:
         # Помечаем в планировщике что файл уже игрался
-        for task in machine.scheduler:
-            if (set(current.items()).issubset(task.items())
-                and datetime.strptime(task['from_date'],
-                                      machine.from_date_format) < datetime.today()):
-
-                task['state'] = FileStates.ARCHIVED.value
-
-        # ------
-        machine.current.remove(current)
-    machine.current.append({'display': display,
-                            'filename': filename,
-                            'md5hash': md5hash})
-
-    for record in machine.files:
-        if record['filename'] == f"{display}_media.mp4":
-            record['md5hash'] = md5hash
+        for task in machine.scheduler.by_display_md5(display, current.md5hash):
+            if (task.filename == current.filename
+                and task.due is not None and task.due < time()):
+
+                task.state = FileStates.ARCHIVED.value
+
+    if machine.files.get(f"{display}_media.mp4") is not None:
+        machine.files.add(f"{display}_media.mp4", md5hash)
     # Замена ссылки. Конец ---------------------
     # Запуск сервиса проигрывания
     try:
@@ -125,6 +205,11 @@ async def create_link(machine: MediaMachine, current_task: TaskCurrent):
         err = f"Service start error: {machine.service_name}: {type(e).__name__}"
         logger.error(f"Ошибка при запуске службы {machine.service_name}: {e}")
         logger.exception(e)
+    # Пауза от остановки до запуска проигрывания нового файла
+    switch_gap = monotonic() - switch_started
+    machine.prefetch.record_switch(display, md5hash, switch_gap)
+    machine.metrics.observe('switch_gap_seconds', switch_gap, display=display)
+    machine.startup.frame(machine, display)
     return (True, err)
 
 @async_log_exception_wrapper
@@ -142,56 +227,49 @@ async def delete_file(machine: MediaMachine,
         err = f'{ValueError("Ничего не передано для удаления")}'
         return (False, err)
     elif md5hash is None:
-        record = next((file
-                       for file in machine.files
-                       if file['filename'] == filename), {})
-        md5hash = record.get('md5hash', None)
+        record = machine.files.get(filename)
+        md5hash = record.md5hash if record else None
+        records = [record] if record else []
     elif filename is None:
-        record = next((file
-                       for file in machine.files
-                       if file['md5hash'] == md5hash), {})
-        filename = record.get('filename', md5hash)
+        # Удаление по хэшу - удаляются все имена этого содержимого
+        records = machine.files.by_md5(md5hash)
+        filename = records[0].filename if records else md5hash
     else:
-        record = next((file
-                       for file in machine.files
-                       if file['md5hash'] == md5hash
-                       and file['filename'] == filename), {})
+        record = machine.files.get(filename)
+        records = [record] if record is not None and record.md5hash == md5hash else []
 
     # ниже механизм  предотвращения одновременного доступа к файлу
     # функций: загрузки (get_file), расчета хэша (get_md5hash) и удаления
-    file_handling_event = machine.get_event(filename)
-    logger.info(f"Файл к удалению: {filename}, Жду события. Событие - {file_handling_event}")
-    await file_handling_event.wait()
-    file_handling_event.clear()
-    # --------------
-
-    if md5hash in (file['md5hash'] for file in machine.current):
-        err = f'''{ValueError(
-            "Я функция delete_file, Удалить невозможно: Указанный файл проигрывается в данный момент."
-            )}'''
-        logger.error(err)
-        file_handling_event.set()
-        return (False, err)
-
-    files_to_delete = [
-        os.path.abspath(f'{machine.downloading_dir}/{filename}'),
-        os.path.abspath(f'{machine.working_dir}/{filename}')
-        ]
-
-    try:
-        if record in machine.files:
-            machine.files.remove(record)
-        for file in files_to_delete:
-            if os.path.exists(file):
-                os.remove(file)
+    logger.info(f"Файл к удалению: {filename}, Жду блокировки. {machine.locks.stats()}")
+    async with machine.locks.exclusive(filename):
+        if machine.current.is_playing(md5hash):
+            err = f'''{ValueError(
+                "Я функция delete_file, Удалить невозможно: Указанный файл проигрывается в данный момент."
+                )}'''
+            logger.error(err)
+            return (False, err)
+
+        files_to_delete = [
+            os.path.abspath(f'{machine.downloading_dir}/{filename}'),
+            os.path.abspath(f'{machine.working_dir}/{filename}')
+            ]
 
-        logger.info(f'Я функция delete_file, {filename} удален')
-    except Exception as e:
-        err = f'{type(e).__name__}, {e}'
-        logger.error('Я функция delete_file, ошиблась:', err)
-        logging.exception(e)
+        try:
+            for record in records:
+                machine.files.remove(record.filename)
+                # Снимаем ссылку имени, объект удаляется вместе с последней
+                await machine.store.release(record.md5hash, record.filename)
+                machine.hash_cache.discard(os.path.abspath(f'{machine.working_dir}/{record.filename}'))
+            await machine.fs.remove(*files_to_delete)
+            for file in files_to_delete:
+                machine.hash_cache.discard(file)
+
+            logger.info(f'Я функция delete_file, {filename} удален')
+        except Exception as e:
+            err = f'{type(e).__name__}, {e}'
+            logger.error('Я функция delete_file, ошиблась:', err)
+            logging.exception(e)
 
-    file_handling_event.set()
     await save_json(machine)
 
     return bool(err is None), err
@@ -199,29 +277,104 @@ async def delete_file(machine: MediaMachine,
 @async_log_exception_wrapper
 async def get_files_list_from_dir(
                             machine: MediaMachine,
-                            extensions: str | list[str] | tuple[str] = 'mp4'
+                            extensions: str | list[str] | tuple[str] = 'mp4',
+                            rebuild_store: bool = True
                             ):
+    '''Собирает список файлов рабочей директории с их хэшами. Хэш
+    считается заново только для файлов, чья сигнатура stat не совпала
+    с записью в кэше хэшей. rebuild_store=False - счетчики хранилища
+    пересобирает вызывающий'''
 
     path = machine.working_dir
     if isinstance(extensions, str):
         extensions = list(ex.strip() for ex in extensions.split(','))
-    names = [os.path.abspath(file)
-             for file in os.listdir(path)
-             if (file.split('.')[-1] in extensions)
-             and not os.path.islink(f'{path}/{file}')]
+
+    cache = machine.hash_cache
+    cache.reset_counters()
+    files = []
+    seen_paths = set()
+    to_hash = []
+    # Обход и stat всех файлов - один переход в пул fs
+    for name, entry_path, stat in await machine.fs.scan(path):
+        if name.split('.')[-1] not in extensions:
+            continue
+        seen_paths.add(entry_path)
+        md5hash = cache.lookup(entry_path, stat)
+        if md5hash is None:
+            to_hash.append((name, entry_path, stat))
+        else:
+            files.append({'filename': name, 'md5hash': md5hash})
 
     hash_tasks = [asyncio.create_task(
                                     get_md5(
                                         machine,
-                                        os.path.split(name)[-1],
+                                        name,
                                         dir_path=machine.working_dir
                                         )
-                                    ) for name in names]
+                                    ) for name, _, _ in to_hash]
 
     await asyncio.gather(*hash_tasks)
-    files = [{'filename': task.result()[1], 'md5hash': task.result()[2]} for task in hash_tasks]
+    for (_, entry_path, stat), task in zip(to_hash, hash_tasks):
+        if task.result() is None:
+            continue
+        _, filename, md5hash = task.result()
+        cache.store(entry_path, stat, md5hash)
+        files.append({'filename': filename, 'md5hash': md5hash})
+
+    cache.prune(seen_paths)
+    logger.info(f"Кэш хэшей: попаданий {cache.hits}, промахов {cache.misses}, "
+                f"подсчет: {machine.hasher.stats()}")
+    await machine.persistence.flush_hooks()
+
+    if rebuild_store:
+        await machine.store.reindex([(file['filename'], file['md5hash']) for file in files])
+        logger.info(f"Хранилище объектов: {machine.store.stats()}")
+
+    return FileRegistry.from_list(files)
 
-    return files
+
+@async_log_exception_wrapper
+async def restore_playback(machine: MediaMachine):
+    '''Ссылки дисплеев по machine.current, восстановленному из db.json.
+    Целая ссылка - дисплей уже показывает файл, битая пересоздается,
+    если объект есть в хранилище. Остальное сделает планировщик'''
+
+    for record in list(machine.current):
+        if not await machine.fs.exists(machine.store.blob_path(record.md5hash)):
+            logger.warning(f"Объекта {record.md5hash} дисплея {record.display} нет, жду расписания")
+            continue
+        await create_link(machine, TaskCurrent(
+            display=record.display,
+            md5hash=record.md5hash,
+            url=f'{machine.srv_url}/files/{record.md5hash}'))
+
+
+@async_log_exception_wrapper
+async def reconcile_files(machine: MediaMachine, delay: float = 0):
+    '''Фоновая сверка списка файлов, восстановленного из db.json, с
+    диском после быстрого старта: пересчет хэшей измененных файлов и
+    счетчиков хранилища'''
+
+    await asyncio.sleep(delay)
+    started = monotonic()
+    scanned = await get_files_list_from_dir(machine=machine, rebuild_store=False)
+    # Файлы, удаленные и перенесенные в рабочую директорию во время сверки
+    records = list(scanned) + [record for record in machine.files
+                               if scanned.get(record.filename) is None]
+    present = await machine.fs.batch('exists', [
+        (os.path.exists, (os.path.join(machine.working_dir, record.filename),))
+        for record in records])
+    for record, exists in zip(records, present):
+        if not exists:
+            scanned.remove(record.filename)
+        elif scanned.get(record.filename) is None:
+            scanned.add(record.filename, record.md5hash)
+    machine.files = scanned
+    await machine.store.reindex([(record.filename, record.md5hash) for record in scanned])
+    machine.persistence.request_save()
+    machine.metrics.observe('reconcile_seconds', monotonic() - started)
+    logger.info(f"Сверка файлов за {monotonic() - started:.3f} c, "
+                f"файлов {len(scanned)}, хранилище: {machine.store.stats()}")
 
 @async_log_exception_wrapper
 async def get_md5(machine: MediaMachine,
@@ -230,80 +383,59 @@ async def get_md5(machine: MediaMachine,
                   md5hash=None,
                   dir_path=None
                   ) -> tuple[bool, str]:
-    '''Функция для асинхронного подсчета хэша мд5 кусками
-    (chunk_size) значения в МБ). Вернет кортеж результата
-    сравнения с переданным хэшем, имя файла, и его хэш}'''
+    '''Функция для асинхронного подсчета хэша мд5 через machine.hasher
+    (весь файл за одно обращение к пулу потоков, chunk_size оставлен для
+    совместимости). Вернет кортеж результата сравнения с переданным
+    хэшем, имя файла, и его хэш}'''
 
     await asyncio.sleep(0)
     if dir_path is None:
         dir_path = machine.downloading_dir
-    file_handling_event = machine.get_event(filename)
-    await file_handling_event.wait()
-    file_handling_event.clear()
-
-    chunk_size *= 1024*1024
-    filehash = hashlib.md5()
     full_path = os.path.abspath(f'{dir_path}/{filename}')
-    if not os.path.exists(full_path):
-        file_handling_event.set()
-        return (False, filename, 'broken_link')
-
-    async with aiofiles.open(full_path, 'rb') as afile:
-
-        while True:
-            task = asyncio.create_task(afile.read(chunk_size))
-            chunk = await task
-            if not chunk:
-                break
-            await asyncio.to_thread(filehash.update, chunk)
-
-    file_handling_event.set()
+    # Хэш одного файла могут считать несколько читателей сразу,
+    # загрузка и удаление ждут их окончания
+    async with machine.locks.shared(filename):
+        try:
+            hashed = (await machine.fs.stat(full_path)).st_size
+        except FileNotFoundError:
+            return (False, filename, 'broken_link')
+        started = monotonic()
+        digest = await machine.hasher.hash_file(full_path)
+    machine.metrics.inc('hash_bytes_total', hashed)
+    machine.metrics.observe('hash_bytes_per_second', hashed / max(monotonic() - started, 1e-6))
 
     md5hash = filename.split('.', 1)[0] if md5hash is None else md5hash
 
-    logger.info(f"Cообщаю: {(md5hash == filehash.hexdigest(), filename, filehash.hexdigest())}")
-    return (md5hash == filehash.hexdigest(), filename, filehash.hexdigest())
+    logger.info(f"Cообщаю: {(md5hash == digest, filename, digest)}")
+    return (md5hash == digest, filename, digest)
 
 @async_log_exception_wrapper
 async def save_json(machine: MediaMachine):
-    async with aiofiles.open(
-        os.path.abspath(
-            f'{machine.working_dir}/{machine.db_json}'),
-            mode='w') as db_json:
-        full_json = json.dumps({
-            'info': machine.info,
-            'current': machine.current,
-            'files': machine.files,
-            'schedule': machine.scheduler
-            }, indent=2)
-        await db_json.write(full_json)
+    '''Запрос на сохранение db.json. Запись отложенная и атомарная,
+    частые вызовы склеиваются в одну (см. StatePersistence)'''
+
+    machine.persistence.request_save()
     return
 
 @async_log_exception_wrapper
 async def get_check_hash_and_move_file(machine: MediaMachine,
                                        current_task: TaskCurrent):
+    '''Объект текущего задания в хранилище, при отсутствии - загрузка.
+    Вернет (хэш совпал, имя файла, хэш) или None, если файл не получен'''
+
     filename = f'{current_task.md5hash}.mp4'
-    file_path = os.path.abspath(f'{machine.working_dir}/{filename}')
-    # Проверка наличия файла в рабочей директории
-    if not os.path.exists(file_path):
-        url = current_task.url
-        if url is None:
-            url = f'{machine.srv_url}/files/{current_task.md5hash}'
-        # Получаем файл
-
-        #raise Exception('test exception')
-        await api_requests.get_file(machine,
-                                        url=url,
-                                        filename=filename)
-
-        # Проверяем хэш
-        hash_task = asyncio.create_task(get_md5(machine,
-                                                filename,
-                                                md5hash=current_task.md5hash))
-        # Перемещаем в рабочую директорию
-        hash_task.add_done_callback(
-            lambda task: move_to_working_dir(task, machine))
-        await hash_task
+    # Проверка наличия объекта в хранилище
+    if await machine.fs.exists(machine.store.blob_path(current_task.md5hash)):
+        return (True, filename, current_task.md5hash)
+    url = current_task.url
+    if url is None:
+        url = f'{machine.srv_url}/files/{current_task.md5hash}'
+    # Получаем файл вне очереди расписания, хэш считается по ходу загрузки
+    return await fetch_file(machine,
+                            url=url,
+                            filename=filename,
+                            md5hash=current_task.md5hash,
+                            priority=DownloadPriority.CURRENT)
 
 @async_log_exception_wrapper
 async def set_current(machine: MediaMachine,
@@ -315,30 +447,24 @@ async def set_current(machine: MediaMachine,
 
     # link = os.path.abspath(f'{machine.working_dir}/{current_task.display}_media.mp4')
     logger.info(f'{machine.__dict__=} {current_task.__dict__=} ')
-    await get_check_hash_and_move_file(machine=machine, current_task=current_task)
-    err = None
-
-
-    # Должен быть ответ серверу, что хэш не сошелся
-    ''' ... или нет
-    if not hash_task.result()[0]:
-        err = f'{ValueError("Hash invalid or None")}'
-    responce_data = dict(current_task)
-    responce_data.update({'error': err})
-
-    await api_requests.send_response(data=responce_data, url=f"{machine.srv_url}/device/{machine.info['serial']}/current")
-    '''
+    checked = await get_check_hash_and_move_file(machine=machine, current_task=current_task)
+    if not checked or not checked[0]:
+        # Ссылку дисплея на отсутствующий или чужой объект не ставим
+        err = f'{RuntimeError(f"File {current_task.md5hash} not downloaded or hash mismatch")}'
+        logger.error(err)
+        return (False, err)
 
     # Замена ссылки
     #Добавить условие, что ссылка не та же
-    await create_link(machine=machine, current_task=current_task)
+    result = await create_link(machine=machine, current_task=current_task)
 
     # Обновление БД
     await save_json(machine)
 
     # Отправка серверу отчета об успешной замене
 
-    result = (True, err) if err else (False, err)
+    if result is None:
+        result = (False, f'{RuntimeError("create_link failed")}')
     return result
 
 
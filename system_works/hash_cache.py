@@ -0,0 +1,84 @@
+import json
+import os
+from functools import partial
+from typing import Callable
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HashCache:
+    '''Персистентный индекс хэшей медиафайлов.
+    Ключ записи - путь к файлу, значение - сигнатура stat (inode, size,
+    mtime_ns) и посчитанный по ней md5. Файл перехэшируется только если
+    его сигнатура изменилась'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    @staticmethod
+    def signature(stat: os.stat_result) -> list[int]:
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as cache_file:
+                self.entries = json.load(cache_file)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as exception:
+            logger.warning(f"Кэш хэшей {self.path} не прочитан, {exception=}")
+            self.entries = {}
+
+    def lookup(self, path: str, stat: os.stat_result) -> str | None:
+        '''Вернет md5 из кэша, если сигнатура файла не менялась'''
+
+        entry = self.entries.get(path)
+        if entry is not None and entry.get('signature') == self.signature(stat):
+            self.hits += 1
+            return entry.get('md5hash')
+        self.misses += 1
+        return None
+
+    def store(self, path: str, stat: os.stat_result, md5hash: str):
+        self.entries[path] = {'signature': self.signature(stat),
+                              'md5hash': md5hash}
+        self.dirty = True
+
+    def discard(self, path: str):
+        if self.entries.pop(path, None) is not None:
+            self.dirty = True
+
+    def prune(self, existing: set[str]):
+        '''Удаляет записи о файлах, которых больше нет на диске'''
+
+        for path in set(self.entries) - existing:
+            self.discard(path)
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def save_job(self) -> Callable[[], None] | None:
+        '''Снимок записей в цикле событий и запись его для пула потоков.
+        None - сохранять нечего'''
+
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return partial(self.write, dict(self.entries))
+
+    def write(self, entries: dict[str, dict]):
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, mode='w', encoding='utf-8') as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            # Следующее сохранение повторит запись
+            self.dirty = True
+            raise
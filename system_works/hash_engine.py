@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HashEngine:
+    '''Подсчет хэшей файлов целиком в отдельном пуле потоков: одно
+    обращение к пулу на файл, без переходов в цикл событий на каждый кусок.
+    Файл читается через mmap (или readinto в один переиспользуемый буфер),
+    hashlib отпускает GIL, поэтому несколько файлов считаются параллельно.
+    io_concurrency ограничивает число одновременно читаемых файлов'''
+
+    def __init__(self,
+                 workers: int | None = None,
+                 io_concurrency: int = 2,
+                 buffer_size: int = 4 * 1024 * 1024,
+                 use_mmap: bool = True):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.io_concurrency = io_concurrency
+        self.buffer_size = buffer_size
+        self.use_mmap = use_mmap
+        self.files = 0
+        self.bytes = 0
+        self.busy = 0.0  # суммарное время подсчета в потоках, сек
+
+        self._executor: ThreadPoolExecutor | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+
+    def _digest(self, path: str, hash_name: str) -> tuple[str, int, float]:
+        started = monotonic()
+        filehash = hashlib.new(hash_name)
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if self.use_mmap and size:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    if hasattr(mapped, 'madvise'):
+                        mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    view = memoryview(mapped)
+                    try:
+                        for offset in range(0, size, self.buffer_size):
+                            filehash.update(view[offset:offset + self.buffer_size])
+                    finally:
+                        view.release()
+            else:
+                buffer = bytearray(self.buffer_size)
+                view = memoryview(buffer)
+                while read := file.readinto(buffer):
+                    filehash.update(view[:read])
+        return filehash.hexdigest(), size, monotonic() - started
+
+    async def hash_file(self, path: str, hash_name: str = 'md5') -> str:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix='hash')
+            self._semaphore = asyncio.Semaphore(self.io_concurrency)
+        async with self._semaphore:
+            digest, size, elapsed = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._digest, path, hash_name)
+        self.files += 1
+        self.bytes += size
+        self.busy += elapsed
+        return digest
+
+    async def hash_files(self, paths: list[str], hash_name: str = 'md5') -> list[str | None]:
+        '''Хэши нескольких файлов параллельно; None - файл не прочитан'''
+
+        async def one(path):
+            try:
+                return await self.hash_file(path, hash_name)
+            except OSError as exception:
+                logger.warning(f"Хэш {path} не посчитан, {exception=}")
+                return None
+
+        return await asyncio.gather(*(one(path) for path in paths))
+
+    def stats(self) -> dict:
+        return {'files': self.files, 'bytes': self.bytes,
+                'mb_per_s': round(self.bytes / 1024 / 1024 / self.busy, 1) if self.busy else 0.0,
+                'workers': self.workers, 'io_concurrency': self.io_concurrency}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
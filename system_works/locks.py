@@ -0,0 +1,136 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from time import monotonic
+import logging
+
+logger = logging.getLogger(__name__)
+
+SHARED = 'shared'
+EXCLUSIVE = 'exclusive'
+
+
+class LockTimeout(asyncio.TimeoutError):
+    '''Блокировка не получена за отведенное время'''
+
+
+class _LockEntry:
+    # Держатели и очередь ожидающих одного объекта
+
+    __slots__ = ('readers', 'writer', 'waiters')
+
+    def __init__(self):
+        self.readers = 0
+        self.writer = False
+        self.waiters: deque[tuple[str, asyncio.Future]] = deque()
+
+    def compatible(self, mode: str) -> bool:
+        if mode == SHARED:
+            return not self.writer
+        return not self.writer and not self.readers
+
+    def grant(self, mode: str):
+        if mode == SHARED:
+            self.readers += 1
+        else:
+            self.writer = True
+
+    def idle(self) -> bool:
+        return not self.readers and not self.writer and not self.waiters
+
+
+class LockManager:
+    '''Блокировки объектов (файлов) по имени: разделяемые (подсчет хэша,
+    чтение) и исключительные (загрузка, перенос, удаление). Очередь
+    строго FIFO - читатели не обгоняют ждущего писателя. Запись объекта
+    живет, пока его кто-то держит или ждет, и удаляется сразу после.
+    timeout (сек, None - без предела) - время ожидания по умолчанию'''
+
+    def __init__(self, timeout: float | None = None):
+        self.timeout = timeout
+        self.entries: dict[str, _LockEntry] = {}
+        self.acquisitions = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _wake(self, name: str, entry: _LockEntry):
+        while entry.waiters:
+            mode, future = entry.waiters[0]
+            if future.done():
+                entry.waiters.popleft()
+                continue
+            if not entry.compatible(mode):
+                break
+            entry.waiters.popleft()
+            entry.grant(mode)
+            future.set_result(None)
+        if entry.idle():
+            self.entries.pop(name, None)
+
+    async def acquire(self, name: str, mode: str = EXCLUSIVE, timeout: float | None = None):
+        entry = self.entries.setdefault(name, _LockEntry())
+        self.acquisitions += 1
+        if not entry.waiters and entry.compatible(mode):
+            entry.grant(mode)
+            return
+
+        self.contended += 1
+        future = asyncio.get_running_loop().create_future()
+        entry.waiters.append((mode, future))
+        started = monotonic()
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException as exception:
+            if future.done() and not future.cancelled():
+                # Блокировку выдали одновременно с отменой - возвращаем
+                self.release(name, mode)
+            else:
+                # Снятый с очереди может пропускать стоявших за ним
+                self._wake(name, entry)
+            if isinstance(exception, asyncio.TimeoutError):
+                self.timeouts += 1
+                logger.warning(f"Блокировка {mode} {name} не получена за {timeout} c")
+                raise LockTimeout(f'{mode} lock on {name} not acquired in {timeout} s') from None
+            raise
+        finally:
+            waited = monotonic() - started
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def release(self, name: str, mode: str = EXCLUSIVE):
+        entry = self.entries[name]
+        if mode == SHARED:
+            entry.readers -= 1
+        else:
+            entry.writer = False
+        self._wake(name, entry)
+
+    @asynccontextmanager
+    async def shared(self, name: str, timeout: float | None = None):
+        await self.acquire(name, SHARED, timeout)
+        try:
+            yield
+        finally:
+            self.release(name, SHARED)
+
+    @asynccontextmanager
+    async def exclusive(self, name: str, timeout: float | None = None):
+        await self.acquire(name, EXCLUSIVE, timeout)
+        try:
+            yield
+        finally:
+            self.release(name, EXCLUSIVE)
+
+    def locked(self, name: str) -> bool:
+        entry = self.entries.get(name)
+        return entry is not None and (entry.writer or entry.readers > 0)
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries),
+                'waiting': sum(len(entry.waiters) for entry in self.entries.values()),
+                'acquisitions': self.acquisitions, 'contended': self.contended,
+                'timeouts': self.timeouts, 'wait_total': round(self.wait_total, 6),
+                'wait_max': round(self.wait_max, 6)}
@@ -0,0 +1,219 @@
+import asyncio
+import os
+from system_works.async_fs import AsyncFS, commit_file, fsync_dir, readlink_or_none, swap_symlink
+import logging
+
+logger = logging.getLogger(__name__)
+
+DISPLAY_LINK_SUFFIX = '_media.mp4'
+
+
+class MediaStore:
+    '''Контентно-адресуемое хранилище медиа: каждый файл лежит один раз
+    в objects/<md5>. Именованные файлы рабочей директории - жесткие ссылки
+    на объект, ссылки дисплеев {display}_media.mp4 - символьные ссылки на
+    него. Объект удаляется, когда на него не осталось ни одной ссылки.
+    Счетчики ссылок не хранятся, а восстанавливаются по директории (reindex).
+    Асинхронные place, alias, switch_display и release делают системные
+    вызовы в пуле fs, а счетчики ссылок меняют только в цикле событий.
+    Они и пересборка (reindex) идут под общей блокировкой хранилища -
+    пересборка не видит полуготовых ссылок и не удаляет новый объект'''
+
+    def __init__(self, working_dir: str, objects_dir: str = 'objects', fs: AsyncFS | None = None):
+        self.working_dir = os.path.abspath(working_dir)
+        self.objects_dir = os.path.join(self.working_dir, objects_dir)
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.fs = fs or AsyncFS()
+
+        self.refs: dict[str, set[str]] = {}  # {md5: {filename | display:<name>}}
+        self.duplicates_avoided = 0
+        self.bytes_not_downloaded = 0
+
+        self._lock: asyncio.Lock | None = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def blob_path(self, md5hash: str) -> str:
+        return os.path.join(self.objects_dir, md5hash)
+
+    def has(self, md5hash: str) -> bool:
+        return os.path.exists(self.blob_path(md5hash))
+
+    def _ref(self, md5hash: str, ref: str):
+        self.refs.setdefault(md5hash, set()).add(ref)
+
+    def refcount(self, md5hash: str) -> int:
+        return len(self.refs.get(md5hash, ()))
+
+    @staticmethod
+    def _link_name(blob: str, path: str):
+        if os.path.exists(path):
+            if os.path.samefile(path, blob):
+                return
+            os.remove(path)
+        os.link(blob, path)
+
+    def _place(self, src_path: str, blob: str, path: str) -> tuple[bool, os.stat_result]:
+        duplicate = os.path.exists(blob)
+        if duplicate:
+            os.remove(src_path)
+        else:
+            commit_file(src_path, blob, self.fs.durable)
+        self._link_name(blob, path)
+        if self.fs.durable:
+            fsync_dir(self.working_dir)
+        return duplicate, os.stat(path)
+
+    async def place(self, src_path: str, md5hash: str, filename: str) -> tuple[str, os.stat_result]:
+        '''Проверенная загрузка за один переход в пул fs: rename в objects
+        с fsync каталога (если объект уже есть, копия удаляется) и
+        именованная ссылка на объект. Вернет путь имени и его stat'''
+
+        path = os.path.join(self.working_dir, filename)
+        async with self.lock:
+            duplicate, stat = await self.fs.call('place', self._place,
+                                                 src_path, self.blob_path(md5hash), path)
+            if duplicate:
+                self.duplicates_avoided += 1
+            self._ref(md5hash, filename)
+        return path, stat
+
+    def _alias(self, blob: str, path: str) -> os.stat_result | None:
+        if not os.path.exists(blob):
+            return None
+        self._link_name(blob, path)
+        return os.stat(path)
+
+    async def alias(self, md5hash: str, filename: str) -> tuple[str, os.stat_result] | None:
+        '''Объект уже есть - вместо загрузки только имя-ссылка на него.
+        Вернет путь имени и его stat или None, если объекта нет'''
+
+        path = os.path.join(self.working_dir, filename)
+        async with self.lock:
+            stat = await self.fs.call('alias', self._alias, self.blob_path(md5hash), path)
+            if stat is None:
+                return None
+            if filename not in self.refs.get(md5hash, ()):
+                self.duplicates_avoided += 1
+                self.bytes_not_downloaded += stat.st_size
+            self._ref(md5hash, filename)
+        return path, stat
+
+    def _display_target(self, link: str) -> str | None:
+        target = readlink_or_none(link)
+        if target is None or os.path.dirname(target) != self.objects_dir:
+            return None
+        return os.path.basename(target)
+
+    def _swap_display(self, blob: str, link: str) -> str | None:
+        previous = self._display_target(link)
+        swap_symlink(blob, link, self.fs.durable)
+        return previous
+
+    async def switch_display(self, md5hash: str, display: str, link: str) -> str | None:
+        '''Атомарная замена ссылки дисплея на объект через пул fs: временная
+        ссылка, rename поверх старой и fsync каталога. Вернет md5 прежнего
+        объекта дисплея'''
+
+        async with self.lock:
+            previous = await self.fs.call('switch_display', self._swap_display,
+                                          self.blob_path(md5hash), link)
+            self._ref(md5hash, f'display:{display}')
+            if previous is not None and previous != md5hash:
+                await self._release(previous, f'display:{display}')
+        return previous
+
+    async def release(self, md5hash: str, ref: str) -> bool:
+        '''Снимает ссылку через пул fs. Вернет True, если объект удален'''
+
+        async with self.lock:
+            return await self._release(md5hash, ref)
+
+    async def _release(self, md5hash: str, ref: str) -> bool:
+        refs = self.refs.get(md5hash, set())
+        refs.discard(ref)
+        paths = [] if ref.startswith('display:') else [os.path.join(self.working_dir, ref)]
+        if not refs:
+            self.refs.pop(md5hash, None)
+            paths.append(self.blob_path(md5hash))
+        removed = await self.fs.remove(*paths)
+        if self.blob_path(md5hash) in removed:
+            logger.info(f"Объект {md5hash} удален, ссылок не осталось")
+            return True
+        return False
+
+    async def drop(self, md5hash: str, filenames: list[str]):
+        '''Вытеснение: объект и его имена удаляются одним переходом в пул fs,
+        независимо от оставшихся ссылок'''
+
+        async with self.lock:
+            self.refs.pop(md5hash, None)
+            await self.fs.remove(*(os.path.join(self.working_dir, filename) for filename in filenames),
+                                 self.blob_path(md5hash))
+
+    async def reindex(self, files: list[tuple[str, str]], prune: bool = True):
+        '''Восстанавливает счетчики по директории в пуле fs под блокировкой
+        хранилища. files - пары (имя, md5) рабочей директории; файлы,
+        которых еще нет в objects (раскладка до хранилища), переносятся туда
+        жесткой ссылкой. Имена, которые place и alias успели добавить после
+        составления files, сохраняются. prune=False оставляет объекты без
+        ссылок - список files может быть неполным (восстановлен из db.json
+        при быстром старте)'''
+
+        async with self.lock:
+            listed = {filename for filename, _ in files}
+            files = list(files) + [(ref, md5hash) for md5hash, refs in self.refs.items()
+                                   for ref in refs
+                                   if not ref.startswith('display:') and ref not in listed]
+            self.refs = await self.fs.call('rebuild', self._rebuild, files, prune)
+
+    def _rebuild(self, files: list[tuple[str, str]], prune: bool) -> dict[str, set[str]]:
+        # Счетчики собираются в новый словарь, self.refs не трогаем
+        refs: dict[str, set[str]] = {}
+        for filename, md5hash in files:
+            path = os.path.join(self.working_dir, filename)
+            blob = self.blob_path(md5hash)
+            if not os.path.exists(path):
+                continue
+            if not os.path.exists(blob):
+                os.link(path, blob)
+            elif not os.path.samefile(path, blob):
+                # Копия того же содержимого - заменяем ссылкой на объект
+                os.remove(path)
+                os.link(blob, path)
+            refs.setdefault(md5hash, set()).add(filename)
+
+        with os.scandir(self.working_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(DISPLAY_LINK_SUFFIX) and entry.is_symlink():
+                    md5hash = self._display_target(entry.path)
+                    if md5hash is not None and self.has(md5hash):
+                        display = entry.name[:-len(DISPLAY_LINK_SUFFIX)]
+                        refs.setdefault(md5hash, set()).add(f'display:{display}')
+
+        if prune:
+            for blob in os.listdir(self.objects_dir):
+                if blob not in refs:
+                    os.remove(self.blob_path(blob))
+                    logger.info(f"Объект {blob} без ссылок удален")
+        return refs
+
+    def stats(self) -> dict:
+        stored = 0
+        logical = 0
+        for md5hash, refs in self.refs.items():
+            try:
+                size = os.stat(self.blob_path(md5hash)).st_size
+            except FileNotFoundError:
+                continue
+            stored += size
+            logical += size * max(1, sum(not ref.startswith('display:') for ref in refs))
+        return {'objects': len(self.refs),
+                'bytes_stored': stored,
+                'bytes_saved': logical - stored,
+                'duplicates_avoided': self.duplicates_avoided,
+                'bytes_not_downloaded': self.bytes_not_downloaded}
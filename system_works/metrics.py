@@ -0,0 +1,145 @@
+import asyncio
+from time import monotonic
+from aiohttp import web
+import logging
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'media_panel'
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in sorted(labels.items()))
+    return f'{{{pairs}}}'
+
+
+class Summary:
+    # Число наблюдений, сумма, максимум и последнее значение
+
+    __slots__ = ('count', 'total', 'max', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.last = value
+
+
+class Metrics:
+    '''Метрики устройства в текстовом формате Prometheus (/metrics).
+    Счетчики и наблюдения пишутся по месту событий, состояние очередей
+    снимается с компонентов machine в момент запроса'''
+
+    def __init__(self):
+        self.counters: dict[tuple, float] = {}
+        self.summaries: dict[tuple, Summary] = {}
+        self.lag_window_max = 0.0
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        self.summaries.setdefault(self._key(name, labels), Summary()).observe(value)
+
+    async def loop_lag_sampler(self, interval: float = 0.5, window: int = 20):
+        '''Задержка цикла событий: насколько позже заказанного просыпается
+        sleep. Большие значения - цикл занят синхронной работой или
+        ждет диск'''
+
+        samples = 0
+        while True:
+            started = monotonic()
+            await asyncio.sleep(interval)
+            lag = max(0.0, monotonic() - started - interval)
+            self.observe('loop_lag_seconds', lag)
+            self.lag_window_max = max(self.lag_window_max, lag)
+            samples += 1
+            if samples % window == 0:
+                if self.lag_window_max > interval:
+                    logger.warning(f"Задержка цикла событий до {self.lag_window_max:.3f} c")
+                self.lag_window_max = 0.0
+
+    def _gauges(self, machine) -> list[tuple[str, dict, float]]:
+        downloads = machine.downloads.stats()
+        reports = machine.reports.stats()
+        gauges = [
+            ('download_queue_depth', {}, downloads['queue_depth']),
+            ('downloads_active', {}, downloads['active']),
+            ('download_oldest_wait_seconds', {}, downloads['oldest_wait']),
+            ('report_queue_depth', {}, reports['queued']),
+            ('reports_dropped', {}, reports['dropped']),
+            ('schedule_pending', {}, machine.scheduler.pending_count()),
+            ('schedule_tasks', {}, len(machine.scheduler)),
+            ('files', {}, len(machine.files)),
+            ('push_connected', {}, int(machine.push_connected.is_set())),
+            ('loop_lag_window_max_seconds', {}, self.lag_window_max),
+            ('prefetch_budget_used_bytes', {}, machine.prefetch.used()),
+            ]
+        for name, value in machine.locks.stats().items():
+            gauges.append((f'locks_{name}', {}, value))
+        for name, value in machine.store.stats().items():
+            gauges.append((f'store_{name}', {}, value))
+        hasher = machine.hasher.stats()
+        gauges.append(('hash_engine_mb_per_second', {}, hasher['mb_per_s']))
+        for op, stats in machine.fs.ops.items():
+            gauges.append(('fs_op_count', {'op': op}, stats.count))
+            gauges.append(('fs_op_seconds_total', {'op': op}, stats.total))
+            gauges.append(('fs_op_seconds_max', {'op': op}, stats.max))
+        return gauges
+
+    def render(self, machine) -> str:
+        lines = []
+        for name, labels, value in self._gauges(machine):
+            lines.append(f'# TYPE {PREFIX}_{name} gauge')
+            lines.append(f'{PREFIX}_{name}{_labels(labels)} {value}')
+
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {PREFIX}_{name} counter')
+                typed.add(name)
+            lines.append(f'{PREFIX}_{name}{_labels(dict(labels))} {value}')
+
+        by_name: dict[str, list[tuple[str, Summary]]] = {}
+        for (name, labels), summary in sorted(self.summaries.items()):
+            by_name.setdefault(name, []).append((_labels(dict(labels)), summary))
+        for name, series in by_name.items():
+            lines.append(f'# TYPE {PREFIX}_{name} summary')
+            for labels, summary in series:
+                lines.append(f'{PREFIX}_{name}_count{labels} {summary.count}')
+                lines.append(f'{PREFIX}_{name}_sum{labels} {summary.total}')
+            # Максимум и последнее значение - отдельные gauge
+            for suffix in ('max', 'last'):
+                lines.append(f'# TYPE {PREFIX}_{name}_{suffix} gauge')
+                for labels, summary in series:
+                    lines.append(f'{PREFIX}_{name}_{suffix}{labels} {getattr(summary, suffix)}')
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, machine, host: str = '127.0.0.1', port: int = 9100):
+        async def metrics(request: web.Request):
+            return web.Response(text=self.render(machine),
+                                content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Метрики на http://{host}:{port}/metrics")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
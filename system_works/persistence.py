@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import logging
+from time import monotonic
+from typing import Callable
+from system_works.async_fs import fsync_dir
+
+logger = logging.getLogger(__name__)
+
+# Ключ поколения записи в снимке db.json
+GENERATION = '_generation'
+
+
+def atomic_write(path: str, payload: bytes):
+    '''Запись через временный файл: fsync, rename поверх, fsync каталога.
+    При сбое на диске остается либо старая, либо новая версия'''
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path))
+
+
+def load_state(path: str) -> dict:
+    '''Читает снимок db.json и накатывает поверх него журнал секций.
+    Записи журнала с поколением не новее снимка пропускаются: их мог
+    оставить сбой между записью снимка и удалением журнала. В ключе
+    GENERATION вернет наибольшее встреченное поколение'''
+
+    state = {}
+    try:
+        with open(path, encoding='utf-8') as db_json:
+            state = json.load(db_json)
+    except FileNotFoundError:
+        pass
+    snapshot_generation = state.get(GENERATION, 0)
+    generation = snapshot_generation
+
+    try:
+        with open(f'{path}.journal', encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Оборванная при сбое последняя строка
+                    logger.warning(f"Пропущена битая запись журнала {path}")
+                    break
+                # Записи без поколения - из журнала до его введения
+                entry_generation = entry.get('generation')
+                if entry_generation is not None:
+                    generation = max(generation, entry_generation)
+                    if entry_generation <= snapshot_generation:
+                        continue
+                state[entry['section']] = entry['data']
+    except FileNotFoundError:
+        pass
+    state[GENERATION] = generation
+    return state
+
+
+class StatePersistence:
+    '''Сохранение состояния машины в db.json.
+    Запросы на сохранение откладываются на delay секунд и склеиваются в одну
+    запись. Снимок пишется атомарно. В режиме журнала дописываются только
+    изменившиеся секции, полный снимок (компакция) - раз в compact_every
+    записей журнала. Каждая запись (снимок или пачка строк журнала)
+    получает следующее поколение generation - по нему load_state отличает
+    журнал, уже вошедший в снимок. generation - последнее поколение на
+    диске (из load_state). on_flush - хуки соседних файлов состояния (кэш
+    хэшей), записываются вместе с db.json под одной блокировкой'''
+
+    def __init__(self,
+                 path: str,
+                 snapshot: Callable[[], dict],
+                 delay: float = 1.0,
+                 journal: bool = False,
+                 compact_every: int = 200,
+                 report_interval: float = 3600,
+                 generation: int = 0):
+        self.path = path
+        self.journal_path = f'{path}.journal'
+        self.snapshot = snapshot
+        self.delay = delay
+        self.journal = journal
+        self.compact_every = compact_every
+        self.report_interval = report_interval
+        self.generation = generation
+        self.on_flush: list[Callable[[], Callable[[], None] | None]] = []
+
+        self.requests = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.journal_appends = 0
+        self.compactions = 0
+        self._journal_entries = 0
+        self._written_sections: dict[str, bytes] = {}
+        self._pending: asyncio.Task | None = None
+        self._lock: asyncio.Lock | None = None
+        self._started = monotonic()
+        self._last_report = self._started
+
+    def request_save(self):
+        '''Отложенное сохранение, повторные запросы до записи склеиваются'''
+
+        self.requests += 1
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.delay)
+        self._pending = None
+        await self.flush()
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def flush(self):
+        async with self.lock:
+            sections = self.snapshot()
+            await asyncio.to_thread(self._write, sections)
+            await self._run_hooks()
+        self._report()
+
+    async def flush_hooks(self):
+        '''Только записи on_flush, без db.json - под той же блокировкой'''
+
+        async with self.lock:
+            await self._run_hooks()
+
+    async def _run_hooks(self):
+        # Хук вызывается в цикле событий (снимок данных без гонки с их
+        # изменением) и возвращает запись для потока или None
+        for hook in self.on_flush:
+            job = hook()
+            if job is not None:
+                await asyncio.to_thread(job)
+
+    def _write(self, sections: dict):
+        encoded = {name: json.dumps(data, ensure_ascii=False).encode('utf-8')
+                   for name, data in sections.items()}
+        changed = [name for name, payload in encoded.items()
+                   if self._written_sections.get(name) != payload]
+        if not changed:
+            return
+
+        generation = self.generation + 1
+        if (self.journal and self._written_sections
+                and self._journal_entries < self.compact_every):
+            lines = b''.join(
+                b'{"generation": %d, "section": "%s", "data": %s}\n'
+                % (generation, name.encode(), encoded[name])
+                for name in changed)
+            with open(self.journal_path, 'ab') as journal:
+                journal.write(lines)
+                journal.flush()
+                os.fsync(journal.fileno())
+            self._journal_entries += len(changed)
+            self.journal_appends += 1
+            self.bytes_written += len(lines)
+        else:
+            payload = json.dumps({**sections, GENERATION: generation},
+                                 indent=2, ensure_ascii=False).encode('utf-8')
+            atomic_write(self.path, payload)
+            self.bytes_written += len(payload)
+            if os.path.exists(self.journal_path):
+                # Снимок уже содержит все секции журнала; если удаление не
+                # успеет до сбоя, журнал отсечет поколение снимка
+                os.remove(self.journal_path)
+                self.compactions += 1
+            self._journal_entries = 0
+
+        self.generation = generation
+        self.writes += 1
+        for name in changed:
+            self._written_sections[name] = encoded[name]
+
+    def stats(self) -> dict:
+        hours = max((monotonic() - self._started) / 3600, 1e-9)
+        return {
+            'requests': self.requests,
+            'writes': self.writes,
+            'bytes_written': self.bytes_written,
+            'journal_appends': self.journal_appends,
+            'compactions': self.compactions,
+            'writes_per_hour': round(self.writes / hours, 1),
+            'bytes_per_hour': round(self.bytes_written / hours),
+            }
+
+    def _report(self):
+        if monotonic() - self._last_report >= self.report_interval:
+            self._last_report = monotonic()
+            logger.info(f"Запись состояния: {self.stats()}")
@@ -0,0 +1,38 @@
+import time
+from time import monotonic
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def since_boot() -> float | None:
+    # Секунды от загрузки системы, включая сон
+    if hasattr(time, 'CLOCK_BOOTTIME'):
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+    return None
+
+
+class StartupClock:
+    '''Время до первого кадра: от запуска процесса и от загрузки системы
+    до момента, когда дисплей впервые показывает файл (ссылка дисплея
+    проверена или заменена). mode - 'fast' (состояние из db.json) или
+    'full' (со сверкой файлов до старта)'''
+
+    def __init__(self):
+        self.started = monotonic()
+        self.mode = 'full'
+        self.first_frame: dict | None = None
+
+    def frame(self, machine, display: str):
+        if self.first_frame is not None:
+            return
+        since_start = monotonic() - self.started
+        boot = since_boot()
+        self.first_frame = {'mode': self.mode, 'display': display,
+                            'since_start': round(since_start, 3),
+                            'since_boot': round(boot, 3) if boot is not None else None}
+        machine.metrics.observe('time_to_first_frame_seconds', since_start, mode=self.mode)
+        if boot is not None:
+            machine.metrics.observe('boot_to_first_frame_seconds', boot, mode=self.mode)
+        machine.reports.put('startup', self.first_frame)
+        logger.info(f"Первый кадр: {self.first_frame}")
@@ -0,0 +1,172 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+from time import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Состояния задач, файлы которых вытеснять нельзя
+PROTECTED_STATES = ('scheduled', 'current', 'downloading')
+
+# fallocate(2): выделить блоки, не меняя размер файла
+FALLOC_FL_KEEP_SIZE = 0x01
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong)
+except (OSError, AttributeError, TypeError):
+    _fallocate = None
+
+
+def preallocate(path: str, offset: int, length: int, keep_size: bool = False):
+    '''Выделение места под оставшуюся часть загрузки до начала записи:
+    нехватка места обнаруживается сразу, а файл ложится непрерывно.
+    keep_size - размер файла не меняется (FALLOC_FL_KEEP_SIZE), чтобы
+    после сбоя по нему по-прежнему считалась позиция докачки. Без
+    fallocate(2) место в этом случае только проверяется'''
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if length <= 0:
+            return
+        if not keep_size:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, offset, length)
+        elif _fallocate is not None:
+            if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+                code = ctypes.get_errno()
+                if code not in (errno.EOPNOTSUPP, errno.ENOSYS):
+                    raise OSError(code, os.strerror(code), path)
+    finally:
+        os.close(fd)
+
+
+def disk_usage(path: str) -> int:
+    try:
+        return os.stat(path).st_blocks * 512
+    except FileNotFoundError:
+        return 0
+
+
+def scan_usage(objects_dir: str, downloading_dir: str,
+               working_dir: str) -> tuple[int, int, dict[str, tuple[int, float]]]:
+    '''Все, что нужно для решения о вытеснении, за один проход в пуле fs:
+    (занято objects и загрузками, свободно на разделе,
+    {md5: (занято объектом, mtime)})'''
+
+    objects = {}
+    with os.scandir(objects_dir) as entries:
+        for entry in entries:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            objects[entry.name] = (stat.st_blocks * 512, stat.st_mtime)
+    used = sum(size for size, _ in objects.values())
+    with os.scandir(downloading_dir) as entries:
+        used += sum(disk_usage(entry.path) for entry in entries
+                    if entry.is_file(follow_symlinks=False))
+    stat = os.statvfs(working_dir)
+    return used, stat.f_bavail * stat.f_frsize, objects
+
+
+class StorageManager:
+    '''Учет места под медиа. quota - предел объема objects и загрузок
+    (0 - без предела, только свободное место на диске), reserve - сколько
+    места оставлять свободным на разделе. При нехватке вытесняются объекты,
+    которые не проигрываются и не нужны ожидающим задачам расписания,
+    начиная с давно не использованных. Обход диска и удаление идут
+    в пуле machine.fs'''
+
+    def __init__(self, quota: int = 0, reserve: int = 100 * 1024 * 1024):
+        self.quota = quota
+        self.reserve = reserve
+        self.last_used: dict[str, float] = {}
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.refused = 0
+
+    async def _scan(self, machine) -> tuple[int, int, dict[str, tuple[int, float]]]:
+        return await machine.fs.call('storage_scan', scan_usage, machine.store.objects_dir,
+                                     machine.downloading_dir, machine.working_dir)
+
+    def touch(self, md5hash: str):
+        self.last_used[md5hash] = time()
+
+    def candidates(self, machine, objects: dict[str, tuple[int, float]]) -> list[str]:
+        '''Объекты, которые можно вытеснить, от давно не использованных.
+        objects - {md5: (размер, mtime)} из scan_usage'''
+
+        protected = {task.md5hash for task in machine.scheduler
+                     if task.state in PROTECTED_STATES}
+        # Объекты со ссылкой дисплея тоже проигрываются, даже если
+        # machine.current еще не восстановлен
+        displayed = {md5hash for md5hash, refs in machine.store.refs.items()
+                     if any(ref.startswith('display:') for ref in refs)}
+        evictable = [md5hash for md5hash in objects
+                     if md5hash not in protected and md5hash not in displayed
+                     and not machine.current.is_playing(md5hash)]
+        # До первого использования - время появления объекта
+        return sorted(evictable,
+                      key=lambda md5hash: self.last_used.get(md5hash, objects[md5hash][1]))
+
+    def _shortage(self, used: int, free: int, needed: int) -> int:
+        shortage = needed + self.reserve - free
+        if self.quota:
+            shortage = max(shortage, used + needed - self.quota)
+        return shortage
+
+    async def evict(self, machine, md5hash: str, size: int):
+        filenames = [record.filename for record in machine.files.by_md5(md5hash)]
+        for filename in filenames:
+            machine.files.remove(filename)
+            machine.hash_cache.discard(os.path.join(machine.working_dir, filename))
+        await machine.store.drop(md5hash, filenames)
+        self.last_used.pop(md5hash, None)
+        self.evicted_files += 1
+        self.evicted_bytes += size
+
+    async def ensure_space(self, machine, needed: int = 0) -> bool:
+        '''Освобождает место под needed байт. Вернет False, если места
+        не хватит даже после вытеснения всех кандидатов'''
+
+        used, free, objects = await self._scan(machine)
+        shortage = self._shortage(used, free, needed)
+        if shortage <= 0:
+            return True
+        candidates = self.candidates(machine, objects)
+        if sum(objects[md5hash][0] for md5hash in candidates) < shortage:
+            # Вытеснение не поможет - ничего не удаляем
+            self.refused += 1
+            logger.error(f"Нет места под {needed} байт: не хватает {shortage}, "
+                         f"вытеснять можно {len(candidates)} объектов")
+            return False
+        for md5hash in candidates:
+            freed = objects[md5hash][0]
+            await self.evict(machine, md5hash, freed)
+            shortage -= freed
+            logger.info(f"Вытеснен объект {md5hash}: {freed} байт, "
+                        f"не хватает еще {max(shortage, 0)} байт")
+            if shortage <= 0:
+                break
+        machine.persistence.request_save()
+        return True
+
+    async def reserve_download(self, machine, path: str, offset: int, length: int,
+                               keep_size: bool = False):
+        '''Проверка места и предвыделение под загрузку. Нехватка места -
+        OSError(ENOSPC) до начала записи. keep_size - для загрузок, позиция
+        докачки которых берется из размера файла'''
+
+        if not await self.ensure_space(machine, length):
+            raise OSError(errno.ENOSPC, f'No space for {length} bytes', path)
+        await machine.fs.call('preallocate', preallocate, path, offset, length, keep_size)
+
+    async def stats(self, machine) -> dict:
+        used, free, _ = await self._scan(machine)
+        return {'usage': used, 'free': free,
+                'quota': self.quota, 'evicted_files': self.evicted_files,
+                'evicted_bytes': self.evicted_bytes, 'refused': self.refused}
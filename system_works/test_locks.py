@@ -0,0 +1,138 @@
+import asyncio
+import pytest
+from system_works.locks import EXCLUSIVE, SHARED, LockManager, LockTimeout
+
+
+async def hold(locks, name, mode, order, label, release: asyncio.Event):
+    await locks.acquire(name, mode)
+    order.append(label)
+    await release.wait()
+    locks.release(name, mode)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_shared_holders_coexist():
+    async def scenario():
+        locks = LockManager()
+        async with locks.shared('a.mp4'):
+            async with locks.shared('a.mp4'):
+                assert locks.entries['a.mp4'].readers == 2
+                assert locks.locked('a.mp4')
+        assert not locks.locked('a.mp4')
+        # Запись объекта удаляется, как только его никто не держит
+        assert locks.entries == {}
+        assert locks.stats()['contended'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_fifo_readers_do_not_overtake_writer():
+    async def scenario():
+        locks = LockManager()
+        order = []
+        release = {label: asyncio.Event() for label in ('r1', 'w1', 'r2', 'w2')}
+        tasks = []
+        for label, mode in (('r1', SHARED), ('w1', EXCLUSIVE), ('r2', SHARED), ('w2', EXCLUSIVE)):
+            tasks.append(asyncio.create_task(hold(locks, 'a.mp4', mode, order, label, release[label])))
+            await settle()
+
+        # Читатель r2 стоит за писателем w1, хотя совместим с r1
+        assert order == ['r1']
+        for label, expected in (('r1', ['r1', 'w1']), ('w1', ['r1', 'w1', 'r2']),
+                                ('r2', ['r1', 'w1', 'r2', 'w2'])):
+            release[label].set()
+            await settle()
+            assert order == expected
+        release['w2'].set()
+        await asyncio.gather(*tasks)
+        assert locks.entries == {}
+        assert locks.stats()['contended'] == 3
+
+    asyncio.run(scenario())
+
+
+def test_consecutive_readers_granted_together():
+    async def scenario():
+        locks = LockManager()
+        order = []
+        release = asyncio.Event()
+        await locks.acquire('a.mp4', EXCLUSIVE)
+        tasks = [asyncio.create_task(hold(locks, 'a.mp4', SHARED, order, label, release))
+                 for label in ('r1', 'r2', 'r3')]
+        await settle()
+        locks.release('a.mp4', EXCLUSIVE)
+        await settle()
+        assert order == ['r1', 'r2', 'r3']
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_timeout_leaves_queue_and_wakes_followers():
+    async def scenario():
+        locks = LockManager()
+        order = []
+        release = asyncio.Event()
+        await locks.acquire('a.mp4', SHARED)
+        writer = asyncio.create_task(locks.acquire('a.mp4', EXCLUSIVE, timeout=0.05))
+        await settle()
+        reader = asyncio.create_task(hold(locks, 'a.mp4', SHARED, order, 'r2', release))
+        await settle()
+        assert order == []
+
+        with pytest.raises(LockTimeout):
+            await writer
+        # Ушедший по таймауту писатель больше не задерживает читателя
+        await settle()
+        assert order == ['r2']
+        assert locks.stats()['timeouts'] == 1
+
+        release.set()
+        await reader
+        locks.release('a.mp4', SHARED)
+        assert locks.entries == {}
+
+    asyncio.run(scenario())
+
+
+def test_default_timeout_and_lock_timeout_type():
+    async def scenario():
+        locks = LockManager(timeout=0.01)
+        async with locks.exclusive('a.mp4'):
+            with pytest.raises(asyncio.TimeoutError):
+                async with locks.shared('a.mp4'):
+                    pass
+        assert locks.entries == {}
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_removed():
+    async def scenario():
+        locks = LockManager()
+        await locks.acquire('a.mp4', EXCLUSIVE)
+        waiter = asyncio.create_task(locks.acquire('a.mp4', EXCLUSIVE))
+        await settle()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        locks.release('a.mp4', EXCLUSIVE)
+        assert locks.entries == {}
+
+        # Блокировка, выданная одновременно с отменой, возвращается
+        await locks.acquire('b.mp4', EXCLUSIVE)
+        waiter = asyncio.create_task(locks.acquire('b.mp4', EXCLUSIVE))
+        await settle()
+        locks.release('b.mp4', EXCLUSIVE)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not locks.locked('b.mp4')
+        assert locks.entries == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,91 @@
+import asyncio
+import json
+from system_works.persistence import GENERATION, StatePersistence, load_state
+
+
+def write_journal(path, entries):
+    with open(f'{path}.journal', 'w', encoding='utf-8') as journal:
+        for entry in entries:
+            journal.write(json.dumps(entry) + '\n')
+
+
+def test_load_state_missing(tmp_path):
+    assert load_state(str(tmp_path / 'db.json')) == {GENERATION: 0}
+
+
+def test_journal_replayed_over_snapshot(tmp_path):
+    path = tmp_path / 'db.json'
+    path.write_text(json.dumps({'files': ['a'], 'current': [], GENERATION: 3}))
+    write_journal(path, [{'generation': 4, 'section': 'files', 'data': ['a', 'b']},
+                         {'generation': 5, 'section': 'current', 'data': ['x']}])
+
+    state = load_state(str(path))
+    assert state['files'] == ['a', 'b']
+    assert state['current'] == ['x']
+    assert state[GENERATION] == 5
+
+
+def test_journal_older_than_snapshot_skipped(tmp_path):
+    # Сбой между записью снимка и удалением журнала
+    path = tmp_path / 'db.json'
+    path.write_text(json.dumps({'files': [], GENERATION: 7}))
+    write_journal(path, [{'generation': 5, 'section': 'files', 'data': ['deleted.mp4']},
+                         {'generation': 6, 'section': 'files', 'data': ['deleted.mp4', 'b']}])
+
+    state = load_state(str(path))
+    assert state['files'] == []
+    assert state[GENERATION] == 7
+
+
+def test_torn_last_line_ignored(tmp_path):
+    path = tmp_path / 'db.json'
+    path.write_text(json.dumps({'files': [], GENERATION: 1}))
+    write_journal(path, [{'generation': 2, 'section': 'files', 'data': ['a']}])
+    with open(f'{path}.journal', 'a', encoding='utf-8') as journal:
+        journal.write('{"generation": 3, "section": "fil')
+
+    assert load_state(str(path))['files'] == ['a']
+
+
+def test_legacy_journal_without_generation(tmp_path):
+    path = tmp_path / 'db.json'
+    path.write_text(json.dumps({'files': []}))
+    write_journal(path, [{'section': 'files', 'data': ['a']}])
+
+    assert load_state(str(path))['files'] == ['a']
+
+
+def test_compaction_crash_window(tmp_path):
+    path = str(tmp_path / 'db.json')
+    state = {'files': [], 'current': []}
+    persistence = StatePersistence(path, snapshot=lambda: dict(state),
+                                   journal=True, compact_every=2)
+
+    async def flush(**changes):
+        state.update(changes)
+        await persistence.flush()
+
+    async def scenario():
+        await flush(files=['a'])               # снимок
+        await flush(files=['a', 'b'])          # журнал
+        await flush(current=['a'])             # журнал
+        with open(f'{path}.journal', encoding='utf-8') as journal:
+            saved_journal = journal.read()
+        await flush(files=['b'])               # компакция: снимок, журнал удален
+        return saved_journal
+
+    saved_journal = asyncio.run(scenario())
+    assert load_state(path)['files'] == ['b']
+
+    # Журнал пережил компакцию - его записи старше снимка
+    with open(f'{path}.journal', 'w', encoding='utf-8') as journal:
+        journal.write(saved_journal)
+    state = load_state(path)
+    assert state['files'] == ['b']
+    assert state['current'] == ['a']
+
+    # После перезапуска поколения продолжаются, а не начинаются заново
+    restarted = StatePersistence(path, snapshot=lambda: {'files': ['c'], 'current': ['a']},
+                                 journal=True, generation=state[GENERATION])
+    asyncio.run(restarted.flush())
+    assert load_state(path)['files'] == ['c']
@@ -0,0 +1,120 @@
+import asyncio
+import os
+from collections import deque
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Сколько байт с начала файла прочитать для проверки готовности
+VERIFY_BYTES = 1024 * 1024
+
+
+class Prefetcher:
+    '''Прогрев следующего файла дисплея в page cache перед переключением.
+    За lead_time секунд до слота файл помечается posix_fadvise(WILLNEED),
+    начало файла читается для проверки. Объем прогретых, но еще не
+    включенных файлов ограничен memory_budget байт - сверх бюджета
+    прогревается только начало файла. Для каждого дисплея хранится
+    история фактических пауз переключения. Не скачанный к слоту файл
+    качается одной задачей на (дисплей, md5), неудачная загрузка
+    повторяется через retry_delay секунд, удваивая паузу до max_retry_delay'''
+
+    def __init__(self, lead_time: float = 30, memory_budget: int = 256 * 1024 * 1024,
+                 gap_history: int = 50, retry_delay: float = 5, max_retry_delay: float = 300):
+        self.lead_time = lead_time
+        self.memory_budget = memory_budget
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.warmed: dict[tuple, int] = {}  # {(display, md5hash): прогрето байт}
+        self.fetches: dict[tuple, asyncio.Task] = {}  # срочные загрузки к слоту
+        self.retries: dict[tuple, tuple[float, float]] = {}  # {key: (повтор после, пауза)}
+        self.switch_gaps: dict[str, deque] = {}  # {display: (пауза, сек; был ли прогрет)}
+        self.gap_history = gap_history
+        self.warmups = 0
+        self.partial_warmups = 0
+
+    def used(self) -> int:
+        return sum(self.warmed.values())
+
+    def is_warmed(self, key: tuple) -> bool:
+        return key in self.warmed
+
+    def warm(self, key: tuple, path: str) -> bool:
+        '''Прогрев файла в пределах бюджета. Вернет False, если файл
+        не читается (еще не скачан или поврежден)'''
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as exception:
+            logger.warning(f"Прогрев {path} невозможен, {exception=}")
+            return False
+        try:
+            size = os.fstat(fd).st_size
+            length = min(size, max(self.memory_budget - self.used(), VERIFY_BYTES))
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+            # Чтение начала и подтверждает готовность, и прогревает там,
+            # где fadvise нет
+            verify = min(size, VERIFY_BYTES)
+            if size and len(os.pread(fd, verify, 0)) != verify:
+                return False
+        finally:
+            os.close(fd)
+
+        self.warmed[key] = length
+        self.warmups += 1
+        if length < size:
+            self.partial_warmups += 1
+        logger.info(f"Прогрет {path}: {length} из {size} байт, бюджет занят на {self.used()}")
+        return True
+
+    def release(self, key: tuple):
+        self.warmed.pop(key, None)
+
+    def fetch_wait(self, key: tuple, now: float) -> float | None:
+        '''Сколько ждать до новой срочной загрузки key: None - можно
+        начинать сейчас. Завершенная неудачей загрузка откладывает повтор'''
+
+        fetch = self.fetches.get(key)
+        if fetch is not None:
+            if not fetch.done():
+                return 1.0
+            del self.fetches[key]
+            result = None if fetch.cancelled() else fetch.result()
+            if result and result[0]:
+                self.retries.pop(key, None)
+            else:
+                _, delay = self.retries.get(key, (0.0, self.retry_delay / 2))
+                delay = min(delay * 2, self.max_retry_delay)
+                self.retries[key] = (now + delay, delay)
+                logger.warning(f"Срочная загрузка {key} не удалась, повтор через {delay:.0f} c")
+        retry_at = self.retries.get(key, (0.0, 0.0))[0]
+        return retry_at - now if retry_at > now else None
+
+    def track_fetch(self, key: tuple, fetch: asyncio.Task):
+        self.fetches[key] = fetch
+
+    def forget(self, key: tuple):
+        # Задача снята с расписания: загрузка продолжается в общей очереди
+        self.release(key)
+        self.fetches.pop(key, None)
+        self.retries.pop(key, None)
+
+    def record_switch(self, display: str, md5hash: str, gap: float):
+        '''Фактическая пауза переключения дисплея, сек'''
+
+        key = (display, md5hash)
+        warmed = key in self.warmed
+        self.switch_gaps.setdefault(
+            display, deque(maxlen=self.gap_history)).append((round(gap, 3), warmed))
+        self.release(key)
+        logger.info(f"Переключение дисплея {display}: пауза {gap:.3f} c, прогрет: {warmed}")
+
+    def stats(self) -> dict:
+        gaps = {display: {'last': history[-1][0],
+                          'max': max(gap for gap, _ in history),
+                          'avg': round(sum(gap for gap, _ in history) / len(history), 3)}
+                for display, history in self.switch_gaps.items() if history}
+        return {'warmups': self.warmups, 'partial_warmups': self.partial_warmups,
+                'budget_used': self.used(), 'fetching': len(self.fetches),
+                'retrying': len(self.retries), 'switch_gaps': gaps}